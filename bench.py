@@ -0,0 +1,1078 @@
+"""Benchmarks del bot Knock Twice.
+
+Uso:
+    python bench.py render      # coste por clic de las pantallas estáticas, con y sin caché
+    python bench.py estres      # muchos usuarios a la vez: ningún clic del carrito se pierde
+    python bench.py webhook [updates.jsonl]  # POST de updates al webhook local a máxima velocidad
+    python bench.py recorridos [-n 200] [--guardar base.json] [--comparar base.json]
+                                # recorridos completos de cliente: p50/p99 por ruta y memoria
+    python bench.py e2e [-c 1000] [--latencia 20] [--errores 0.01] [--retry-after 0.01]
+                                # el bot real en polling contra una Bot API falsa local
+    python bench.py catalogo [carta.json]  # valida la carta, recarga una copia modificada y mide la carga
+    python bench.py perfil [hilos]   # handlers perfilados a la vez: ninguno se pierde
+"""
+import argparse
+import contextlib
+import heapq
+import http.client
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher
+from telegram.utils.request import Request
+
+# La BD de los benchmarks nunca es la de producción
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="knocktwice_bench_"), "bench.db"))
+# Sólo avisos y errores: los logs de cada clic falsearían las mediciones
+os.environ.setdefault("LOG_NIVEL", "WARNING")
+
+import main
+
+
+# ============ OBJETOS FALSOS DE TELEGRAM ============
+class UsuarioFalso:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"cliente{user_id}"
+        self.first_name = f"Cliente {user_id}"
+
+
+class MensajeFalso:
+    def __init__(self, texto=None, latencia=0.0):
+        self.text = texto
+        self.latencia = latencia
+        self.respuestas = []
+
+    def reply_text(self, texto, reply_markup=None, parse_mode=None):
+        time.sleep(self.latencia)
+        self.respuestas.append(texto)
+
+
+class QueryFalsa:
+    def __init__(self, data, usuario, latencia=0.0):
+        self.data = data
+        self.from_user = usuario
+        self.message = MensajeFalso("Mensaje original")
+        self.latencia = latencia
+        self.ediciones = []
+
+    def answer(self, texto=None, show_alert=False):
+        pass
+
+    def edit_message_text(self, texto, reply_markup=None, parse_mode=None):
+        time.sleep(self.latencia)
+        self.ediciones.append(texto)
+
+
+class UpdateFalso:
+    def __init__(self, usuario, data=None, texto=None, latencia=0.0):
+        self.effective_user = usuario
+        self.effective_chat = usuario
+        self.callback_query = QueryFalsa(data, usuario, latencia) if data is not None else None
+        self.message = MensajeFalso(texto, latencia) if data is None else None
+
+
+class BotFalso:
+    def __init__(self):
+        self.enviados = []
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        self.enviados.append((chat_id, text))
+
+
+class ContextoFalso:
+    def __init__(self, user_data, bot):
+        self.user_data = user_data
+        self.bot = bot
+        self.dispatcher = SimpleNamespace(persistence=None)
+
+
+@contextlib.contextmanager
+def _silencio():
+    """Oculta la salida por consola durante la medición"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def _pico_bytes(funcion, repeticiones=200):
+    """Pico medio de memoria asignada durante una llamada (bytes)"""
+    tracemalloc.start()
+    total = 0
+    for _ in range(repeticiones):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        funcion()
+        total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return total / repeticiones
+
+
+def _microsegundos(funcion, numero=2000):
+    """Mejor tiempo medio por llamada (µs) de 5 rondas"""
+    return min(timeit.repeat(funcion, number=numero, repeat=5)) / numero * 1e6
+
+
+def _casos_render():
+    """(nombre, sin caché, con caché) para cada pantalla estática"""
+    menu, faq = main.CATALOGO.menu, main.CATALOGO.faq
+    casos = [
+        ("menu_principal", lambda: main._pantalla_menu_principal(menu), lambda: main.pantalla('menu_principal', None)),
+        ("faq_menu", lambda: main._pantalla_faq_menu(faq), lambda: main.pantalla('faq_menu', None)),
+    ]
+    for categoria, datos in menu.items():
+        casos.append((f"cat_{categoria}",
+                      lambda c=categoria, d=datos: main._pantalla_categoria(c, d),
+                      lambda c=categoria: main.pantalla('cat', c)))
+    categoria, datos = next(iter(menu.items()))
+    producto_id, producto = next(iter(datos['productos'].items()))
+    casos.append((f"info_{categoria}_{producto_id}",
+                  lambda: main._pantalla_producto(categoria, producto_id, producto),
+                  lambda: main.pantalla('info', categoria, producto_id)))
+    clave_faq, datos_faq = next(iter(faq.items()))
+    casos.append((f"faq_{clave_faq}", lambda: main._pantalla_faq(datos_faq), lambda: main.pantalla('faq', clave_faq)))
+    casos.append(("valorar_pedido_42",
+                  lambda: main.teclado_valoracion_pedido.__wrapped__(42),
+                  lambda: main.teclado_valoracion_pedido(42)))
+    return casos
+
+
+def bench_render():
+    print(f"{'pantalla':<22} {'sin caché µs':>12} {'con caché µs':>12} {'sin caché B':>12} {'con caché B':>12}")
+    for nombre, sin_cache, con_cache in _casos_render():
+        con_cache()  # calienta la caché LRU de las plantillas por pedido
+        print(f"{nombre:<22} {_microsegundos(sin_cache):>12.2f} {_microsegundos(con_cache):>12.2f} "
+              f"{_pico_bytes(sin_cache):>12.0f} {_pico_bytes(con_cache):>12.0f}")
+
+
+def bench_estres(usuarios=300, clics=20, latencia=0.002):
+    """Clics de añadir al carrito de muchos usuarios a la vez a través del ejecutor"""
+    usuarios, clics, latencia = int(usuarios), int(clics), float(latencia)
+    if main.EJECUTOR is None:
+        sys.exit("BOT_HILOS=0: no hay ejecutor concurrente que probar")
+    main.init_db()
+    
+    bot = BotFalso()
+    datos_usuario = defaultdict(dict)
+    activos = defaultdict(int)
+    solapes = []
+    lock = threading.Lock()
+    
+    def handler_vigilado(update, context):
+        user_id = update.effective_user.id
+        with lock:
+            activos[user_id] += 1
+            if activos[user_id] > 1:
+                solapes.append(user_id)
+        try:
+            main.button_handler(update, context)
+        finally:
+            with lock:
+                activos[user_id] -= 1
+    
+    handler = main.en_paralelo(handler_vigilado)
+    inicio = time.perf_counter()
+    with _silencio():
+        for _ in range(clics):
+            for user_id in range(1, usuarios + 1):
+                usuario = UsuarioFalso(user_id)
+                update = UpdateFalso(usuario, data="add_pizzas_margarita_1", latencia=latencia)
+                handler(update, ContextoFalso(datos_usuario[user_id], bot))
+        profundidad_maxima = main.EJECUTOR.pendientes
+        while main.EJECUTOR.pendientes:
+            time.sleep(0.01)
+    duracion = time.perf_counter() - inicio
+    
+    perdidos = sum(clics - main.obtener_carrito(ContextoFalso(datos_usuario[u], bot)).unidades
+                   for u in range(1, usuarios + 1))
+    total = usuarios * clics
+    print(f"Usuarios: {usuarios} • clics por usuario: {clics} • hilos: {main.EJECUTOR.hilos}")
+    print(f"Updates: {total} en {duracion:.2f}s ({total / duracion:.0f}/s) • cola máxima: {profundidad_maxima}")
+    print(f"Unidades perdidas: {perdidos} • solapes del mismo usuario: {len(solapes)}")
+    print("✅ OK" if not perdidos and not solapes else "❌ FALLO")
+    return not perdidos and not solapes
+
+
+def _update_sintetico(update_id, user_id, data):
+    """JSON de un update de callback_query como los que envía Telegram"""
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": usuario,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "text": "Knock Twice"},
+        },
+    }
+
+
+def bench_webhook(fichero=None, updates=3000, conexiones=16):
+    """Envía updates grabados (o sintéticos) al webhook del servidor web local"""
+    updates, conexiones = int(updates), int(conexiones)
+    main.WEBHOOK_SECRET = main.WEBHOOK_SECRET or "secreto-bench"
+    if fichero:
+        with open(fichero, "rb") as f:
+            cuerpos = [linea.strip() for linea in f if linea.strip()]
+    else:
+        recorrido = ["menu_principal", "cat_pizzas", "info_pizzas_margarita", "add_pizzas_margarita_2", "ver_carrito"]
+        cuerpos = [json.dumps(_update_sintetico(i, 1000 + i % 250, recorrido[i % len(recorrido)])).encode()
+                   for i in range(updates)]
+    
+    recibidos = queue.Queue()
+    with _silencio():
+        servidor = main.crear_servidor_web(0)
+    servidor.despachador = SimpleNamespace(bot=None, update_queue=recibidos)
+    puerto = servidor.server_address[1]
+    
+    def post(cuerpo, secreto=main.WEBHOOK_SECRET):
+        conexion = http.client.HTTPConnection("127.0.0.1", puerto, timeout=10)
+        inicio = time.perf_counter()
+        try:
+            conexion.request("POST", main.RUTA_WEBHOOK, body=cuerpo, headers={
+                "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secreto})
+            estado = conexion.getresponse().status
+        except OSError:
+            estado = None
+        finally:
+            conexion.close()
+        return estado, time.perf_counter() - inicio
+    
+    with _silencio():
+        rechazado, _ = post(cuerpos[0], secreto="incorrecto")
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=conexiones) as pool:
+            resultados = list(pool.map(post, cuerpos))
+        duracion = time.perf_counter() - inicio
+    servidor.shutdown()
+    
+    latencias = sorted(latencia for _, latencia in resultados)
+    errores = sum(1 for estado, _ in resultados if estado != 200)
+    print(f"Updates: {len(cuerpos)} en {duracion:.2f}s ({len(cuerpos) / duracion:.0f}/s) con {conexiones} conexiones")
+    print(f"Latencia POST p50 {latencias[len(latencias) // 2] * 1000:.1f} ms • "
+          f"p99 {latencias[int(len(latencias) * 0.99)] * 1000:.1f} ms")
+    print(f"Errores HTTP: {errores} • en cola del dispatcher: {recibidos.qsize()} • secreto incorrecto -> {rechazado}")
+    ok = errores == 0 and recibidos.qsize() == len(cuerpos) and rechazado == 403
+    print("✅ OK" if ok else "❌ FALLO")
+    return ok
+
+
+# ============ RECORRIDOS DE CLIENTE ============
+class PeticionGrabadora(Request):
+    """Request que no sale a la red: anota cada llamada a la API y responde True"""
+    __slots__ = ('latencia', 'llamadas')  # PTB avisa de atributos nuevos fuera de __slots__
+
+    def __init__(self, latencia=0.0):
+        super().__init__(con_pool_size=1)
+        self.latencia = latencia
+        self.llamadas = defaultdict(int)
+
+    def post(self, url, data, timeout=None):
+        self.llamadas[url.rsplit('/', 1)[-1]] += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+        return True
+
+
+def _update_mensaje(update_id, user_id, texto):
+    """JSON de un update de mensaje de texto de un chat privado"""
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}", "username": f"cliente{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": int(time.time()), "from": usuario,
+                    "chat": {"id": user_id, "type": "private"}, "text": texto},
+    }
+
+
+class Recorrido:
+    """Un cliente que hace un pedido completo, con cada handler cronometrado por ruta"""
+
+    def __init__(self, despachador, user_id, tiempos):
+        self.despachador = despachador
+        self.user_id = user_id
+        self.tiempos = tiempos  # ruta -> [segundos]
+        self.update_id = user_id * 100
+
+    def _ejecutar(self, ruta, handler, datos):
+        self.update_id += 1
+        update = Update.de_json(datos, self.despachador.bot)
+        contexto = CallbackContext.from_update(update, self.despachador)
+        inicio = time.perf_counter()
+        handler(update, contexto)
+        if self.tiempos is not None:
+            self.tiempos[ruta].append(time.perf_counter() - inicio)
+
+    def comando(self, texto, handler):
+        self._ejecutar(texto, handler, _update_mensaje(self.update_id, self.user_id, texto))
+
+    def texto(self, texto):
+        self._ejecutar("mensaje", main.handle_message, _update_mensaje(self.update_id, self.user_id, texto))
+
+    def boton(self, data, user_id=None):
+        ruta = main.resolver_callback(data)[0]
+        datos = _update_sintetico(self.update_id, user_id or self.user_id, data)
+        datos["callback_query"]["from"]["username"] = f"cliente{user_id or self.user_id}"
+        self._ejecutar(ruta, main.button_handler, datos)
+
+    def completo(self):
+        """Inicio → carta → producto → carrito → dirección → hora → entrega → valoración"""
+        self.comando("/start", main.start)
+        for data in ("menu_principal", "cat_pizzas", "info_pizzas_margarita", "add_pizzas_margarita_1",
+                     "cat_burgers", "info_burgers_classic", "add_burgers_classic_2", "ver_carrito",
+                     "pedir_direccion"):
+            self.boton(data)
+        self.texto("Calle Principal 123, Piso 2A")
+        self.boton("hora_21:00")
+        
+        with main.get_db() as conn:
+            pedido_id = conn.execute("SELECT MAX(id) FROM pedidos WHERE user_id = ?", (self.user_id,)).fetchone()[0]
+        self.boton(f"entregado_{pedido_id}", user_id=main.ADMIN_IDS[0])
+        self.boton("valorar_menu")
+        self.boton(f"valorar_pedido_{pedido_id}")
+        self.boton(f"puntuar_{pedido_id}_5")
+
+
+def _percentil(muestras, p):
+    return muestras[min(len(muestras) - 1, int(len(muestras) * p / 100))]
+
+
+def _commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _comparar(actual, base, umbral):
+    """Imprime las diferencias con una línea base; devuelve las rutas que empeoran más de `umbral`"""
+    print(f"\nComparación con la base ({base.get('commit') or '?'} del {base.get('fecha', '?')[:16]}):")
+    regresiones = []
+    for ruta, datos in actual["rutas"].items():
+        anterior = base["rutas"].get(ruta)
+        if not anterior:
+            continue
+        cambio = datos["p50_ms"] / anterior["p50_ms"] - 1 if anterior["p50_ms"] else 0.0
+        # Por debajo de 50 µs la diferencia es ruido
+        empeora = cambio > umbral and datos["p50_ms"] - anterior["p50_ms"] > 0.05
+        if empeora:
+            regresiones.append(ruta)
+        print(f"  {ruta:<18} p50 {anterior['p50_ms']:>8.3f} -> {datos['p50_ms']:>8.3f} ms "
+              f"({cambio:+.0%}){'  ❌' if empeora else ''}")
+    cambio = actual["handlers_por_segundo"] / base["handlers_por_segundo"] - 1
+    print(f"  {'handlers/s':<18} {base['handlers_por_segundo']:>12.0f} -> {actual['handlers_por_segundo']:>8.0f} "
+          f"({cambio:+.0%})")
+    if cambio < -umbral:
+        regresiones.append("handlers/s")
+    return regresiones
+
+
+def bench_recorridos(*argumentos):
+    """Recorridos completos de cliente en proceso, con Bot y BD falsos"""
+    parser = argparse.ArgumentParser(prog="bench.py recorridos")
+    parser.add_argument("-n", "--recorridos", type=int, default=200)
+    parser.add_argument("--latencia", type=float, default=0.0, help="ms por llamada falsa a la API")
+    parser.add_argument("--guardar", metavar="FICHERO", help="guarda el resultado como línea base JSON")
+    parser.add_argument("--comparar", metavar="FICHERO", help="compara con una línea base JSON")
+    parser.add_argument("--umbral", type=float, default=0.25, help="empeoramiento tolerado (0.25 = 25%%)")
+    opciones = parser.parse_args(argumentos)
+    
+    main.init_db()
+    peticion = PeticionGrabadora(opciones.latencia / 1000)
+    despachador = Dispatcher(Bot("123456:BENCH", request=peticion), queue.Queue(), use_context=True)
+    with main.get_db() as conn:
+        primer_usuario = (conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM pedidos").fetchone()[0]) + 1
+    primer_usuario = max(primer_usuario, 200000)
+    
+    # Calentamiento: cachés, sentencias preparadas e imports perezosos
+    for i in range(5):
+        Recorrido(despachador, primer_usuario + i, None).completo()
+    primer_usuario += 5
+    
+    tiempos = defaultdict(list)
+    llamadas_antes = sum(peticion.llamadas.values())
+    inicio = time.perf_counter()
+    for i in range(opciones.recorridos):
+        Recorrido(despachador, primer_usuario + i, tiempos).completo()
+    duracion = time.perf_counter() - inicio
+    primer_usuario += opciones.recorridos
+    llamadas_api = sum(peticion.llamadas.values()) - llamadas_antes
+    
+    # Memoria en una pasada aparte para no falsear las latencias
+    muestras_memoria = max(10, opciones.recorridos // 10)
+    tracemalloc.start()
+    base_memoria = tracemalloc.get_traced_memory()[0]
+    picos = []
+    for i in range(muestras_memoria):
+        tracemalloc.reset_peak()
+        antes = tracemalloc.get_traced_memory()[0]
+        Recorrido(despachador, primer_usuario + i, None).completo()
+        picos.append(tracemalloc.get_traced_memory()[1] - antes)
+    retenido = (tracemalloc.get_traced_memory()[0] - base_memoria) / muestras_memoria
+    tracemalloc.stop()
+    
+    with main.get_db() as conn:
+        valorados = conn.execute("SELECT COUNT(*) FROM pedidos WHERE user_id >= ? AND user_id < ? AND valoracion = 5",
+                                 (primer_usuario - opciones.recorridos, primer_usuario)).fetchone()[0]
+    
+    total_handlers = sum(len(muestras) for muestras in tiempos.values())
+    tiempo_handlers = sum(sum(muestras) for muestras in tiempos.values())
+    resultado = {
+        "fecha": datetime.now().isoformat(),
+        "commit": _commit_actual(),
+        "recorridos": opciones.recorridos,
+        "latencia_api_ms": opciones.latencia,
+        "handlers_por_segundo": total_handlers / tiempo_handlers,
+        "recorridos_por_segundo": opciones.recorridos / duracion,
+        "llamadas_api_por_recorrido": llamadas_api / opciones.recorridos,
+        "memoria": {"pico_medio_bytes": sum(picos) / len(picos), "retenido_bytes": retenido},
+        "rutas": {},
+    }
+    print(f"{'ruta':<18} {'n':>6} {'p50 ms':>8} {'p99 ms':>8} {'máx ms':>8}")
+    for ruta, muestras in sorted(tiempos.items(), key=lambda item: -sum(item[1])):
+        muestras.sort()
+        datos = {"n": len(muestras), "p50_ms": _percentil(muestras, 50) * 1000,
+                 "p99_ms": _percentil(muestras, 99) * 1000, "max_ms": muestras[-1] * 1000}
+        resultado["rutas"][ruta] = datos
+        print(f"{ruta:<18} {datos['n']:>6} {datos['p50_ms']:>8.3f} {datos['p99_ms']:>8.3f} {datos['max_ms']:>8.3f}")
+    print(f"\nRecorridos: {opciones.recorridos} en {duracion:.2f}s ({resultado['recorridos_por_segundo']:.1f}/s) • "
+          f"handlers/s: {resultado['handlers_por_segundo']:.0f} • llamadas API por recorrido: "
+          f"{resultado['llamadas_api_por_recorrido']:.1f}")
+    print(f"Memoria por recorrido: pico {resultado['memoria']['pico_medio_bytes'] / 1024:.1f} KB • "
+          f"retenida {retenido / 1024:.1f} KB")
+    print(f"Pedidos valorados: {valorados}/{opciones.recorridos}")
+    ok = valorados == opciones.recorridos
+    
+    if opciones.comparar:
+        with open(opciones.comparar, encoding="utf-8") as f:
+            regresiones = _comparar(resultado, json.load(f), opciones.umbral)
+        if regresiones:
+            print(f"❌ Regresiones: {', '.join(regresiones)}")
+            ok = False
+    if opciones.guardar:
+        with open(opciones.guardar, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"💾 Línea base guardada en {opciones.guardar}")
+    print("✅ OK" if ok else "❌ FALLO")
+    return ok
+
+
+# ============ BOT API FALSA (PRUEBA DE EXTREMO A EXTREMO) ============
+# Métodos en los que se inyectan latencia, errores y 429
+METODOS_CON_FALLOS = {"sendMessage", "editMessageText", "answerCallbackQuery"}
+TEXTO_PASOS = "Calle Principal 123, Piso 2A"
+# (tipo, dato): los {pedido} se rellenan con el número que confirma el bot
+PASOS_CLIENTE = [
+    ("comando", "/start"),
+    ("boton", "menu_principal"),
+    ("boton", "cat_pizzas"),
+    ("boton", "info_pizzas_margarita"),
+    ("boton", "add_pizzas_margarita_1"),
+    ("boton", "ver_carrito"),
+    ("boton", "pedir_direccion"),
+    ("texto", TEXTO_PASOS),
+    ("boton", "hora_21:00"),
+    ("entrega", None),  # espera a que un admin lo marque como entregado
+    ("boton", "valorar_pedido_{pedido}"),
+    ("boton", "puntuar_{pedido}_5"),
+]
+SEGUNDOS_SIN_RESPUESTA = 10  # un clic sin respuesta en este tiempo se repite...
+REINTENTOS_CLIC = 2           # ...y tras estos reintentos el cliente se da por perdido
+
+
+class Planificador:
+    """Acciones diferidas de los clientes simulados en un único hilo"""
+
+    def __init__(self):
+        self._cola = []
+        self._secuencia = itertools.count()
+        self._cond = threading.Condition()
+        self._parar = False
+
+    def programar(self, retraso, funcion, *args):
+        with self._cond:
+            heapq.heappush(self._cola, (time.monotonic() + retraso, next(self._secuencia), funcion, args))
+            self._cond.notify()
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while not self._parar and (not self._cola or self._cola[0][0] > time.monotonic()):
+                    self._cond.wait(self._cola[0][0] - time.monotonic() if self._cola else None)
+                if self._parar:
+                    return
+                _, _, funcion, args = heapq.heappop(self._cola)
+            funcion(*args)
+
+    def iniciar(self):
+        threading.Thread(target=self._bucle, name="planificador", daemon=True).start()
+
+    def detener(self):
+        with self._cond:
+            self._parar = True
+            self._cond.notify()
+
+
+class ClienteSimulado:
+    __slots__ = ('user_id', 'paso', 'ruta', 'enviado', 'intentos', 'pedido_id', 'estado', 'entregado')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.paso = 0
+        self.ruta = None
+        self.enviado = 0.0
+        self.intentos = 0
+        self.pedido_id = None
+        self.estado = "nuevo"  # esperando, entrega, terminado, perdido
+        self.entregado = None  # monotonic del aviso de entrega, si llega antes de esperarlo
+
+
+class Comanda:
+    """Un pedido en el grupo y el clic de admin que espera respuesta"""
+    __slots__ = ('pedido_id', 'ruta', 'enviado', 'intentos', 'texto')
+
+    def __init__(self, pedido_id, texto):
+        self.pedido_id = pedido_id
+        self.ruta = "camino_"
+        self.enviado = None  # monotonic del clic pendiente
+        self.intentos = 0
+        self.texto = texto
+
+
+class ApiTelegramFalsa:
+    """Bot API en memoria: getUpdates con long polling y respuestas a los envíos.
+
+    Los clientes simulados reaccionan a lo que el bot les envía o edita; los
+    admins pulsan EN CAMINO y ENTREGADO en cada comanda que llega al grupo.
+    """
+
+    def __init__(self, id_grupo, admins, latencia=0.0, errores=0.0, retry_after=0.0, pensar=0.3):
+        self.id_grupo = int(id_grupo)
+        self.admins = admins
+        self.latencia = latencia
+        self.errores = errores
+        self.retry_after = retry_after
+        self.pensar = pensar
+        self.planificador = Planificador()
+        self._updates = deque()
+        self._ids_update = itertools.count(1)
+        self._ids_mensaje = itertools.count(1)
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self.llamadas = Counter()
+        self.fallos = Counter()
+        self.latencias = defaultdict(list)  # ruta -> segundos del clic a la respuesta
+        self.clientes = {}
+        self.notificaciones = Counter()  # pedido_id -> comandas recibidas en el grupo
+        self.comandas = {}               # message_id en el grupo -> Comanda
+        self.reintentos = 0
+        self.confirmados = set()
+        self.parado = False
+
+    # ---- updates que "envía Telegram" ----
+    def _encolar(self, update):
+        with self._cond:
+            update["update_id"] = next(self._ids_update)
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def _get_updates(self, datos):
+        offset = int(datos.get("offset") or 0)  # PTB envía los números como texto
+        fin = time.monotonic() + float(datos.get("timeout") or 0)
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()  # confirmados por el offset
+            while not self._updates and not self.parado and fin > time.monotonic():
+                self._cond.wait(fin - time.monotonic())
+            return list(itertools.islice(self._updates, int(datos.get("limit") or 100)))
+
+    def _boton(self, user_id, chat_id, message_id, texto, data):
+        usuario = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}", "username": f"cliente{user_id}"}
+        chat = {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}
+        self._encolar({"callback_query": {
+            "id": f"{user_id}-{time.monotonic_ns()}", "from": usuario, "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": chat, "text": texto},
+        }})
+
+    def _mensaje(self, user_id, texto):
+        usuario = {"id": user_id, "is_bot": False, "first_name": f"Cliente {user_id}", "username": f"cliente{user_id}"}
+        mensaje = {"message_id": next(self._ids_mensaje), "date": int(time.time()), "from": usuario,
+                   "chat": {"id": user_id, "type": "private"}, "text": texto}
+        if texto.startswith("/"):
+            mensaje["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        self._encolar({"message": mensaje})
+
+    # ---- clientes simulados ----
+    def nuevo_cliente(self, user_id):
+        cliente = self.clientes[user_id] = ClienteSimulado(user_id)
+        self._siguiente_paso(cliente)
+
+    def _siguiente_paso(self, cliente):
+        if cliente.paso >= len(PASOS_CLIENTE):
+            cliente.estado = "terminado"
+            return
+        tipo, dato = PASOS_CLIENTE[cliente.paso]
+        if tipo == "entrega":
+            with self._lock:
+                if cliente.entregado is None:
+                    cliente.estado = "entrega"
+                    cliente.enviado = time.monotonic()
+                    return
+                self.latencias["(confirmado → entregado)"].append(cliente.entregado - cliente.enviado)
+            self._avanzar(cliente)
+            return
+
+        dato = dato.format(pedido=cliente.pedido_id)
+        cliente.estado = "esperando"
+        cliente.enviado = time.monotonic()
+        if tipo == "boton":
+            cliente.ruta = main.resolver_callback(dato)[0]
+            self._boton(cliente.user_id, cliente.user_id, 1, "Knock Twice", dato)
+        else:
+            cliente.ruta = dato if tipo == "comando" else "mensaje"
+            self._mensaje(cliente.user_id, dato)
+        self.planificador.programar(SEGUNDOS_SIN_RESPUESTA, self._vigilar, cliente, cliente.enviado)
+
+    def _vigilar(self, cliente, enviado):
+        """Sin respuesta al clic: se repite, como haría una persona"""
+        with self._lock:
+            if cliente.estado != "esperando" or cliente.enviado != enviado:
+                return
+            if cliente.intentos >= REINTENTOS_CLIC:
+                cliente.estado = "perdido"
+                return
+            cliente.intentos += 1
+            self.reintentos += 1
+        self._siguiente_paso(cliente)
+
+    def _avanzar(self, cliente):
+        cliente.paso += 1
+        cliente.intentos = 0
+        self.planificador.programar(random.expovariate(1 / self.pensar) if self.pensar else 0,
+                                    self._siguiente_paso, cliente)
+
+    def _al_cliente(self, chat_id, texto):
+        """Algo enviado o editado en el chat de un cliente"""
+        ahora = time.monotonic()
+        with self._lock:
+            cliente = self.clientes.get(chat_id)
+            if cliente is None:
+                return
+            if cliente.estado == "esperando":
+                self.latencias[cliente.ruta].append(ahora - cliente.enviado)
+                if cliente.ruta == "hora_":
+                    confirmado = re.search(r"PEDIDO #(\d+) CONFIRMADO", texto)
+                    if not confirmado:
+                        cliente.estado = "perdido"
+                        return
+                    cliente.pedido_id = int(confirmado.group(1))
+                    self.confirmados.add(cliente.pedido_id)
+            elif "ENTREGADO" in texto:
+                if cliente.estado != "entrega":
+                    cliente.entregado = ahora  # el admin fue más rápido que el cliente
+                    return
+                self.latencias["(confirmado → entregado)"].append(ahora - cliente.enviado)
+            else:
+                return
+            cliente.estado = "avanzando"
+        self._avanzar(cliente)
+
+    def _al_grupo(self, message_id, texto, editado):
+        """Comanda nueva en el grupo o respuesta a un clic de admin"""
+        ahora = time.monotonic()
+        with self._lock:
+            if not editado:
+                nuevo = re.search(r"NUEVO PEDIDO #(\d+)", texto)
+                if not nuevo:
+                    return
+                pedido_id = int(nuevo.group(1))
+                self.notificaciones[pedido_id] += 1
+                self.comandas[message_id] = Comanda(pedido_id, texto)
+            else:
+                comanda = self.comandas.get(message_id)
+                if comanda is None or comanda.enviado is None:
+                    return
+                self.latencias[comanda.ruta].append(ahora - comanda.enviado)
+                comanda.enviado = None
+                if comanda.ruta == "entregado_":
+                    return
+                comanda.ruta, comanda.texto, comanda.intentos = "entregado_", texto, 0
+        self.planificador.programar(random.expovariate(1 / self.pensar) if self.pensar else 0,
+                                    self._clic_admin, message_id)
+
+    def _clic_admin(self, message_id):
+        with self._lock:
+            comanda = self.comandas[message_id]
+            comanda.enviado = enviado = time.monotonic()
+        admin = self.admins[comanda.pedido_id % len(self.admins)]
+        self._boton(admin, self.id_grupo, message_id, comanda.texto, f"{comanda.ruta}{comanda.pedido_id}")
+        self.planificador.programar(SEGUNDOS_SIN_RESPUESTA, self._vigilar_admin, message_id, enviado)
+
+    def _vigilar_admin(self, message_id, enviado):
+        with self._lock:
+            comanda = self.comandas[message_id]
+            if comanda.enviado != enviado or comanda.intentos >= REINTENTOS_CLIC:
+                return
+            comanda.intentos += 1
+            self.reintentos += 1
+        self._clic_admin(message_id)
+
+    # ---- la API ----
+    def _mensaje_enviado(self, chat_id, texto, message_id=None):
+        return {"message_id": message_id or next(self._ids_mensaje), "date": int(time.time()), "text": texto,
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}}
+
+    def llamar(self, metodo, datos):
+        """Devuelve (estado HTTP, respuesta JSON) de un método de la Bot API"""
+        with self._lock:
+            self.llamadas[metodo] += 1
+        if metodo == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(datos)}
+        if metodo == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Knock Twice",
+                                                "username": "knocktwice_bench_bot"}}
+
+        if metodo in METODOS_CON_FALLOS:
+            if self.latencia:
+                time.sleep(random.uniform(0.5, 1.5) * self.latencia)
+            azar = random.random()
+            if azar < self.retry_after:
+                with self._lock:
+                    self.fallos["429"] += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            if azar < self.retry_after + self.errores:
+                with self._lock:
+                    self.fallos["500"] += 1
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        if metodo in ("sendMessage", "editMessageText"):
+            chat_id, texto = int(datos["chat_id"]), datos["text"]
+            resultado = self._mensaje_enviado(chat_id, texto, int(datos.get("message_id") or 0))
+            if chat_id == self.id_grupo:
+                self._al_grupo(resultado["message_id"], texto, metodo == "editMessageText")
+            else:
+                self._al_cliente(chat_id, texto)
+            return 200, {"ok": True, "result": resultado}
+        return 200, {"ok": True, "result": True}  # answerCallbackQuery, deleteWebhook...
+
+    def detener(self):
+        self.planificador.detener()
+        with self._cond:
+            self.parado = True
+            self._cond.notify_all()
+
+
+class ManejadorApiFalsa(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # cabeceras y cuerpo van en dos send(): sin esto, 40 ms de ACK retardado
+
+    def do_POST(self):
+        metodo = self.path.rsplit("/", 1)[-1]
+        cuerpo = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        datos = json.loads(cuerpo) if cuerpo else {}
+        estado, respuesta = self.server.api.llamar(metodo, datos)
+        salida = json.dumps(respuesta).encode()
+        self.send_response(estado)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(salida)))
+        self.end_headers()
+        self.wfile.write(salida)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ServidorApiFalso(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _puerto_libre():
+    with contextlib.closing(socket.socket()) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_e2e(*argumentos):
+    """El bot real (python main.py) en polling contra la Bot API falsa"""
+    parser = argparse.ArgumentParser(prog="bench.py e2e")
+    parser.add_argument("-c", "--clientes", type=int, default=1000)
+    parser.add_argument("--rampa", type=float, default=10.0, help="segundos en los que van llegando los clientes")
+    parser.add_argument("--pensar", type=float, default=0.3, help="segundos medios entre clics de un cliente")
+    parser.add_argument("--latencia", type=float, default=20.0, help="ms de latencia de la API falsa")
+    parser.add_argument("--errores", type=float, default=0.0, help="fracción de envíos que fallan con 500")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="fracción de envíos que reciben un 429")
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--hilos", type=int, default=main.HILOS_HANDLERS, help="BOT_HILOS del bot")
+    parser.add_argument("--limites", action="store_true", help="mantener los límites de envío de Telegram")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    opciones = parser.parse_args(argumentos)
+
+    directorio = tempfile.mkdtemp(prefix="knocktwice_e2e_")
+    admins = [900000 + i for i in range(max(1, opciones.admins))]
+    api = ApiTelegramFalsa(main.ID_GRUPO_PEDIDOS, admins, opciones.latencia / 1000, opciones.errores,
+                           opciones.retry_after, opciones.pensar)
+    servidor = ServidorApiFalso(("127.0.0.1", 0), ManejadorApiFalsa)
+    servidor.api = api
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    puerto_web = _puerto_libre()
+
+    entorno = dict(os.environ,
+                   TELEGRAM_TOKEN="123456:E2E", TELEGRAM_API_URL=f"http://127.0.0.1:{servidor.server_address[1]}",
+                   DB_PATH=os.path.join(directorio, "e2e.db"), PORT=str(puerto_web),
+                   URL_PROYECTO=f"http://127.0.0.1:{puerto_web}", ADMIN_IDS=",".join(map(str, admins)),
+                   MODO_BOT="polling", BOT_HILOS=str(opciones.hilos), LOG_NIVEL="WARNING")
+    if not opciones.limites:
+        # La API falsa no limita: se prueba el bot, no los límites de Telegram
+        entorno.update(LIMITE_GLOBAL_POR_SEGUNDO="100000", LIMITE_GRUPO_POR_MINUTO="6000000",
+                       LIMITE_CHAT_POR_SEGUNDO="1000")
+    ruta_log = os.path.join(directorio, "bot.log")
+    with open(ruta_log, "wb") as log:
+        bot = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")],
+                               env=entorno, stdout=log, stderr=subprocess.STDOUT)
+
+    try:
+        limite = time.monotonic() + 30
+        while not api.llamadas["getUpdates"]:
+            if bot.poll() is not None or time.monotonic() > limite:
+                print(f"❌ El bot no ha arrancado (log: {ruta_log})")
+                return False
+            time.sleep(0.1)
+
+        api.planificador.iniciar()
+        inicio = time.monotonic()
+        primer_cliente = 100000
+        for i in range(opciones.clientes):
+            api.planificador.programar(opciones.rampa * i / opciones.clientes, api.nuevo_cliente, primer_cliente + i)
+
+        fin = inicio + opciones.timeout
+        while time.monotonic() < fin:
+            with api._lock:
+                estados = Counter(cliente.estado for cliente in api.clientes.values())
+            if len(api.clientes) == opciones.clientes and estados["terminado"] + estados["perdido"] == opciones.clientes:
+                break
+            time.sleep(0.2)
+        duracion = time.monotonic() - inicio
+        time.sleep(1)  # comandas que aún estén saliendo de la cola
+    finally:
+        api.detener()
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        servidor.shutdown()
+
+    with contextlib.closing(sqlite3.connect(entorno["DB_PATH"])) as conn:
+        pedidos = {fila[0] for fila in conn.execute("SELECT id FROM pedidos")}
+    sin_comanda = sorted(p for p in pedidos if api.notificaciones[p] == 0)
+    repetidas = sorted(p for p, veces in api.notificaciones.items() if veces > 1)
+    desconocidas = sorted(p for p in api.notificaciones if p not in pedidos)
+
+    print(f"{'ruta':<26} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8}")
+    for ruta, muestras in sorted(api.latencias.items(), key=lambda item: -len(item[1])):
+        muestras.sort()
+        print(f"{ruta:<26} {len(muestras):>6} {_percentil(muestras, 50) * 1000:>8.1f} "
+              f"{_percentil(muestras, 95) * 1000:>8.1f} {_percentil(muestras, 99) * 1000:>8.1f} "
+              f"{muestras[-1] * 1000:>8.1f}")
+    total_clics = sum(len(m) for ruta, m in api.latencias.items() if not ruta.startswith("("))
+    print(f"\nClientes: {estados['terminado']} terminados, {estados['perdido']} perdidos, "
+          f"{opciones.clientes - estados['terminado'] - estados['perdido']} sin acabar • {duracion:.1f}s "
+          f"({total_clics / duracion:.0f} clics/s)")
+    print(f"Llamadas a la API: {dict(api.llamadas)} • fallos inyectados: {dict(api.fallos) or 'ninguno'} • "
+          f"clics repetidos: {api.reintentos}")
+    print(f"Pedidos en BD: {len(pedidos)} • confirmados a clientes: {len(api.confirmados)} • "
+          f"comandas en el grupo: {sum(api.notificaciones.values())}")
+    print(f"Pedidos sin comanda: {len(sin_comanda)} • comandas repetidas: {len(repetidas)} • "
+          f"comandas de pedidos inexistentes: {len(desconocidas)}")
+
+    ok = not sin_comanda and not repetidas and not desconocidas and api.confirmados <= pedidos
+    if not (opciones.errores or opciones.retry_after):
+        ok = ok and estados["terminado"] == opciones.clientes
+    print("✅ OK" if ok else f"❌ FALLO (log del bot: {ruta_log})")
+    return ok
+
+
+# ============ CARTA RECARGABLE ============
+def _escribir_carta(ruta, datos):
+    """Escribe la carta de golpe, como lo haría un despliegue (nunca a medias)"""
+    temporal = ruta + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+def bench_catalogo(fichero=None):
+    """Valida la carta, recarga una copia modificada y comprueba el cambio de versión"""
+    fichero = fichero or main.CATALOGO_PATH
+    if not fichero:
+        sys.exit("CATALOGO_PATH vacío: indica la carta a comprobar")
+    original = main.leer_catalogo(fichero)
+    print(f"{fichero}: versión {original.version} • {len(original.productos)} productos • "
+          f"{len(original.agotados)} agotados • {len(original.faq)} FAQ")
+    with open(fichero, encoding="utf-8") as f:
+        datos = json.load(f)
+
+    ruta = os.path.join(tempfile.mkdtemp(prefix="knocktwice_carta_"), "catalogo.json")
+    shutil.copyfile(fichero, ruta)
+    ruta_anterior, main.CATALOGO_PATH = main.CATALOGO_PATH, ruta
+    comprobaciones = []
+    try:
+        main.recargar_catalogo(forzar=True)
+        anterior = main.CATALOGO
+        (categoria, producto_id), producto = next(iter(anterior.productos.items()))
+        precio = producto["precio"]
+
+        # Nueva versión: sube un precio y agota el mismo producto
+        modificado = json.loads(json.dumps(datos))
+        ficha = modificado["menu"][categoria]["productos"][producto_id]
+        ficha["precio"] = precio + 1
+        ficha["disponible"] = False
+        modificado["version"] = f"{anterior.version}-bench"
+        _escribir_carta(ruta, modificado)
+        nuevo = main.recargar_catalogo()
+        comprobaciones += [
+            ("la recarga sustituye el catálogo", nuevo is not None and main.CATALOGO is nuevo and nuevo is not anterior),
+            ("precio nuevo en el índice", main.CATALOGO.producto(categoria, producto_id)["precio"] == precio + 1),
+            ("producto agotado", (categoria, producto_id) in main.CATALOGO.agotados),
+            ("ficha sin botones de cantidad",
+             len(main.pantalla("info", categoria, producto_id)[1].inline_keyboard) == 1),
+            ("la versión anterior no cambia", anterior.producto(categoria, producto_id)["precio"] == precio
+             and len(anterior.pantallas["info", categoria, producto_id][1].inline_keyboard) > 1),
+        ]
+
+        # Misma versión guardada otra vez: no se sustituye
+        time.sleep(0.01)
+        _escribir_carta(ruta, modificado)
+        comprobaciones.append(("misma versión: sin cambio", main.recargar_catalogo() is None and main.CATALOGO is nuevo))
+
+        # Fichero roto: error una vez y sigue la versión en uso
+        with open(ruta, "w", encoding="utf-8") as f:
+            f.write('{"menu": ')
+        try:
+            main.recargar_catalogo()
+            fallo = False
+        except main.ErrorCatalogo:
+            fallo = True
+        comprobaciones.append(("fichero roto: error y se queda la versión en uso", fallo and main.CATALOGO is nuevo))
+        comprobaciones.append(("fichero roto: no se repite el error", main.recargar_catalogo() is None))
+
+        _escribir_carta(ruta, datos)
+        veces = 50
+        inicio = time.perf_counter()
+        for _ in range(veces):
+            main.recargar_catalogo(forzar=True)
+        print(f"Carga completa (leer, validar, índices y pantallas): "
+              f"{(time.perf_counter() - inicio) / veces * 1000:.2f} ms")
+    finally:
+        main.CATALOGO_PATH = ruta_anterior
+
+    for descripcion, correcta in comprobaciones:
+        print(f"{'✓' if correcta else '✗'} {descripcion}")
+    ok = all(correcta for _, correcta in comprobaciones)
+    print("✅ OK" if ok else "❌ FALLO")
+    return ok
+
+
+# ============ PERFILADO CONCURRENTE ============
+class _PerfilOcupado:
+    """cProfile.Profile cuando otra herramienta ya usa sys.monitoring (Python 3.12+)"""
+
+    def enable(self):
+        raise ValueError("Another profiling tool is already active")
+
+    def disable(self):
+        pass
+
+
+def bench_perfil(hilos=8, rondas=20):
+    """Handlers perfilados desde varios hilos a la vez, como en el EJECUTOR"""
+    hilos, rondas = int(hilos), int(rondas)
+    perfilador = main.Perfilador()
+    barrera = threading.Barrier(hilos)
+    completados = Counter()
+
+    def handler(indice):
+        sum(i * i for i in range(2000))
+        time.sleep(0.001)
+        completados[indice] += 1  # cada índice lo incrementa un solo hilo
+
+    def trabajador(indice):
+        for _ in range(rondas):
+            barrera.wait()  # todos entran en ejecutar() a la vez
+            perfilador.ejecutar("bench", handler, indice)
+
+    comprobaciones = []
+    perfilador.iniciar(segundos=600)
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        list(pool.map(trabajador, range(hilos)))
+    perfiladas = perfilador.updates
+    informe = perfilador.detener()
+    comprobaciones += [
+        ("todos los handlers concurrentes terminan", sum(completados.values()) == hilos * rondas),
+        ("se perfila al menos uno por ronda", perfiladas >= rondas),
+        ("hay informe", bool(informe)),
+    ]
+
+    # enable() falla: el handler se ejecuta igual y el hilo puede volver a perfilar
+    perfilador.iniciar(segundos=600)
+    original = main.cProfile.Profile
+    main.cProfile.Profile = _PerfilOcupado
+    try:
+        antes = sum(completados.values())
+        perfilador.ejecutar("bench", handler, 0)
+        comprobaciones.append(("enable() ocupado: el handler se ejecuta", sum(completados.values()) == antes + 1))
+    finally:
+        main.cProfile.Profile = original
+    perfilador.ejecutar("bench", handler, 0)
+    comprobaciones.append(("y el siguiente update se perfila", perfilador.updates == 1))
+    perfilador.detener()
+
+    print(f"{hilos} hilos x {rondas} rondas: {sum(completados.values())} handlers, {perfiladas} perfilados")
+    for descripcion, correcta in comprobaciones:
+        print(f"{'✓' if correcta else '✗'} {descripcion}")
+    ok = all(correcta for _, correcta in comprobaciones)
+    print("✅ OK" if ok else "❌ FALLO")
+    return ok
+
+
+BENCHMARKS = {
+    "render": bench_render,
+    "estres": bench_estres,
+    "webhook": bench_webhook,
+    "recorridos": bench_recorridos,
+    "e2e": bench_e2e,
+    "catalogo": bench_catalogo,
+    "perfil": bench_perfil,
+}
+
+if __name__ == "__main__":
+    nombre = sys.argv[1] if len(sys.argv) > 1 else "render"
+    if nombre not in BENCHMARKS:
+        sys.exit(f"Benchmark desconocido: {nombre}. Opciones: {', '.join(BENCHMARKS)}")
+    if BENCHMARKS[nombre](*sys.argv[2:]) is False:
+        sys.exit(1)
@@ -1,30 +1,155 @@
+import atexit
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import logging
+import math
+import mimetypes
 import os
+import pstats
+import queue
+import random
+import re
 import sqlite3
+import sys
 import threading
 import time
+import weakref
+import zlib
 import requests
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import parse_qs, urlsplit
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, Unauthorized
+from telegram.ext import (Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext,
+                          BasePersistence, ExtBot)
+from telegram.utils.helpers import escape_markdown
+from telegram.utils.request import Request
+
+# ============ REGISTRO (LOGS) ============
+# Quien registra sólo mete el LogRecord en una cola; el hilo del listener
+# formatea el mensaje (una línea JSON por evento) y escribe en stdout.
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+LOG_FORMATO = os.environ.get("LOG_FORMATO", "json")  # "json" o "texto"
+LOG_MUESTREO = max(1, int(os.environ.get("LOG_MUESTREO", 20)))  # 1 de cada N eventos de debug frecuentes
+
+LOG = logging.getLogger("knocktwice")
+
+class FormatoJSON(logging.Formatter):
+    """{"ts", "nivel", "logger", "mensaje", ...campos} en una línea"""
+
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        campos = getattr(record, 'campos', None)
+        if campos:
+            datos.update(campos)
+        if record.exc_info:
+            datos["traza"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+class FormatoTexto(logging.Formatter):
+    """Formato legible para desarrollo: hora, nivel, mensaje y clave=valor"""
+
+    def format(self, record):
+        texto = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} {record.getMessage()}"
+        campos = getattr(record, 'campos', None)
+        if campos:
+            texto += " " + " ".join(f"{clave}={valor}" for clave, valor in campos.items())
+        if record.exc_info:
+            texto += "\n" + self.formatException(record.exc_info)
+        return texto
+
+class ColaLogs(QueueHandler):
+    """QueueHandler que no formatea en el hilo que registra (lo hace el listener)"""
+
+    def prepare(self, record):
+        return record
+
+def iniciar_logs():
+    """Envía todos los logs (también los de python-telegram-bot) a la cola"""
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON() if LOG_FORMATO == "json" else FormatoTexto())
+    cola = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [ColaLogs(cola)]
+    raiz.setLevel(logging.WARNING)
+    LOG.setLevel(LOG_NIVEL)
+    oyente = QueueListener(cola, salida)
+    oyente.start()
+    atexit.register(oyente.stop)  # vacía la cola al salir
+    return oyente
+
+OYENTE_LOGS = iniciar_logs()
+
+def _log(nivel, mensaje, args, campos, exc_info=False):
+    if LOG.isEnabledFor(nivel):
+        LOG.log(nivel, mensaje, *args, exc_info=exc_info, extra={'campos': campos} if campos else None)
+
+def log_debug(mensaje, *args, **campos):
+    _log(logging.DEBUG, mensaje, args, campos)
+
+def log_info(mensaje, *args, **campos):
+    _log(logging.INFO, mensaje, args, campos)
+
+def log_aviso(mensaje, *args, **campos):
+    _log(logging.WARNING, mensaje, args, campos)
+
+def log_error(mensaje, *args, exc_info=False, **campos):
+    _log(logging.ERROR, mensaje, args, campos, exc_info)
+
+_MUESTRAS_LOG = defaultdict(itertools.count)
+
+def log_muestreado(evento, mensaje, *args, **campos):
+    """Evento de debug muy frecuente (clics...): sólo se registra 1 de cada LOG_MUESTREO"""
+    if LOG.isEnabledFor(logging.DEBUG) and next(_MUESTRAS_LOG[evento]) % LOG_MUESTREO == 0:
+        campos['evento'] = evento
+        campos['muestreo'] = LOG_MUESTREO
+        LOG.debug(mensaje, *args, extra={'campos': campos})
 
 # ============ CONFIGURACIÓN ============
-print("="*50)
-print("🤖 INICIANDO BOT KNOCK TWICE...")
-print("="*50)
+log_info("🤖 INICIANDO BOT KNOCK TWICE...")
 
 ID_GRUPO_PEDIDOS = "-5151917747"
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
 MODO_PRUEBAS = False  # MODE DEBUG ACTIVADO
-URL_PROYECTO = "https://pizzeria-bot-l4y4.onrender.com"
+URL_PROYECTO = os.environ.get("URL_PROYECTO", "https://pizzeria-bot-l4y4.onrender.com")
+# Servidor de la Bot API (otro distinto sólo para pruebas de carga: bench.py e2e)
+URL_API_TELEGRAM = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 NOMBRE_BOT_ALIAS = "pizzaioloo_bot"
 
-print(f"🔧 TOKEN: {'✅' if TOKEN else '❌ ERROR: No hay token'}")
-print(f"🔧 MODO_PRUEBAS: {MODO_PRUEBAS}")
+log_info("🔧 TOKEN: %s", '✅' if TOKEN else '❌ ERROR: No hay token')
+log_info("🔧 MODO_PRUEBAS: %s", MODO_PRUEBAS)
+
+# Recepción de updates: "webhook" (POST al servidor web) o "polling"
+MODO_BOT = os.environ.get("MODO_BOT", "polling")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+RUTA_WEBHOOK = "/telegram"
+log_info("🔧 MODO_BOT: %s", MODO_BOT)
+if URL_API_TELEGRAM != "https://api.telegram.org":
+    log_aviso("🔧 Bot API en %s", URL_API_TELEGRAM)
 
 admin_ids_str = os.environ.get("ADMIN_IDS", "")
 ADMIN_IDS = [int(id.strip()) for id in admin_ids_str.split(",") if id.strip().isdigit()] if admin_ids_str else [123456789]
-print(f"🔧 ADMINS: {ADMIN_IDS}")
+log_info("🔧 ADMINS: %s", ADMIN_IDS)
 
 # ============ WEB LANDING PAGE ============
 HTML_WEB = f"""
@@ -48,58 +173,770 @@ HTML_WEB = f"""
 </html>
 """
 
+# ============ MÉTRICAS ============
+# Registro propio en formato de texto de Prometheus, servido en /metrics.
+# Cada hilo escribe en su propia fila de contadores, así que registrar una
+# muestra no toma ningún lock (sólo la primera vez en cada hilo).
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICAS = []  # familias en orden de exposición
+
+def _podar_hilos_muertos(filas):
+    """Suma en la fila None las de hilos que ya no existen y las quita.
+
+    El servidor web crea un hilo por conexión: sin esto cada petición dejaría
+    una fila para siempre. Llamar con el lock de la métrica tomado.
+    """
+    vivos = {hilo.ident for hilo in threading.enumerate()}
+    for ident in [ident for ident in filas if ident is not None and ident not in vivos]:
+        fila = filas.pop(ident)
+        retirados = filas.get(None)
+        if retirados is None:
+            filas[None] = list(fila)
+        else:
+            for i, valor in enumerate(fila):
+                retirados[i] += valor
+
+class Histograma:
+    """Histograma acumulado de segundos; fila por hilo: [cuenta por bucket..., +Inf, suma]"""
+    __slots__ = ('limites', '_filas', '_lock')
+
+    def __init__(self, limites=BUCKETS_SEGUNDOS):
+        self.limites = limites
+        self._filas = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, segundos):
+        fila = self._filas.get(threading.get_ident())
+        if fila is None:
+            fila = self._fila_nueva()
+        fila[bisect_left(self.limites, segundos)] += 1
+        fila[-1] += segundos
+
+    def _fila_nueva(self):
+        fila = [0] * (len(self.limites) + 1) + [0.0]
+        with self._lock:
+            self._filas[threading.get_ident()] = fila
+        return fila
+
+    def valores(self):
+        """(cuentas por bucket, suma) sumando las filas de todos los hilos"""
+        with self._lock:
+            _podar_hilos_muertos(self._filas)
+            filas = list(self._filas.values())
+        totales = [sum(columna) for columna in zip(*filas)] or [0] * (len(self.limites) + 2)
+        return totales[:-1], totales[-1]
+
+class Contador:
+    """Contador monótono; fila por hilo como en Histograma"""
+    __slots__ = ('_filas', '_lock')
+
+    def __init__(self):
+        self._filas = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, n=1):
+        fila = self._filas.get(threading.get_ident())
+        if fila is None:
+            fila = [0]
+            with self._lock:
+                self._filas[threading.get_ident()] = fila
+        fila[0] += n
+
+    def valor(self):
+        with self._lock:
+            _podar_hilos_muertos(self._filas)
+            return sum(fila[0] for fila in self._filas.values())
+
+def _etiquetas(texto):
+    return '{%s}' % texto if texto else ''
+
+def _escapar_etiqueta(valor):
+    return str(valor).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+class FamiliaMetricas:
+    """Métrica con una etiqueta opcional; .con(valor) devuelve la serie de ese valor"""
+
+    def __init__(self, nombre, ayuda, tipo, etiqueta=None, crear=None, funcion=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.tipo = tipo
+        self.etiqueta = etiqueta
+        self._crear = crear
+        self._funcion = funcion  # medidores: devuelve un número o {valor_etiqueta: número}
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICAS.append(self)
+
+    def con(self, valor=None):
+        serie = self._series.get(valor)
+        if serie is None:
+            with self._lock:
+                serie = self._series.setdefault(valor, self._crear())
+        return serie
+
+    # Atajos para las familias sin etiqueta
+    def registrar(self, segundos):
+        self.con().registrar(segundos)
+
+    def incrementar(self, n=1):
+        self.con().incrementar(n)
+
+    def _etiqueta(self, valor):
+        if self.etiqueta is None or valor is None:
+            return ''
+        return f'{self.etiqueta}="{_escapar_etiqueta(valor)}"'
+
+    def exponer(self, lineas):
+        lineas.append(f"# HELP {self.nombre} {self.ayuda}")
+        lineas.append(f"# TYPE {self.nombre} {self.tipo}")
+        if self._funcion is not None:
+            valores = self._funcion()
+            if not isinstance(valores, dict):
+                valores = {None: valores}
+            for valor, numero in valores.items():
+                lineas.append(f"{self.nombre}{_etiquetas(self._etiqueta(valor))} {numero}")
+            return
+
+        with self._lock:
+            series = list(self._series.items())
+        for valor, serie in sorted(series, key=lambda item: str(item[0])):
+            etiqueta = self._etiqueta(valor)
+            if self.tipo == 'histogram':
+                cuentas, suma = serie.valores()
+                acumulado = 0
+                separador = ',' if etiqueta else ''
+                for limite, cuenta in zip(serie.limites + ('+Inf',), cuentas):
+                    acumulado += cuenta
+                    lineas.append(f'{self.nombre}_bucket{{{etiqueta}{separador}le="{limite}"}} {acumulado}')
+                lineas.append(f"{self.nombre}_sum{_etiquetas(etiqueta)} {suma}")
+                lineas.append(f"{self.nombre}_count{_etiquetas(etiqueta)} {acumulado}")
+            else:
+                lineas.append(f"{self.nombre}{_etiquetas(etiqueta)} {serie.valor()}")
+
+def histograma(nombre, ayuda, etiqueta=None):
+    return FamiliaMetricas(nombre, ayuda, 'histogram', etiqueta, crear=Histograma)
+
+def contador(nombre, ayuda, etiqueta=None):
+    return FamiliaMetricas(nombre, ayuda, 'counter', etiqueta, crear=Contador)
+
+def medidor(nombre, ayuda, funcion, etiqueta=None, tipo='gauge'):
+    """Métrica calculada al exponer (profundidad de colas, percentiles...)"""
+    return FamiliaMetricas(nombre, ayuda, tipo, etiqueta, funcion=funcion)
+
+def exponer_metricas():
+    """Texto de /metrics"""
+    lineas = []
+    for familia in METRICAS:
+        try:
+            familia.exponer(lineas)
+        except Exception as e:
+            log_error("❌ Error exponiendo %s: %s", familia.nombre, e, metrica=familia.nombre)
+    return ("\n".join(lineas) + "\n").encode("utf-8")
+
+LATENCIA_CALLBACKS = histograma("knocktwice_callback_segundos", "Duración de los handlers de botones por ruta", "ruta")
+LATENCIA_COMANDOS = histograma("knocktwice_comando_segundos", "Duración de los handlers de comandos y mensajes", "comando")
+LATENCIA_SQL = histograma("knocktwice_sql_segundos", "Duración de las sentencias SQL por tipo", "sentencia")
+LATENCIA_API = histograma("knocktwice_telegram_api_segundos", "Duración de las llamadas a la API de Telegram", "metodo")
+PEDIDOS_CREADOS = contador("knocktwice_pedidos_creados_total", "Pedidos confirmados")
+PEDIDOS_ENTREGADOS = contador("knocktwice_pedidos_entregados_total", "Pedidos marcados como entregados")
+RECHAZOS_COOLDOWN = contador("knocktwice_cooldown_rechazos_total", "Intentos de pedido rechazados por el cooldown")
+ENVIOS_FALLIDOS = contador("knocktwice_envios_fallidos_total", "Errores de send_message en la cola de salida", "motivo")
+
+def medir(familia, valor, handler):
+    """Envuelve un handler para registrar su duración en familia.con(valor)"""
+    serie = familia.con(valor)
+
+    @wraps(handler)
+    def envoltorio(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            if PERFILADOR.activo:
+                return PERFILADOR.ejecutar(valor, handler, *args, **kwargs)
+            return handler(*args, **kwargs)
+        finally:
+            serie.registrar(time.perf_counter() - inicio)
+    return envoltorio
+
+class PeticionMedida(Request):
+    """Request de python-telegram-bot que mide cada llamada a la API por método"""
+
+    def post(self, url, data, timeout=None):
+        inicio = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        finally:
+            duracion = time.perf_counter() - inicio
+            LATENCIA_API.con(url.rsplit('/', 1)[-1]).registrar(duracion)
+            if PERFILADOR.activo:
+                PERFILADOR.sumar('api', duracion)
+
+# ============ PERFILADO ============
+# Ventana de perfilado bajo demanda (/perfil o el panel admin). Fuera de la
+# ventana el único coste es comprobar PERFILADOR.activo.
+SEGUNDOS_PERFIL = 60
+UPDATES_LENTOS = 10
+MAX_UPDATES_PERFIL = 20000  # tope de updates perfilados por ventana
+
+class UpdateLento:
+    __slots__ = ('ruta', 'total', 'bd', 'api', 'pila')
+
+    def __init__(self, ruta, total, bd, api, pila):
+        self.ruta = ruta
+        self.total = total
+        self.bd = bd
+        self.api = api
+        self.pila = pila  # funciones con más tiempo propio dentro del update
+
+    @property
+    def python(self):
+        return max(0.0, self.total - self.bd - self.api)
+
+def _nombre_funcion(clave):
+    fichero, linea, funcion = clave
+    if fichero == '~':
+        return funcion  # función C: '<built-in method ...>'
+    return f"{os.path.basename(fichero)}:{linea} {funcion}"
+
+def _funciones_mas_costosas(estadisticas, n):
+    """[(tiempo propio, llamadas, nombre)] de las n funciones con más tiempo propio"""
+    filas = sorted(estadisticas.items(), key=lambda item: item[1][2], reverse=True)[:n]
+    return [(tt, nc, _nombre_funcion(clave)) for clave, (cc, nc, tt, ct, llamadores) in filas]
+
+class Perfilador:
+    """cProfile de cada update durante una ventana, con los N más lentos desglosados.
+
+    Se perfila un update cada vez, con su propio cProfile.Profile; los que
+    llegan mientras tanto se ejecutan sin perfilar. Desde Python 3.12 cProfile
+    usa sys.monitoring, que es de todo el proceso: un segundo enable() a la
+    vez falla y el perfil de un hilo recogería también los demás. Al terminar
+    se suma al perfil agregado y, si está entre los más lentos, se guarda con
+    su tiempo de BD, de API de Telegram y de Python.
+    """
+
+    def __init__(self):
+        self.activo = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._perfilando = threading.Lock()  # un único update perfilado a la vez
+        self._temporizador = None
+        self._reiniciar(0, None)
+        self.informe = None  # texto del último informe
+
+    def _reiniciar(self, segundos, aviso_chat):
+        self.segundos = segundos
+        self.aviso_chat = aviso_chat  # chat al que se envía el informe al acabar
+        self.inicio = time.monotonic()
+        self.updates = 0
+        self._lentos = []   # heap de (total, secuencia, UpdateLento)
+        self._agregado = None
+
+    def iniciar(self, segundos=SEGUNDOS_PERFIL, aviso_chat=None):
+        """Abre una ventana de perfilado; devuelve False si ya hay una abierta"""
+        with self._lock:
+            if self.activo:
+                return False
+            self._reiniciar(segundos, aviso_chat)
+            self._temporizador = threading.Timer(segundos, self._caducar)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+            self.activo = True
+        return True
+
+    def _caducar(self):
+        informe = self.detener()
+        if informe and self.aviso_chat is not None:
+            enviar_mensaje(self.aviso_chat, informe)
+
+    def detener(self):
+        """Cierra la ventana y devuelve el informe (None si no había ninguna abierta)"""
+        with self._lock:
+            if not self.activo:
+                return None
+            self.activo = False
+            if self._temporizador:
+                self._temporizador.cancel()
+            lentos = [lento for _, _, lento in sorted(self._lentos, reverse=True)]
+            agregado, self._agregado = self._agregado, None
+            self.informe = self._componer_informe(time.monotonic() - self.inicio, lentos, agregado)
+        log_info("🔬 Perfilado terminado: %s updates", self.updates, updates=self.updates)
+        return self.informe
+
+    def sumar(self, tipo, segundos):
+        """Suma tiempo de BD o de API al update que se está perfilando en este hilo"""
+        tiempos = getattr(self._local, 'tiempos', None)
+        if tiempos is not None:
+            tiempos[tipo] += segundos
+
+    def ejecutar(self, ruta, funcion, *args, **kwargs):
+        """Ejecuta un handler bajo cProfile y anota su desglose de tiempos"""
+        if self.updates >= MAX_UPDATES_PERFIL or not self._perfilando.acquire(blocking=False):
+            return funcion(*args, **kwargs)
+
+        local = self._local
+        perfil = cProfile.Profile()
+        try:
+            try:
+                perfil.enable()
+            except ValueError:
+                # Otra herramienta de perfilado activa (sys.monitoring en 3.12+)
+                return funcion(*args, **kwargs)
+            local.tiempos = {'bd': 0.0, 'api': 0.0}
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                perfil.disable()
+                total = time.perf_counter() - inicio
+                tiempos, local.tiempos = local.tiempos, None
+                self._anotar(ruta, total, tiempos, perfil)
+        finally:
+            self._perfilando.release()
+
+    def _anotar(self, ruta, total, tiempos, perfil):
+        perfil.create_stats()
+        with self._lock:
+            if not self.activo:
+                return
+            self.updates += 1
+            # Antes de sumarlo al agregado: pstats se queda con perfil.stats
+            if len(self._lentos) < UPDATES_LENTOS or total > self._lentos[0][0]:
+                pila = [nombre for _, _, nombre in _funciones_mas_costosas(perfil.stats, 3)]
+                lento = UpdateLento(ruta, total, tiempos['bd'], tiempos['api'], pila)
+                entrada = (total, self.updates, lento)
+                if len(self._lentos) < UPDATES_LENTOS:
+                    heapq.heappush(self._lentos, entrada)
+                else:
+                    heapq.heapreplace(self._lentos, entrada)
+
+            if self._agregado is None:
+                self._agregado = pstats.Stats(perfil)
+            else:
+                self._agregado.add(perfil)
+
+    def _componer_informe(self, duracion, lentos, agregado):
+        lineas = [f"🔬 PERFIL: {self.updates} updates en {duracion:.0f} s"]
+        if agregado is not None:
+            lineas.append("")
+            lineas.append("Funciones con más tiempo propio:")
+            for tt, nc, nombre in _funciones_mas_costosas(agregado.stats, 8):
+                lineas.append(f"  {tt * 1000:7.1f} ms {nc:>6}x {nombre}")
+        if lentos:
+            lineas.append("")
+            lineas.append(f"{len(lentos)} updates más lentos (BD / API / Python):")
+            for i, lento in enumerate(lentos, 1):
+                lineas.append(f"{i:>2}. {lento.ruta} {lento.total * 1000:.0f} ms = "
+                              f"{lento.bd * 1000:.0f} / {lento.api * 1000:.0f} / {lento.python * 1000:.0f} ms")
+                lineas.append(f"    {' • '.join(lento.pila)}")
+        return "\n".join(lineas)[:4000]  # límite de un mensaje de Telegram
+
+PERFILADOR = Perfilador()
+
 # ============ BASE DE DATOS ============
+DB_PATH = os.environ.get("DB_PATH", "knocktwice.db")
+# Pedidos entregados antiguos (ver ARCHIVO): otra BD adjunta a cada conexión como `archivo`
+DB_ARCHIVO_PATH = os.environ.get("DB_ARCHIVO_PATH", os.path.splitext(DB_PATH)[0] + "_archivo.db")
+
+# Pragmas aplicados a cada conexión nueva del pool
+PRAGMAS_DB = (
+    # Antes que WAL, que ya escribe la cabecera; en una BD existente no hace nada
+    "PRAGMA main.auto_vacuum=INCREMENTAL",
+    "PRAGMA archivo.auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",        # las lecturas del admin no bloquean los pedidos (también en el archivo)
+    "PRAGMA synchronous=NORMAL",      # seguro con WAL y con muchos menos fsync
+    "PRAGMA archivo.synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",       # ~16 MB de caché de páginas
+    "PRAGMA mmap_size=67108864",      # 64 MB leídos vía mmap
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+TIPOS_SENTENCIA = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "PRAGMA", "CREATE", "WITH"))
+_SERIES_SQL = {}  # texto SQL -> serie de LATENCIA_SQL (las sentencias son constantes)
+
+def _serie_sql(sql):
+    serie = _SERIES_SQL.get(sql)
+    if serie is None:
+        palabra = sql.lstrip()[:6].upper()
+        serie = LATENCIA_SQL.con(palabra if palabra in TIPOS_SENTENCIA else "OTRA")
+        if len(_SERIES_SQL) < 1000:
+            _SERIES_SQL[sql] = serie
+    return serie
+
+class ConexionDB(sqlite3.Connection):
+    """Conexión del pool: mide cada sentencia (y, como subclase, admite referencias débiles)"""
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            duracion = time.perf_counter() - inicio
+            _serie_sql(sql).registrar(duracion)
+            if PERFILADOR.activo:
+                PERFILADOR.sumar('bd', duracion)
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            duracion = time.perf_counter() - inicio
+            _serie_sql(sql).registrar(duracion)
+            if PERFILADOR.activo:
+                PERFILADOR.sumar('bd', duracion)
+
+    def commit(self):
+        inicio = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            duracion = time.perf_counter() - inicio
+            LATENCIA_SQL.con("COMMIT").registrar(duracion)
+            if PERFILADOR.activo:
+                PERFILADOR.sumar('bd', duracion)
+
+class PoolDB:
+    """Pool de conexiones SQLite: una conexión persistente por hilo.
+
+    Cada hilo del dispatcher reutiliza su conexión (y con ella la caché de
+    sentencias preparadas de sqlite3) en lugar de abrir una por consulta.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._conexiones = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._generacion = 0
+
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta, timeout=5, factory=ConexionDB,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute("ATTACH DATABASE ? AS archivo", (DB_ARCHIVO_PATH,))
+        for pragma in PRAGMAS_DB:
+            conn.execute(pragma)
+        with self._lock:
+            self._conexiones.add(conn)
+        return conn
+
+    def conexion(self):
+        """Devuelve la conexión del hilo actual, creándola si hace falta"""
+        local = self._local
+        if getattr(local, 'generacion', None) != self._generacion:
+            local.conn = self._conectar()
+            local.generacion = self._generacion
+            local.nivel = 0
+            local.al_confirmar = []
+        return local.conn
+
+    @contextmanager
+    def transaccion(self):
+        """Transacción sobre la conexión del hilo; las anidadas se unen a la exterior"""
+        conn = self.conexion()
+        local = self._local
+        local.nivel += 1
+        try:
+            yield conn
+        except BaseException:
+            local.nivel -= 1
+            if local.nivel == 0:
+                local.al_confirmar.clear()
+                conn.rollback()
+            raise
+        local.nivel -= 1
+        if local.nivel == 0:
+            try:
+                conn.commit()
+            except BaseException:
+                # Sin esto la conexión del hilo seguiría en la transacción fallida
+                # y la siguiente la confirmaría junto con sus callbacks
+                local.al_confirmar.clear()
+                conn.rollback()
+                raise
+            pendientes, local.al_confirmar = local.al_confirmar, []
+            for funcion in pendientes:
+                funcion()
+
+    def al_confirmar(self, funcion):
+        """Ejecuta `funcion` cuando se confirme la transacción en curso del hilo"""
+        self._local.al_confirmar.append(funcion)
+
+    def cerrar(self):
+        """Cierra todas las conexiones abiertas (al apagar el bot)"""
+        with self._lock:
+            self._generacion += 1
+            conexiones = list(self._conexiones)
+            self._conexiones.clear()
+        for conn in conexiones:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+POOL_DB = PoolDB(DB_PATH)
+
 def init_db():
     """Inicializa todas las tablas de la base de datos"""
+    global ID_GRUPO_PEDIDOS
     try:
-        conn = sqlite3.connect('knocktwice.db')
-        c = conn.cursor()
-        
-        # Tabla de pedidos
-        c.execute('''CREATE TABLE IF NOT EXISTS pedidos
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      username TEXT,
-                      productos TEXT,
-                      total REAL,
-                      direccion TEXT,
-                      hora_entrega TEXT,
-                      estado TEXT DEFAULT 'pendiente',
-                      valoracion INTEGER DEFAULT 0,
-                      fecha TEXT)''')
-        
-        # Tabla de usuarios
-        c.execute('''CREATE TABLE IF NOT EXISTS usuarios
-                     (user_id INTEGER PRIMARY KEY,
-                      username TEXT,
-                      ultimo_pedido TEXT,
-                      puntos INTEGER DEFAULT 0)''')
-        
-        # Tabla de valoraciones
-        c.execute('''CREATE TABLE IF NOT EXISTS valoraciones
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      pedido_id INTEGER,
-                      user_id INTEGER,
-                      estrellas INTEGER,
-                      comentario TEXT,
-                      fecha TEXT)''')
-        
-        # Tabla de FAQ
-        c.execute('''CREATE TABLE IF NOT EXISTS faq_stats
-                     (pregunta TEXT PRIMARY KEY,
-                      veces_preguntada INTEGER DEFAULT 0)''')
+        with get_db() as conn:
+            # Tabla de pedidos
+            conn.execute('''CREATE TABLE IF NOT EXISTS pedidos
+                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          user_id INTEGER,
+                          username TEXT,
+                          productos TEXT,
+                          total REAL,
+                          direccion TEXT,
+                          hora_entrega TEXT,
+                          estado TEXT DEFAULT 'pendiente',
+                          valoracion INTEGER DEFAULT 0,
+                          fecha TEXT)''')
+            
+            # Tabla de usuarios
+            conn.execute('''CREATE TABLE IF NOT EXISTS usuarios
+                         (user_id INTEGER PRIMARY KEY,
+                          username TEXT,
+                          ultimo_pedido TEXT,
+                          puntos INTEGER DEFAULT 0)''')
+            
+            # Tabla de valoraciones
+            conn.execute('''CREATE TABLE IF NOT EXISTS valoraciones
+                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          pedido_id INTEGER,
+                          user_id INTEGER,
+                          estrellas INTEGER,
+                          comentario TEXT,
+                          fecha TEXT)''')
+            
+            # Tabla de FAQ
+            conn.execute('''CREATE TABLE IF NOT EXISTS faq_stats
+                         (pregunta TEXT PRIMARY KEY,
+                          veces_preguntada INTEGER DEFAULT 0)''')
+            
+            aplicar_migraciones(conn)
+            for sentencia in ESQUEMA_ARCHIVO:
+                conn.execute(sentencia)
+            
+            # El grupo de pedidos pudo migrar a supergrupo en una ejecución anterior
+            fila = conn.execute("SELECT valor FROM ajustes WHERE clave = 'id_grupo_pedidos'").fetchone()
+            if fila and fila[0] != ID_GRUPO_PEDIDOS:
+                log_aviso("⚠️ ID_GRUPO_PEDIDOS %s sustituido por %s (grupo migrado)", ID_GRUPO_PEDIDOS, fila[0])
+                ID_GRUPO_PEDIDOS = fila[0]
         
-        conn.commit()
-        conn.close()
-        print("✅ Base de datos inicializada")
+        cargar_totales()
+        log_info("✅ Base de datos inicializada")
     except Exception as e:
-        print(f"❌ Error BD: {e}")
+        log_error("❌ Error BD: %s", e, exc_info=True)
 
 def get_db():
-    """Obtiene conexión a la base de datos"""
-    return sqlite3.connect('knocktwice.db')
+    """Transacción sobre la conexión persistente del hilo: `with get_db() as conn:`"""
+    return POOL_DB.transaccion()
+
+# Ventas por día recalculadas desde `pedidos` (para la migración, la
+# reconstrucción y la comprobación de ventas_diarias)
+SQL_VENTAS_POR_DIA = '''SELECT substr(fecha, 1, 10) AS dia, COUNT(*), COALESCE(SUM(total), 0),
+                                COALESCE(SUM(CASE WHEN valoracion > 0 THEN valoracion END), 0),
+                                COUNT(CASE WHEN valoracion > 0 THEN 1 END)
+                         FROM pedidos GROUP BY dia'''
+SQL_TOTALES_DESDE_DIAS = '''INSERT OR REPLACE INTO totales (id, pedidos, ventas, suma_valoraciones, valoraciones)
+                            SELECT 1, COALESCE(SUM(pedidos), 0), COALESCE(SUM(ventas), 0),
+                                   COALESCE(SUM(suma_valoraciones), 0), COALESCE(SUM(valoraciones), 0)
+                            FROM ventas_diarias'''
+# Igual que SQL_VENTAS_POR_DIA pero contando también los pedidos archivados (sin
+# duplicar los de un lote a medio archivar); la migración 5 es anterior al archivo
+SQL_VENTAS_POR_DIA_CON_ARCHIVO = SQL_VENTAS_POR_DIA.replace(
+    "FROM pedidos", '''FROM (SELECT fecha, total, valoracion FROM main.pedidos
+                               UNION ALL
+                               SELECT fecha, total, valoracion FROM archivo.pedidos
+                               WHERE id NOT IN (SELECT id FROM main.pedidos))''')
+
+def _migrar_pedido_items(conn):
+    """Rellena pedido_items interpretando los textos "2x Margarita, 1x Bacon BBQ" de `pedidos`.
+
+    Los nombres se buscan en la carta en uso; el precio unitario es el actual
+    porque el texto no lo guarda. Las líneas de productos que ya no existen se omiten.
+    """
+    catalogo = CATALOGO
+    por_nombre = {nombre: (categoria, producto_id, catalogo.productos[categoria, producto_id]['precio'])
+                  for nombre, (categoria, producto_id) in catalogo.por_nombre.items()}
+    pedidos = conn.execute("SELECT id, productos FROM pedidos WHERE productos IS NOT NULL")
+    migrados = omitidas = 0
+    while True:
+        lote = pedidos.fetchmany(1000)
+        if not lote:
+            break
+        filas = []
+        for pedido_id, productos in lote:
+            cantidades = Counter()
+            for linea in productos.split(", "):
+                cantidad, _, nombre = linea.partition("x ")
+                if not cantidad.isdigit() or nombre not in por_nombre:
+                    omitidas += 1
+                    continue
+                cantidades[por_nombre[nombre]] += int(cantidad)
+            filas.extend((pedido_id, categoria, producto_id, cantidad, precio)
+                         for (categoria, producto_id, precio), cantidad in cantidades.items())
+            migrados += 1
+        conn.executemany('''INSERT OR IGNORE INTO pedido_items (pedido_id, categoria, producto_id, cantidad, precio_unitario)
+                            VALUES (?, ?, ?, ?, ?)''', filas)
+    log_info("📦 Líneas de %s pedidos migradas a pedido_items (%s omitidas)", migrados, omitidas,
+             pedidos=migrados, omitidas=omitidas)
+
+# Migraciones del esquema, versionadas con PRAGMA user_version.
+# La entrada N lleva la base de datos a la versión N; cada paso es una
+# sentencia SQL o una función que recibe la conexión.
+MIGRACIONES = [
+    # 1: índices para el panel admin, pedidos recientes y pedidos sin valorar
+    (
+        # Cubre el filtro por día (COUNT/SUM) y el ORDER BY fecha de los recientes
+        "CREATE INDEX IF NOT EXISTS idx_pedidos_fecha ON pedidos (fecha, total)",
+        # Índice parcial: sólo contiene los pedidos entregados pendientes de valorar
+        """CREATE INDEX IF NOT EXISTS idx_pedidos_sin_valorar ON pedidos (user_id, fecha, productos)
+           WHERE valoracion = 0 AND estado = 'entregado'""",
+    ),
+    # 2: agregado de valoraciones mantenido en cada escritura
+    (
+        """CREATE TABLE IF NOT EXISTS valoraciones_resumen
+           (id INTEGER PRIMARY KEY CHECK (id = 1),
+            suma INTEGER NOT NULL DEFAULT 0,
+            cuenta INTEGER NOT NULL DEFAULT 0)""",
+        """INSERT OR REPLACE INTO valoraciones_resumen (id, suma, cuenta)
+           SELECT 1, COALESCE(SUM(valoracion), 0), COUNT(*) FROM pedidos WHERE valoracion > 0""",
+    ),
+    # 3: mensajes pendientes de la cola de salida (sobreviven a un reinicio)
+    (
+        """CREATE TABLE IF NOT EXISTS mensajes_salientes
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            teclado TEXT,
+            parse_mode TEXT,
+            prioridad INTEGER NOT NULL,
+            intentos INTEGER NOT NULL DEFAULT 0,
+            creado TEXT NOT NULL)""",
+    ),
+    # 4: sesiones de usuario (carrito, dirección...) que sobreviven a un reinicio
+    (
+        """CREATE TABLE IF NOT EXISTS sesiones
+           (user_id INTEGER PRIMARY KEY,
+            datos TEXT NOT NULL,
+            actualizado TEXT NOT NULL)""",
+    ),
+    # 5: ventas por día y totales históricos mantenidos en cada escritura;
+    #    totales sustituye a valoraciones_resumen
+    (
+        """CREATE TABLE IF NOT EXISTS ventas_diarias
+           (dia TEXT PRIMARY KEY,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            ventas REAL NOT NULL DEFAULT 0,
+            suma_valoraciones INTEGER NOT NULL DEFAULT 0,
+            valoraciones INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS totales
+           (id INTEGER PRIMARY KEY CHECK (id = 1),
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            ventas REAL NOT NULL DEFAULT 0,
+            suma_valoraciones INTEGER NOT NULL DEFAULT 0,
+            valoraciones INTEGER NOT NULL DEFAULT 0)""",
+        f"""INSERT INTO ventas_diarias (dia, pedidos, ventas, suma_valoraciones, valoraciones)
+            {SQL_VENTAS_POR_DIA}""",
+        SQL_TOTALES_DESDE_DIAS,
+        "DROP TABLE IF EXISTS valoraciones_resumen",
+    ),
+    # 6: navegador de pedidos del admin, paginado por (fecha, id) con o sin filtros.
+    #    El rowid (id) va implícito al final de cada índice; (fecha, total) ya no
+    #    hace falta desde que el panel lee ventas_diarias.
+    (
+        "DROP INDEX IF EXISTS idx_pedidos_fecha",
+        "CREATE INDEX IF NOT EXISTS idx_pedidos_fecha ON pedidos (fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_pedidos_estado_fecha ON pedidos (estado, fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_pedidos_usuario_fecha ON pedidos (user_id, fecha)",
+    ),
+    # 7: líneas de cada pedido por producto (pedidos.productos queda como texto legible)
+    (
+        """CREATE TABLE IF NOT EXISTS pedido_items
+           (pedido_id INTEGER NOT NULL,
+            categoria TEXT NOT NULL,
+            producto_id TEXT NOT NULL,
+            cantidad INTEGER NOT NULL,
+            precio_unitario REAL NOT NULL,
+            PRIMARY KEY (pedido_id, categoria, producto_id)) WITHOUT ROWID""",
+        # Cubre las sumas por producto (más vendidos) sin tocar la tabla
+        """CREATE INDEX IF NOT EXISTS idx_items_producto
+           ON pedido_items (categoria, producto_id, cantidad, precio_unitario)""",
+        _migrar_pedido_items,
+    ),
+    # 8: el archivado mueve las valoraciones de cada lote de pedidos
+    (
+        "CREATE INDEX IF NOT EXISTS idx_valoraciones_pedido ON valoraciones (pedido_id)",
+    ),
+    # 9: ajustes que el bot cambia en marcha (p. ej. el id del grupo tras migrar a supergrupo)
+    (
+        """CREATE TABLE IF NOT EXISTS ajustes
+           (clave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL)""",
+    ),
+]
+
+# Tablas de la BD de archivo: las mismas columnas que en la principal, sin
+# AUTOINCREMENT (los ids vienen de la principal) y sólo con los índices que
+# usan el navegador de pedidos, los más vendidos y la exportación
+ESQUEMA_ARCHIVO = (
+    """CREATE TABLE IF NOT EXISTS archivo.pedidos
+       (id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        productos TEXT,
+        total REAL,
+        direccion TEXT,
+        hora_entrega TEXT,
+        estado TEXT,
+        valoracion INTEGER,
+        fecha TEXT)""",
+    "CREATE INDEX IF NOT EXISTS archivo.idx_pedidos_fecha ON pedidos (fecha)",
+    "CREATE INDEX IF NOT EXISTS archivo.idx_pedidos_usuario_fecha ON pedidos (user_id, fecha)",
+    """CREATE TABLE IF NOT EXISTS archivo.pedido_items
+       (pedido_id INTEGER NOT NULL,
+        categoria TEXT NOT NULL,
+        producto_id TEXT NOT NULL,
+        cantidad INTEGER NOT NULL,
+        precio_unitario REAL NOT NULL,
+        PRIMARY KEY (pedido_id, categoria, producto_id)) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS archivo.idx_items_producto
+       ON pedido_items (categoria, producto_id, cantidad, precio_unitario)""",
+    """CREATE TABLE IF NOT EXISTS archivo.valoraciones
+       (id INTEGER PRIMARY KEY,
+        pedido_id INTEGER,
+        user_id INTEGER,
+        estrellas INTEGER,
+        comentario TEXT,
+        fecha TEXT)""",
+)
+
+def aplicar_migraciones(conn):
+    """Aplica en orden las migraciones pendientes, una transacción por versión"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for numero, pasos in enumerate(MIGRACIONES[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for paso in pasos:
+                if callable(paso):
+                    paso(conn)
+                else:
+                    conn.execute(paso)
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log_info("✅ Migración %s aplicada", numero, migracion=numero)
+
+def rango_dia(dia):
+    """Límites [inicio, fin) de un día para comparar con `fecha` usando el índice"""
+    return dia.isoformat(), (dia + timedelta(days=1)).isoformat()
 
 # ============ MENÚ COMPLETO ============
+# Carta integrada: se usa cuando no hay CATALOGO_PATH (ver CATÁLOGO)
 MENU = {
     "pizzas": {
         "titulo": "🍕 PIZZAS",
@@ -163,84 +1000,1493 @@ FAQ = {
     }
 }
 
+class ContadorFAQ:
+    """Contadores de consultas FAQ con escritura diferida.
+
+    Las consultas se acumulan en memoria y un hilo las vuelca a faq_stats en
+    una sola transacción cada `intervalo` segundos, al llegar a `umbral`
+    consultas pendientes y al apagar el bot.
+    """
+
+    def __init__(self, intervalo=30, umbral=100):
+        self.intervalo = intervalo
+        self.umbral = umbral
+        self._pendientes = Counter()
+        self._num_pendientes = 0
+        self._lock = threading.Lock()
+        self._lock_volcado = threading.Lock()  # un volcado o una lectura de totales a la vez
+        self._aviso = threading.Event()
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def registrar(self, pregunta):
+        with self._lock:
+            self._pendientes[pregunta] += 1
+            self._num_pendientes += 1
+            lleno = self._num_pendientes >= self.umbral
+        if lleno:
+            self._aviso.set()
+
+    def volcar(self):
+        """Escribe los contadores pendientes; devuelve cuántas preguntas se actualizaron"""
+        with self._lock_volcado:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, Counter()
+                self._num_pendientes = 0
+            if not lote:
+                return 0
+            
+            try:
+                with get_db() as conn:
+                    conn.executemany('''INSERT INTO faq_stats (pregunta, veces_preguntada) VALUES (?, ?)
+                                        ON CONFLICT(pregunta) DO UPDATE SET
+                                            veces_preguntada = veces_preguntada + excluded.veces_preguntada''',
+                                     lote.items())
+            except Exception:
+                # Se devuelven a la cola para el siguiente intento
+                with self._lock:
+                    self._pendientes.update(lote)
+                    self._num_pendientes += sum(lote.values())
+                raise
+            return len(lote)
+
+    def totales(self):
+        """Consultas por pregunta: lo guardado más lo pendiente de volcar"""
+        with self._lock_volcado:
+            with get_db() as conn:
+                totales = Counter(dict(conn.execute("SELECT pregunta, veces_preguntada FROM faq_stats")))
+            with self._lock:
+                totales.update(self._pendientes)
+        return totales
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            self._aviso.wait(self.intervalo)
+            self._aviso.clear()
+            try:
+                self.volcar()
+            except Exception as e:
+                log_error("❌ Error volcando estadísticas FAQ: %s", e)
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, name="contador-faq", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Para el hilo y vuelca lo que quede pendiente"""
+        self._parar.set()
+        self._aviso.set()
+        if self._hilo:
+            self._hilo.join(timeout=5)
+        self.volcar()
+
+CONTADOR_FAQ = ContadorFAQ()
+
 def registrar_consulta_faq(pregunta):
-    """Registra una consulta FAQ"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO faq_stats (pregunta, veces_preguntada)
-                 VALUES (?, COALESCE((SELECT veces_preguntada FROM faq_stats WHERE pregunta = ?), 0) + 1)''',
-              (pregunta, pregunta))
-    conn.commit()
-    conn.close()
+    """Registra una consulta FAQ (se guarda en el próximo volcado)"""
+    CONTADOR_FAQ.registrar(pregunta)
+
+# ============ CARRITO ============
+class Carrito:
+    """Cesta de un usuario agrupada por producto.
+
+    Cada línea es (categoria, producto_id) -> [cantidad, precio, nombre]; el
+    total y las unidades se mantienen al añadir o quitar, así que son O(1).
+    """
+    __slots__ = ('_lineas', '_total', '_unidades')
+
+    def __init__(self):
+        self._lineas = {}
+        self._total = 0
+        self._unidades = 0
+
+    def agregar(self, categoria, producto_id, nombre, precio, cantidad=1):
+        """Añade `cantidad` unidades de un producto"""
+        linea = self._lineas.get((categoria, producto_id))
+        if linea is None:
+            self._lineas[(categoria, producto_id)] = [cantidad, precio, nombre]
+        else:
+            linea[0] += cantidad
+        self._total += precio * cantidad
+        self._unidades += cantidad
+
+    def quitar_uno(self, categoria, producto_id):
+        """Quita una unidad de un producto; devuelve False si no estaba en la cesta"""
+        linea = self._lineas.get((categoria, producto_id))
+        if linea is None:
+            return False
+        linea[0] -= 1
+        if linea[0] == 0:
+            del self._lineas[(categoria, producto_id)]
+        self._total -= linea[1]
+        self._unidades -= 1
+        return True
+
+    def vaciar(self):
+        self._lineas.clear()
+        self._total = 0
+        self._unidades = 0
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def unidades(self):
+        return self._unidades
+
+    def __bool__(self):
+        return self._unidades > 0
+
+    def lineas(self):
+        """Itera (categoria, producto_id, nombre, cantidad, precio) en orden de llegada"""
+        for (categoria, producto_id), (cantidad, precio, nombre) in self._lineas.items():
+            yield categoria, producto_id, nombre, cantidad, precio
+
+    def serializar(self):
+        """Forma compacta para persistir: [[categoria, producto_id, cantidad, precio, nombre], ...]"""
+        return [[categoria, producto_id, cantidad, precio, nombre]
+                for (categoria, producto_id), (cantidad, precio, nombre) in self._lineas.items()]
+
+    @classmethod
+    def desde_datos(cls, datos):
+        """Reconstruye un carrito desde su forma serializada o desde el formato antiguo.
+
+        El formato antiguo es una lista con un dict {'nombre', 'precio', 'categoria'}
+        por unidad; (categoria, producto_id) se recupera buscando el nombre en la
+        carta. Las líneas que no se pueden identificar se descartan: sin ids no
+        hay botón de quitar válido.
+        """
+        if isinstance(datos, cls):
+            return datos
+        
+        carrito = cls()
+        descartadas = 0
+        for item in datos or ():
+            if isinstance(item, dict):
+                clave = CATALOGO.por_nombre.get(item.get('nombre'))
+                if clave is None:
+                    descartadas += 1
+                    continue
+                carrito.agregar(*clave, item['nombre'], item['precio'])
+            else:
+                categoria, producto_id, cantidad, precio, nombre = item
+                if not categoria or not producto_id:
+                    descartadas += 1
+                    continue
+                carrito.agregar(categoria, producto_id, nombre, precio, cantidad)
+        if descartadas:
+            log_aviso("⚠️ Carrito antiguo: %s líneas sin producto en la carta descartadas", descartadas)
+        return carrito
+
+def obtener_carrito(context):
+    """Carrito del usuario, migrando sesiones con el formato antiguo"""
+    carrito = context.user_data.get('carrito')
+    if not isinstance(carrito, Carrito):
+        carrito = context.user_data['carrito'] = Carrito.desde_datos(carrito)
+    return carrito
+
+# ============ SESIONES PERSISTENTES ============
+class SesionesUsuario(defaultdict):
+    """user_data del dispatcher; cada usuario se lee de la BD la primera vez que se usa"""
+
+    def __init__(self, persistencia):
+        super().__init__(dict)
+        self._persistencia = persistencia
+
+    def __missing__(self, user_id):
+        datos = self[user_id] = self._persistencia.cargar(user_id)
+        return datos
+
+class PersistenciaSQLite(BasePersistence):
+    """Persistencia de user_data en la tabla sesiones.
+
+    Sólo se guardan los usuarios cuyo JSON ha cambiado desde la última
+    escritura; un hilo los vuelca en una transacción cada `intervalo`
+    segundos, al llegar a `umbral` pendientes y al apagar el bot.
+    """
+
+    def __init__(self, intervalo=2, umbral=200):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.intervalo = intervalo
+        self.umbral = umbral
+        self._guardados = {}   # user_id -> último JSON leído o escrito
+        self._pendientes = {}  # user_id -> JSON por escribir
+        self._lock = threading.Lock()
+        self._lock_volcado = threading.Lock()
+        self._aviso = threading.Event()
+        self._parar = threading.Event()
+        self._hilo = None
+
+    # Las sesiones no contienen objetos Bot: no hace falta copiarlas
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    @staticmethod
+    def _serializar(datos):
+        return json.dumps({clave: valor.serializar() if isinstance(valor, Carrito) else valor
+                           for clave, valor in datos.items()},
+                          ensure_ascii=False, separators=(',', ':'))
+
+    def cargar(self, user_id):
+        """Sesión guardada de un usuario ({} si no tiene); el carrito se migra al usarlo"""
+        with get_db() as conn:
+            fila = conn.execute("SELECT datos FROM sesiones WHERE user_id = ?", (user_id,)).fetchone()
+        datos = fila[0] if fila else "{}"
+        with self._lock:
+            self._guardados.setdefault(user_id, datos)
+        return json.loads(datos)
+
+    def get_user_data(self):
+        return SesionesUsuario(self)
+
+    def update_user_data(self, user_id, data):
+        # Con updates en marcha en otro hilo, el ejecutor la guarda al terminar
+        if EJECUTOR is not None and EJECUTOR.ocupado_por_otro(user_id):
+            return
+        datos = self._serializar(data)
+        with self._lock:
+            if self._guardados.get(user_id) == datos:
+                self._pendientes.pop(user_id, None)
+                return
+            self._pendientes[user_id] = datos
+            lleno = len(self._pendientes) >= self.umbral
+        if lleno:
+            self._aviso.set()
+
+    def volcar(self):
+        """Escribe las sesiones cambiadas; devuelve cuántas se actualizaron"""
+        with self._lock_volcado:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, {}
+            if not lote:
+                return 0
+            
+            ahora = datetime.now().isoformat()
+            try:
+                with get_db() as conn:
+                    # Una sesión vacía no ocupa fila
+                    conn.executemany("DELETE FROM sesiones WHERE user_id = ?",
+                                     [(u,) for u, datos in lote.items() if datos == "{}"])
+                    conn.executemany('''INSERT INTO sesiones (user_id, datos, actualizado) VALUES (?, ?, ?)
+                                        ON CONFLICT(user_id) DO UPDATE SET
+                                            datos = excluded.datos, actualizado = excluded.actualizado''',
+                                     [(u, datos, ahora) for u, datos in lote.items() if datos != "{}"])
+            except Exception:
+                # Se devuelven a la cola salvo que ya haya una versión más nueva
+                with self._lock:
+                    for user_id, datos in lote.items():
+                        self._pendientes.setdefault(user_id, datos)
+                raise
+            with self._lock:
+                self._guardados.update(lote)
+            return len(lote)
+
+    def flush(self):
+        self.volcar()
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            self._aviso.wait(self.intervalo)
+            self._aviso.clear()
+            try:
+                self.volcar()
+            except Exception as e:
+                log_error("❌ Error guardando sesiones: %s", e)
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, name="sesiones", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Para el hilo y vuelca lo que quede pendiente"""
+        self._parar.set()
+        self._aviso.set()
+        if self._hilo:
+            self._hilo.join(timeout=5)
+        self.volcar()
+
+    # Sin chat_data, bot_data ni conversaciones
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+PERSISTENCIA = PersistenciaSQLite()
 
 # ============ SISTEMA SIMPLIFICADO ============
+COOLDOWN_PEDIDOS = timedelta(minutes=1)  # 1 minuto en modo pruebas
+MAX_COOLDOWNS_EN_MEMORIA = 10000
+
+class CacheCooldown:
+    """Último pedido de cada usuario dentro de la ventana de cooldown.
+
+    Guarda user_id -> instante (time.monotonic) sólo mientras dura el cooldown.
+    Se carga con un único SELECT al primer uso y a partir de ahí es la fuente
+    de verdad: un usuario ausente no tiene pedidos recientes y no cuesta I/O.
+    """
+
+    def __init__(self, ventana, maximo):
+        self.ventana = ventana.total_seconds()
+        self.maximo = maximo
+        self._ultimos = OrderedDict()  # ordenado del pedido más antiguo al más reciente
+        self._lock = threading.Lock()
+        self._cargada = False
+
+    def _cargar(self):
+        desde = (datetime.now() - timedelta(seconds=self.ventana)).isoformat()
+        with get_db() as conn:
+            filas = conn.execute('''SELECT user_id, ultimo_pedido FROM usuarios
+                                    WHERE ultimo_pedido >= ? ORDER BY ultimo_pedido''', (desde,)).fetchall()
+        
+        ahora_reloj, ahora = datetime.now(), time.monotonic()
+        for user_id, ultimo_pedido in filas:
+            transcurrido = (ahora_reloj - datetime.fromisoformat(ultimo_pedido)).total_seconds()
+            self._ultimos[user_id] = ahora - transcurrido
+        self._cargada = True
+
+    def _purgar(self, ahora):
+        # Expira las entradas fuera de la ventana y, si se supera el máximo,
+        # descarta las más antiguas (las primeras que iban a caducar)
+        limite = ahora - self.ventana
+        while self._ultimos:
+            instante = next(iter(self._ultimos.values()))
+            if instante > limite and len(self._ultimos) <= self.maximo:
+                break
+            self._ultimos.popitem(last=False)
+
+    def restante(self, user_id):
+        """Segundos que le faltan al usuario para poder pedir (0 si ya puede)"""
+        ahora = time.monotonic()
+        with self._lock:
+            if not self._cargada:
+                self._cargar()
+            self._purgar(ahora)
+            instante = self._ultimos.get(user_id)
+        
+        if instante is None:
+            return 0
+        return max(0.0, instante + self.ventana - ahora)
+
+    def registrar(self, user_id):
+        """Anota un pedido recién confirmado"""
+        ahora = time.monotonic()
+        with self._lock:
+            self._ultimos.pop(user_id, None)
+            self._ultimos[user_id] = ahora
+            self._purgar(ahora)
+
+CACHE_COOLDOWN = CacheCooldown(COOLDOWN_PEDIDOS, MAX_COOLDOWNS_EN_MEMORIA)
+
 def verificar_cooldown(user_id):
     """Verifica si el usuario puede hacer otro pedido"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT ultimo_pedido FROM usuarios WHERE user_id = ?", (user_id,))
-    resultado = c.fetchone()
-    conn.close()
-    
-    if resultado and resultado[0]:
-        ultimo_pedido = datetime.fromisoformat(resultado[0])
-        if datetime.now() - ultimo_pedido < timedelta(minutes=1):  # 1 minuto en modo pruebas
-            return False, 1
+    restante = CACHE_COOLDOWN.restante(user_id)
+    if restante > 0:
+        RECHAZOS_COOLDOWN.incrementar()
+        return False, math.ceil(restante / 60)
     
     return True, 0
 
 def actualizar_cooldown(user_id, username):
-    """Actualiza el último pedido del usuario"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO usuarios (user_id, username, ultimo_pedido)
-                 VALUES (?, ?, ?)''',
-              (user_id, username, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    """Actualiza el último pedido del usuario (BD y caché)"""
+    with get_db() as conn:
+        # UPSERT: sólo toca username y ultimo_pedido, conserva los puntos
+        conn.execute('''INSERT INTO usuarios (user_id, username, ultimo_pedido)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            username = excluded.username,
+                            ultimo_pedido = excluded.ultimo_pedido''',
+                     (user_id, username, datetime.now().isoformat()))
+        POOL_DB.al_confirmar(lambda: CACHE_COOLDOWN.registrar(user_id))
+
+# ============ AGREGADOS DE VENTAS ============
+# ventas_diarias (una fila por día) y totales (una sola fila) se actualizan en
+# la misma transacción que crea el pedido o guarda la valoración, así el panel
+# lee dos filas en vez de agregar todo el histórico.
+CAMPOS_VENTAS = ('pedidos', 'ventas', 'suma_valoraciones', 'valoraciones')
+
+# Copia en memoria de la fila de totales, en el orden de CAMPOS_VENTAS. Se carga
+# en init_db, antes de que haya pedidos en marcha, y desde entonces sólo cambia
+# con los deltas confirmados: cargarla más tarde podría contar dos veces un
+# pedido ya confirmado cuyo delta aún no se ha aplicado.
+_totales = None
+_lock_totales = threading.Lock()
+
+def dia_de(fecha):
+    """Día ('AAAA-MM-DD') de una fecha ISO de la tabla pedidos"""
+    return fecha[:10]
+
+def sumar_ventas(conn, dia, pedidos=0, ventas=0, suma_valoraciones=0, valoraciones=0):
+    """Aplica un delta a ventas_diarias y totales dentro de la transacción en curso"""
+    delta = (pedidos, ventas, suma_valoraciones, valoraciones)
+    conn.execute('''INSERT INTO ventas_diarias (dia, pedidos, ventas, suma_valoraciones, valoraciones)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(dia) DO UPDATE SET
+                        pedidos = pedidos + excluded.pedidos,
+                        ventas = ventas + excluded.ventas,
+                        suma_valoraciones = suma_valoraciones + excluded.suma_valoraciones,
+                        valoraciones = valoraciones + excluded.valoraciones''', (dia, *delta))
+    conn.execute('''UPDATE totales SET pedidos = pedidos + ?, ventas = ventas + ?,
+                        suma_valoraciones = suma_valoraciones + ?, valoraciones = valoraciones + ?
+                    WHERE id = 1''', delta)
+    POOL_DB.al_confirmar(lambda: _sumar_totales(delta))
+
+def _sumar_totales(delta):
+    """Aplica un delta ya confirmado en la BD a la copia en memoria"""
+    with _lock_totales:
+        if _totales is not None:
+            for i, valor in enumerate(delta):
+                _totales[i] += valor
+
+def cargar_totales():
+    """Lee la fila de totales confirmada, con una conexión aparte (nunca ve una transacción a medias)"""
+    global _totales
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    try:
+        fila = conn.execute('''SELECT pedidos, ventas, suma_valoraciones, valoraciones
+                               FROM totales WHERE id = 1''').fetchone()
+    finally:
+        conn.close()
+    with _lock_totales:
+        _totales = list(fila) if fila else [0, 0.0, 0, 0]
+
+def obtener_totales():
+    """Totales históricos (pedidos, ventas, suma_valoraciones, valoraciones) sin leer la BD"""
+    if _totales is None:
+        cargar_totales()  # sólo si no se ha llamado a init_db (scripts sueltos)
+    with _lock_totales:
+        return tuple(_totales)
+
+def ventas_del_dia(dia):
+    """(pedidos, ventas, suma_valoraciones, valoraciones) de un día"""
+    with get_db() as conn:
+        fila = conn.execute('''SELECT pedidos, ventas, suma_valoraciones, valoraciones
+                               FROM ventas_diarias WHERE dia = ?''', (dia.isoformat(),)).fetchone()
+    return tuple(fila) if fila else (0, 0.0, 0, 0)
 
 def obtener_valoracion_promedio():
     """Obtiene la valoración promedio"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT AVG(valoracion) FROM pedidos WHERE valoracion > 0")
-    resultado = c.fetchone()[0]
-    conn.close()
-    return round(resultado, 1) if resultado else 0.0
+    _, _, suma, cuenta = obtener_totales()
+    return round(suma / cuenta, 1) if cuenta else 0.0
 
 def guardar_valoracion(pedido_id, user_id, estrellas):
     """Guarda una valoración en la base de datos"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO valoraciones (pedido_id, user_id, estrellas, fecha)
-                 VALUES (?, ?, ?, ?)''',
-              (pedido_id, user_id, estrellas, datetime.now().isoformat()))
-    c.execute("UPDATE pedidos SET valoracion = ? WHERE id = ?", (estrellas, pedido_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute('''INSERT INTO valoraciones (pedido_id, user_id, estrellas, fecha)
+                        VALUES (?, ?, ?, ?)''',
+                     (pedido_id, user_id, estrellas, datetime.now().isoformat()))
+        fila = conn.execute("SELECT valoracion, fecha FROM pedidos WHERE id = ?", (pedido_id,)).fetchone()
+        if not fila:
+            return
+        
+        # Si el pedido ya estaba valorado se sustituye su nota en los agregados
+        anterior = fila[0] or 0
+        conn.execute("UPDATE pedidos SET valoracion = ? WHERE id = ?", (estrellas, pedido_id))
+        sumar_ventas(conn, dia_de(fila[1]), suma_valoraciones=estrellas - anterior,
+                     valoraciones=0 if anterior > 0 else 1)
+
+def comprobar_ventas(conn=None):
+    """Compara ventas_diarias y totales con lo que sale de agregar `pedidos`.
+
+    Devuelve las diferencias como tuplas (día o 'TOTAL', campo, guardado, real).
+    """
+    if conn is None:
+        with get_db() as conn:
+            return comprobar_ventas(conn)
+    
+    reales = {fila[0]: fila[1:] for fila in conn.execute(SQL_VENTAS_POR_DIA_CON_ARCHIVO)}
+    guardadas = {fila[0]: fila[1:] for fila in conn.execute(
+        "SELECT dia, pedidos, ventas, suma_valoraciones, valoraciones FROM ventas_diarias")}
+    fila_totales = conn.execute('''SELECT pedidos, ventas, suma_valoraciones, valoraciones
+                                   FROM totales WHERE id = 1''').fetchone()
+    
+    diferencias = []
+    def comparar(clave, guardado, real):
+        for campo, a, b in zip(CAMPOS_VENTAS, guardado, real):
+            if abs(a - b) > 0.005:  # las ventas son REAL: se ignora el error de redondeo
+                diferencias.append((clave, campo, a, b))
+    
+    vacio = (0, 0, 0, 0)
+    for dia in sorted(reales.keys() | guardadas.keys()):
+        comparar(dia, guardadas.get(dia, vacio), reales.get(dia, vacio))
+    comparar('TOTAL', fila_totales or vacio, [sum(columna) for columna in zip(vacio, *reales.values())])
+    return diferencias
+
+def reconstruir_ventas():
+    """Recalcula ventas_diarias y totales desde `pedidos`; devuelve las diferencias que había"""
+    consulta_totales = "SELECT pedidos, ventas, suma_valoraciones, valoraciones FROM totales WHERE id = 1"
+    with get_db() as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")  # antes y después se leen sin otros pedidos entre medias
+        diferencias = comprobar_ventas(conn)
+        antes = conn.execute(consulta_totales).fetchone() or (0, 0, 0, 0)
+        conn.execute("DELETE FROM ventas_diarias")
+        conn.execute(f'''INSERT INTO ventas_diarias (dia, pedidos, ventas, suma_valoraciones, valoraciones)
+                         {SQL_VENTAS_POR_DIA_CON_ARCHIVO}''')
+        conn.execute(SQL_TOTALES_DESDE_DIAS)
+        despues = conn.execute(consulta_totales).fetchone()
+        # La corrección llega a la copia en memoria como un delta más
+        correccion = tuple(nuevo - viejo for nuevo, viejo in zip(despues, antes))
+        POOL_DB.al_confirmar(lambda: _sumar_totales(correccion))
+    return diferencias
 
 def obtener_pedidos_sin_valorar(user_id):
     """Obtiene pedidos del usuario sin valorar"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''SELECT id, productos FROM pedidos 
-                 WHERE user_id = ? AND valoracion = 0 AND estado = 'entregado'
-                 ORDER BY fecha DESC LIMIT 3''', (user_id,))
-    pedidos = c.fetchall()
-    conn.close()
-    return pedidos
+    with get_db() as conn:
+        return conn.execute('''SELECT id, productos FROM pedidos 
+                               WHERE user_id = ? AND valoracion = 0 AND estado = 'entregado'
+                               ORDER BY fecha DESC LIMIT 3''', (user_id,)).fetchall()
+
+def buscar_pedidos(estado=None, dia=None, user_id=None, antes_de=None, despues_de=None, limite=10):
+    """Una página de pedidos ordenada por (fecha, id), del más reciente al más antiguo.
+
+    antes_de / despues_de son el id del pedido que hace de cursor: la página
+    siguiente (más antiguos) o la anterior (más recientes). Devuelve
+    (filas, hay_mas), donde hay_mas indica si quedan pedidos en esa dirección.
+    """
+    condiciones, parametros = [], []
+    if estado:
+        condiciones.append("estado = ?")
+        parametros.append(estado)
+    if user_id:
+        condiciones.append("user_id = ?")
+        parametros.append(user_id)
+    if dia:
+        condiciones.append("fecha >= ? AND fecha < ?")
+        parametros.extend(rango_dia(dia))
+    
+    # Los entregados antiguos están en el archivo: se piden las dos páginas y se mezclan
+    esquemas = ("main",) if estado and estado != 'entregado' else ("main", "archivo")
+    with get_db() as conn:
+        cursor = antes_de or despues_de
+        fila = conn.execute('''SELECT fecha FROM main.pedidos WHERE id = ?
+                               UNION ALL SELECT fecha FROM archivo.pedidos WHERE id = ?
+                               LIMIT 1''', (cursor, cursor)).fetchone() if cursor else None
+        if fila:
+            # Rango del índice que empieza justo después del cursor, sin OFFSET
+            condiciones.append("(fecha, id) < (?, ?)" if antes_de else "(fecha, id) > (?, ?)")
+            parametros.extend((fila[0], cursor))
+        orden = "ASC" if despues_de and fila else "DESC"
+        donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        filas = []
+        for esquema in esquemas:
+            filas.extend(conn.execute(f'''SELECT id, user_id, username, productos, total, direccion, hora_entrega, estado, fecha
+                                          FROM {esquema}.pedidos {donde}
+                                          ORDER BY fecha {orden}, id {orden} LIMIT ?''', (*parametros, limite + 1)))
+
+    # Mientras se archiva un lote sus pedidos pueden estar en las dos BD
+    unicos = {}
+    for f in sorted(filas, key=lambda f: (f[8], f[0]), reverse=orden == "DESC"):
+        unicos.setdefault(f[0], f)
+    filas = list(unicos.values())
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    if orden == "ASC":
+        filas.reverse()
+    return filas, hay_mas
+
+def productos_mas_vendidos(desde=None, limite=5):
+    """[(categoria, producto_id, unidades, ventas)] más vendidos desde un día, o en todo el histórico"""
+    # Se agrega en cada BD por separado y luego se suman los dos resultados
+    if desde is None:
+        # Sólo recorre idx_items_producto, ya agrupado por producto
+        por_esquema = '''SELECT categoria, producto_id, SUM(cantidad) AS unidades,
+                                SUM(cantidad * precio_unitario) AS ventas
+                         FROM {esquema}.pedido_items GROUP BY categoria, producto_id'''
+        parametros = ()
+    else:
+        por_esquema = '''SELECT i.categoria, i.producto_id, SUM(i.cantidad) AS unidades,
+                                SUM(i.cantidad * i.precio_unitario) AS ventas
+                         FROM {esquema}.pedidos p JOIN {esquema}.pedido_items i ON i.pedido_id = p.id
+                         WHERE p.fecha >= ?
+                         GROUP BY i.categoria, i.producto_id'''
+        parametros = (desde.isoformat(),) * 2
+    with get_db() as conn:
+        return conn.execute(f'''SELECT categoria, producto_id, SUM(unidades) AS total_unidades, SUM(ventas)
+                                FROM ({por_esquema.format(esquema="main")}
+                                      UNION ALL {por_esquema.format(esquema="archivo")})
+                                GROUP BY categoria, producto_id
+                                ORDER BY total_unidades DESC LIMIT ?''', (*parametros, limite)).fetchall()
+
+def unidades_por_preparar():
+    """[(categoria, producto_id, unidades)] de los pedidos pendientes, para cocina"""
+    with get_db() as conn:
+        return conn.execute('''SELECT i.categoria, i.producto_id, SUM(i.cantidad) AS unidades
+                               FROM pedidos p JOIN pedido_items i ON i.pedido_id = p.id
+                               WHERE p.estado = 'pendiente'
+                               GROUP BY i.categoria, i.producto_id
+                               ORDER BY unidades DESC''').fetchall()
 
 def actualizar_estado_pedido(pedido_id, estado):
     """Actualiza el estado de un pedido"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("UPDATE pedidos SET estado = ? WHERE id = ?", (estado, pedido_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("UPDATE pedidos SET estado = ? WHERE id = ?", (estado, pedido_id))
 
 def es_admin(user_id):
     return user_id in ADMIN_IDS
 
+# ============ ARCHIVO ============
+# Los pedidos entregados con más de DIAS_ARCHIVO días pasan, con sus líneas y
+# valoraciones, a la BD de archivo (adjunta como `archivo`). Cada lote son dos
+# transacciones cortas: copiar al archivo y, ya confirmada la copia, borrar de
+# la principal; si el proceso muere entre las dos, el siguiente lote repite la
+# copia (INSERT OR IGNORE) y termina el borrado. Con WAL una transacción que
+# toca dos ficheros no es atómica entre ellos, por eso no se hace en una sola.
+# Con el local cerrado (según FAQ['horario']) se compacta y optimiza la BD.
+DIAS_ARCHIVO = int(os.environ.get("DIAS_ARCHIVO", 90))  # 0 desactiva el archivado
+LOTE_ARCHIVO = 200
+PAUSA_ENTRE_LOTES = 0.05           # deja pasar a los pedidos entre lote y lote
+SEGUNDOS_ENTRE_ARCHIVADOS = 3600
+MARGEN_HORARIO_MINUTOS = 60        # antes de abrir y después de cerrar también se considera abierto
+PAGINAS_VACUUM_POR_PASO = 1000
+HORAS_ENTRE_MANTENIMIENTOS = 20
+DIAS_SEMANA = {'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2, 'jueves': 3, 'viernes': 4,
+               'sábado': 5, 'sabado': 5, 'domingo': 6}
+PEDIDOS_ARCHIVADOS = contador("knocktwice_pedidos_archivados_total", "Pedidos movidos a la BD de archivo")
+
+COLUMNAS_ARCHIVO = {
+    "pedidos": "id, user_id, username, productos, total, direccion, hora_entrega, estado, valoracion, fecha",
+    "pedido_items": "pedido_id, categoria, producto_id, cantidad, precio_unitario",
+    "valoraciones": "id, pedido_id, user_id, estrellas, comentario, fecha",
+}
+
+def franjas_horario(texto):
+    """{día de la semana: [(minuto de apertura, minuto de cierre)]} de un texto como FAQ['horario']"""
+    franjas = defaultdict(list)
+    for linea in texto.splitlines():
+        dia, _, horas = linea.strip("•* \t").partition(":")
+        dia = DIAS_SEMANA.get(dia.strip("* ").lower())
+        if dia is None:
+            continue
+        for h1, m1, h2, m2 in re.findall(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})", horas):
+            franjas[dia].append((int(h1) * 60 + int(m1), int(h2) * 60 + int(m2)))
+    return franjas
+
+def en_horario(momento, franjas, margen=MARGEN_HORARIO_MINUTOS):
+    """True si `momento` cae en una franja de apertura ampliada `margen` minutos por cada lado"""
+    minuto = momento.hour * 60 + momento.minute
+    # Franjas de ayer que pasan de medianoche y de mañana cuyo margen empieza hoy
+    for desfase in (-1, 0, 1):
+        relativo = minuto - desfase * 1440
+        for inicio, fin in franjas.get((momento.weekday() + desfase) % 7, ()):
+            if fin <= inicio:
+                fin += 1440
+            if inicio - margen <= relativo < fin + margen:
+                return True
+    return False
+
+def texto_horario():
+    """Respuesta de la FAQ 'horario' de la carta en uso"""
+    return CATALOGO.faq.get('horario', {}).get('respuesta', '')
+
+class Archivador:
+    """Hilo que archiva los pedidos antiguos y hace el mantenimiento de la BD con el local cerrado"""
+
+    def __init__(self, dias=DIAS_ARCHIVO, intervalo=SEGUNDOS_ENTRE_ARCHIVADOS):
+        self.dias = dias
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._hilo = None
+        self._ultimo_mantenimiento = None
+
+    def archivar(self, antes_de=None):
+        """Mueve al archivo, por lotes, los pedidos entregados anteriores a `antes_de`; devuelve cuántos"""
+        if antes_de is None:
+            antes_de = datetime.now() - timedelta(days=self.dias)
+        movidos = 0
+        while not self._parar.is_set():
+            with get_db() as conn:
+                ids = [fila[0] for fila in conn.execute(
+                    '''SELECT id FROM main.pedidos WHERE estado = 'entregado' AND fecha < ?
+                       ORDER BY fecha LIMIT ?''', (antes_de.isoformat(), LOTE_ARCHIVO))]
+                if not ids:
+                    break
+                marcas = ",".join("?" * len(ids))
+                # 1: copia (sólo escribe en el archivo)
+                for tabla, clave in (("pedidos", "id"), ("pedido_items", "pedido_id"), ("valoraciones", "pedido_id")):
+                    columnas = COLUMNAS_ARCHIVO[tabla]
+                    conn.execute(f'''INSERT OR IGNORE INTO archivo.{tabla} ({columnas})
+                                     SELECT {columnas} FROM main.{tabla} WHERE {clave} IN ({marcas})''', ids)
+            with get_db() as conn:
+                # 2: borrado (sólo escribe en la principal)
+                for tabla, clave in (("valoraciones", "pedido_id"), ("pedido_items", "pedido_id"), ("pedidos", "id")):
+                    conn.execute(f"DELETE FROM main.{tabla} WHERE {clave} IN ({marcas})", ids)
+            movidos += len(ids)
+            PEDIDOS_ARCHIVADOS.incrementar(len(ids))
+            self._parar.wait(PAUSA_ENTRE_LOTES)
+        if movidos:
+            log_info("🗄️ %s pedidos archivados (anteriores a %s)", movidos, antes_de.date(), pedidos=movidos)
+        return movidos
+
+    def mantenimiento(self):
+        """Libera las páginas vacías, optimiza los índices y recorta los WAL; devuelve las páginas liberadas"""
+        conn = POOL_DB.conexion()
+        if conn.in_transaction:
+            return 0
+        for esquema in ("main", "archivo"):
+            if conn.execute(f"PRAGMA {esquema}.auto_vacuum").fetchone()[0] != 2:
+                # BD anterior al archivado: un VACUUM completo, una sola vez, activa el modo incremental
+                log_info("🧹 Activando auto_vacuum incremental en %s (VACUUM completo)", esquema)
+                conn.execute(f"PRAGMA {esquema}.auto_vacuum = INCREMENTAL")
+                conn.execute(f"VACUUM {esquema}")
+        liberadas = 0
+        for esquema in ("main", "archivo"):
+            while not self._parar.is_set():
+                libres = conn.execute(f"PRAGMA {esquema}.freelist_count").fetchone()[0]
+                if not libres:
+                    break
+                conn.execute(f"PRAGMA {esquema}.incremental_vacuum({PAGINAS_VACUUM_POR_PASO})").fetchall()
+                liberadas += min(libres, PAGINAS_VACUUM_POR_PASO)
+                self._parar.wait(PAUSA_ENTRE_LOTES)
+        conn.execute("PRAGMA optimize")
+        for esquema in ("main", "archivo"):
+            conn.execute(f"PRAGMA {esquema}.wal_checkpoint(TRUNCATE)").fetchall()
+        log_info("🧹 Mantenimiento de la BD: %s páginas liberadas", liberadas, paginas=liberadas)
+        return liberadas
+
+    def pasada(self, ahora=None):
+        """Archiva y, si el local está cerrado y toca, hace el mantenimiento"""
+        ahora = ahora or datetime.now()
+        if self.dias > 0:
+            self.archivar()
+        franjas = franjas_horario(texto_horario())
+        if not franjas or en_horario(ahora, franjas):
+            return
+        if self._ultimo_mantenimiento and ahora - self._ultimo_mantenimiento < timedelta(hours=HORAS_ENTRE_MANTENIMIENTOS):
+            return
+        self.mantenimiento()
+        self._ultimo_mantenimiento = ahora
+
+    def _bucle(self):
+        espera = 60  # la primera pasada, ya arrancado el bot
+        while not self._parar.wait(espera):
+            espera = self.intervalo
+            try:
+                self.pasada()
+            except Exception as e:
+                log_error("❌ Error archivando pedidos: %s", e, exc_info=True)
+
+    def iniciar(self):
+        if not franjas_horario(texto_horario()):
+            log_aviso("⚠️ No se entiende FAQ['horario']: no habrá mantenimiento de la BD")
+        self._hilo = threading.Thread(target=self._bucle, name="archivador", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout=5)
+
+ARCHIVADOR = Archivador()
+
+# ============ COLA DE MENSAJES SALIENTES ============
+# Todo envío que no es la respuesta directa a un clic pasa por esta cola:
+# se guarda en `mensajes_salientes` y un hilo lo envía respetando los límites
+# de Telegram (global y por chat), reintentando ante RetryAfter o errores de red.
+PRIORIDAD_COCINA = 0    # comandas al grupo de pedidos
+PRIORIDAD_CLIENTE = 1   # avisos a clientes
+# Límites de Telegram; se pueden subir para pruebas de carga contra un servidor falso
+LIMITE_GLOBAL_POR_SEGUNDO = int(os.environ.get("LIMITE_GLOBAL_POR_SEGUNDO", 30))
+LIMITE_GRUPO_POR_MINUTO = int(os.environ.get("LIMITE_GRUPO_POR_MINUTO", 20))
+LIMITE_CHAT_POR_SEGUNDO = int(os.environ.get("LIMITE_CHAT_POR_SEGUNDO", 1))
+MAX_INTENTOS_ENVIO = 8
+
+class CuboTokens:
+    """Token bucket: ráfaga de `capacidad` envíos y `ritmo` envíos por segundo"""
+    __slots__ = ('capacidad', 'ritmo', 'tokens', 'actualizado', 'bloqueado_hasta')
+
+    def __init__(self, capacidad, ritmo):
+        self.capacidad = capacidad
+        self.ritmo = ritmo
+        self.tokens = capacidad
+        self.actualizado = time.monotonic()
+        self.bloqueado_hasta = 0.0
+
+    def espera(self, ahora):
+        """Segundos hasta poder enviar (0 si ya se puede)"""
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.ritmo)
+        self.actualizado = ahora
+        espera = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.ritmo
+        return max(espera, self.bloqueado_hasta - ahora)
+
+    def consumir(self):
+        self.tokens -= 1
+
+    def bloquear(self, ahora, segundos):
+        """Respeta un RetryAfter de Telegram"""
+        self.bloqueado_hasta = max(self.bloqueado_hasta, ahora + segundos)
+
+    def lleno(self, ahora):
+        return self.espera(ahora) == 0 and self.tokens >= self.capacidad
+
+class Latencias:
+    """Últimas muestras de una latencia (segundos) con percentiles bajo demanda"""
+
+    def __init__(self, muestras=1000):
+        self._muestras = deque(maxlen=muestras)
+        self._lock = threading.Lock()
+        self.cuenta = 0
+        self.maximo = 0.0
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._muestras.append(segundos)
+            self.cuenta += 1
+            if segundos > self.maximo:
+                self.maximo = segundos
+
+    def percentil(self, p):
+        with self._lock:
+            muestras = sorted(self._muestras)
+        if not muestras:
+            return 0.0
+        return muestras[min(len(muestras) - 1, int(len(muestras) * p / 100))]
+
+class MensajeSaliente:
+    __slots__ = ('id', 'chat_id', 'texto', 'teclado', 'parse_mode', 'prioridad', 'intentos', 'encolado', 'no_antes')
+
+    def __init__(self, id, chat_id, texto, teclado, parse_mode, prioridad, intentos, encolado):
+        self.id = id
+        self.chat_id = chat_id
+        self.texto = texto
+        self.teclado = teclado        # InlineKeyboardMarkup, o su JSON si viene de la BD
+        self.parse_mode = parse_mode
+        self.prioridad = prioridad
+        self.intentos = intentos
+        self.encolado = encolado      # time.monotonic() al encolar
+        self.no_antes = 0.0           # backoff tras un error de red
+
+    def clave(self):
+        return self.prioridad, self.id
+
+class ColaSalida:
+    """Cola priorizada y persistente de mensajes salientes con límites de envío"""
+
+    def __init__(self):
+        self.bot = None
+        self._cola = []  # ordenada por (prioridad, id)
+        self._cond = threading.Condition()
+        self._cubo_global = CuboTokens(LIMITE_GLOBAL_POR_SEGUNDO, LIMITE_GLOBAL_POR_SEGUNDO)
+        self._cubos = {}
+        self._hilo = None
+        self._parar = False
+        self.latencias = Latencias()
+        self.latencias_prioridad = {PRIORIDAD_COCINA: Latencias(), PRIORIDAD_CLIENTE: Latencias()}
+        self.enviados = 0
+        self.descartados = 0
+        self.reintentos = 0
+
+    def encolar(self, chat_id, texto, reply_markup=None, parse_mode=None, prioridad=PRIORIDAD_CLIENTE):
+        """Guarda el mensaje y lo pone en cola al confirmarse la transacción; devuelve su id"""
+        chat_id = str(chat_id)
+        with get_db() as conn:
+            c = conn.execute('''INSERT INTO mensajes_salientes (chat_id, texto, teclado, parse_mode, prioridad, creado)
+                                VALUES (?, ?, ?, ?, ?, ?)''',
+                             (chat_id, texto, reply_markup.to_json() if reply_markup else None,
+                              parse_mode, prioridad, datetime.now().isoformat()))
+            mensaje = MensajeSaliente(c.lastrowid, chat_id, texto, reply_markup, parse_mode,
+                                      prioridad, 0, time.monotonic())
+            POOL_DB.al_confirmar(lambda: self._poner(mensaje))
+        return mensaje.id
+
+    def _poner(self, mensaje):
+        with self._cond:
+            insort(self._cola, mensaje, key=MensajeSaliente.clave)
+            self._cond.notify()
+
+    def _cubo(self, chat_id):
+        cubo = self._cubos.get(chat_id)
+        if cubo is None:
+            if str(chat_id).startswith('-'):
+                cubo = CuboTokens(1, LIMITE_GRUPO_POR_MINUTO / 60)
+            else:
+                cubo = CuboTokens(1, LIMITE_CHAT_POR_SEGUNDO)
+            self._cubos[chat_id] = cubo
+        return cubo
+
+    def _siguiente(self, ahora):
+        """Saca el primer mensaje enviable; si no hay, devuelve cuánto esperar (None = indefinido)"""
+        if not self._cola:
+            if len(self._cubos) > 1000:
+                self._cubos = {chat: cubo for chat, cubo in self._cubos.items() if not cubo.lleno(ahora)}
+            return None, None
+        
+        espera_global = self._cubo_global.espera(ahora)
+        if espera_global > 0:
+            return None, espera_global
+        
+        espera_minima = None
+        retenidos = set()  # chats con un mensaje anterior pendiente: se respeta el orden
+        for i, mensaje in enumerate(self._cola):
+            if mensaje.chat_id in retenidos:
+                continue
+            cubo = self._cubo(mensaje.chat_id)
+            espera = max(mensaje.no_antes - ahora, cubo.espera(ahora))
+            if espera <= 0:
+                del self._cola[i]
+                cubo.consumir()
+                self._cubo_global.consumir()
+                return mensaje, 0
+            retenidos.add(mensaje.chat_id)
+            espera_minima = espera if espera_minima is None else min(espera_minima, espera)
+        return None, espera_minima
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._parar:
+                        return
+                    mensaje, espera = self._siguiente(time.monotonic())
+                    if mensaje:
+                        break
+                    self._cond.wait(espera)
+            self._enviar(mensaje)
+
+    def _enviar(self, mensaje):
+        teclado = mensaje.teclado
+        if isinstance(teclado, str):
+            teclado = InlineKeyboardMarkup.de_json(json.loads(teclado), self.bot)
+        
+        try:
+            self.bot.send_message(chat_id=mensaje.chat_id, text=mensaje.texto,
+                                  reply_markup=teclado, parse_mode=mensaje.parse_mode)
+        except RetryAfter as e:
+            # Límite de Telegram: no cuenta como intento fallido
+            ENVIOS_FALLIDOS.con('retry_after').incrementar()
+            with self._cond:
+                self._cubo(mensaje.chat_id).bloquear(time.monotonic(), e.retry_after)
+                self.reintentos += 1
+            self._poner(mensaje)
+            return
+        except ChatMigrated as e:
+            # El grupo pasó a supergrupo: se reenvía al chat nuevo
+            ENVIOS_FALLIDOS.con('chat_migrado').incrementar()
+            self._migrar_chat(str(mensaje.chat_id), str(e.new_chat_id))
+            mensaje.chat_id = str(e.new_chat_id)
+            self._poner(mensaje)
+            return
+        except (BadRequest, Unauthorized) as e:
+            # Mensaje inválido o usuario que ha bloqueado el bot: reintentar no sirve
+            ENVIOS_FALLIDOS.con('bad_request' if isinstance(e, BadRequest) else 'bloqueado').incrementar()
+            log_aviso("❌ Mensaje #%s descartado (%s): %s", mensaje.id, mensaje.chat_id, e,
+                      mensaje_id=mensaje.id, chat_id=mensaje.chat_id)
+            self._terminar(mensaje, enviado=False)
+            return
+        except Exception as e:
+            ENVIOS_FALLIDOS.con('error').incrementar()
+            mensaje.intentos += 1
+            if mensaje.intentos >= MAX_INTENTOS_ENVIO:
+                log_error("❌ Mensaje #%s descartado tras %s intentos: %s", mensaje.id, mensaje.intentos, e,
+                          mensaje_id=mensaje.id, chat_id=mensaje.chat_id)
+                self._terminar(mensaje, enviado=False)
+                return
+            
+            backoff = min(60, 2 ** mensaje.intentos) * random.uniform(0.8, 1.2)
+            log_aviso("⚠️ Error enviando mensaje #%s, reintento en %.0fs: %s", mensaje.id, backoff, e,
+                      mensaje_id=mensaje.id, chat_id=mensaje.chat_id, intentos=mensaje.intentos)
+            mensaje.no_antes = time.monotonic() + backoff
+            with get_db() as conn:
+                conn.execute("UPDATE mensajes_salientes SET intentos = ? WHERE id = ?", (mensaje.intentos, mensaje.id))
+            with self._cond:
+                self.reintentos += 1
+            self._poner(mensaje)
+            return
+        
+        self._terminar(mensaje, enviado=True)
+
+    def _migrar_chat(self, viejo, nuevo):
+        """Lleva al chat nuevo los mensajes pendientes del viejo y, si es el grupo de pedidos, el propio id"""
+        global ID_GRUPO_PEDIDOS
+        with self._cond:
+            for pendiente in self._cola:
+                if str(pendiente.chat_id) == viejo:
+                    pendiente.chat_id = nuevo
+        with get_db() as conn:
+            conn.execute("UPDATE mensajes_salientes SET chat_id = ? WHERE chat_id = ?", (nuevo, viejo))
+            if viejo == str(ID_GRUPO_PEDIDOS):
+                conn.execute("INSERT OR REPLACE INTO ajustes (clave, valor) VALUES ('id_grupo_pedidos', ?)", (nuevo,))
+        if viejo == str(ID_GRUPO_PEDIDOS):
+            ID_GRUPO_PEDIDOS = nuevo
+            log_error("🚨 El grupo de pedidos ha migrado de %s a %s: guardado en la BD, actualiza ID_GRUPO_PEDIDOS",
+                      viejo, nuevo, chat_viejo=viejo, chat_nuevo=nuevo)
+
+    def _terminar(self, mensaje, enviado):
+        with get_db() as conn:
+            conn.execute("DELETE FROM mensajes_salientes WHERE id = ?", (mensaje.id,))
+        with self._cond:
+            if enviado:
+                self.enviados += 1
+                latencia = time.monotonic() - mensaje.encolado
+                self.latencias.registrar(latencia)
+                self.latencias_prioridad[mensaje.prioridad].registrar(latencia)
+            else:
+                self.descartados += 1
+
+    def iniciar(self, bot):
+        """Carga los mensajes que quedaron sin enviar y arranca el hilo de envío"""
+        self.bot = bot
+        with get_db() as conn:
+            filas = conn.execute('''SELECT id, chat_id, texto, teclado, parse_mode, prioridad, intentos, creado
+                                    FROM mensajes_salientes ORDER BY id''').fetchall()
+        
+        with self._cond:
+            en_memoria = {mensaje.id for mensaje in self._cola}
+        filas = [fila for fila in filas if fila[0] not in en_memoria]
+        
+        ahora_reloj, ahora = datetime.now(), time.monotonic()
+        for id, chat_id, texto, teclado, parse_mode, prioridad, intentos, creado in filas:
+            encolado = ahora - (ahora_reloj - datetime.fromisoformat(creado)).total_seconds()
+            self._poner(MensajeSaliente(id, chat_id, texto, teclado, parse_mode, prioridad, intentos, encolado))
+        if filas:
+            log_info("📤 %s mensajes pendientes recuperados", len(filas))
+        
+        self._parar = False
+        self._hilo = threading.Thread(target=self._bucle, name="cola-salida", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Para el hilo; lo no enviado queda en la BD para el próximo arranque"""
+        with self._cond:
+            self._parar = True
+            self._cond.notify_all()
+        if self._hilo:
+            self._hilo.join(timeout=10)
+
+    def estadisticas(self):
+        """Profundidad de la cola, contadores y latencia encolado -> enviado"""
+        with self._cond:
+            return {
+                'profundidad': len(self._cola),
+                'enviados': self.enviados,
+                'descartados': self.descartados,
+                'reintentos': self.reintentos,
+                'latencia_p50': self.latencias.percentil(50),
+                'latencia_p95': self.latencias.percentil(95),
+                'latencia_max': self.latencias.maximo,
+            }
+
+COLA_SALIDA = ColaSalida()
+
+# Latencia de cada etapa de confirmar_hora (la entrega al grupo es
+# COLA_SALIDA.latencias_prioridad[PRIORIDAD_COCINA])
+ETAPAS_PEDIDO = {etapa: Latencias() for etapa in ('validacion', 'transaccion', 'confirmacion', 'total')}
+
+medidor("knocktwice_cola_salida_mensajes", "Mensajes pendientes en la cola de salida",
+        lambda: COLA_SALIDA.estadisticas()["profundidad"])
+medidor("knocktwice_mensajes_enviados_total", "Mensajes entregados por la cola de salida",
+        lambda: COLA_SALIDA.enviados, tipo='counter')
+medidor("knocktwice_mensajes_descartados_total", "Mensajes descartados por la cola de salida",
+        lambda: COLA_SALIDA.descartados, tipo='counter')
+medidor("knocktwice_pedido_p95_segundos", "p95 de las últimas confirmaciones de pedido por etapa",
+        lambda: {etapa: latencias.percentil(95) for etapa, latencias in ETAPAS_PEDIDO.items()}, "etapa")
+medidor("knocktwice_cola_salida_p95_segundos", "p95 del tiempo en cola de los mensajes enviados por prioridad",
+        lambda: {prioridad: latencias.percentil(95) for prioridad, latencias in COLA_SALIDA.latencias_prioridad.items()},
+        "prioridad")
+
+def enviar_mensaje(chat_id, texto, reply_markup=None, parse_mode=None, prioridad=PRIORIDAD_CLIENTE):
+    """Envía un mensaje a través de la cola de salida"""
+    return COLA_SALIDA.encolar(chat_id, texto, reply_markup=reply_markup, parse_mode=parse_mode, prioridad=prioridad)
+
+# ============ PANTALLAS PRECALCULADAS ============
+# Las pantallas que sólo dependen de la carta y las FAQ se construyen al
+# cargar el catálogo y se reutilizan en cada clic. Cada constructor devuelve (texto, teclado); el
+# texto es None cuando la pantalla sólo aporta el teclado.
+
+def _pantalla_inicio(admin):
+    kb = [[InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal')],
+          [InlineKeyboardButton("🛒 MI PEDIDO", callback_data='ver_carrito')],
+          [InlineKeyboardButton("❓ PREGUNTAS FRECUENTES", callback_data='faq_menu')],
+          [InlineKeyboardButton("⭐ VALORAR PEDIDO", callback_data='valorar_menu')]]
+    if admin:
+        kb.append([InlineKeyboardButton("🔧 PANEL ADMIN", callback_data='admin_panel')])
+    return None, InlineKeyboardMarkup(kb)
+
+def _pantalla_menu_principal(menu):
+    keyboard = [[InlineKeyboardButton(datos['titulo'], callback_data=f"cat_{categoria}")]
+                for categoria, datos in menu.items()]
+    keyboard += [
+        [InlineKeyboardButton("🛒 VER MI PEDIDO", callback_data='ver_carrito')],
+        [InlineKeyboardButton("❓ FAQ", callback_data='faq_menu')],
+        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+    ]
+    return "📂 **SELECCIONA UNA CATEGORÍA:**", InlineKeyboardMarkup(keyboard)
+
+def _pantalla_categoria(categoria, datos):
+    kb = [[InlineKeyboardButton(f"{p['nombre']} - {p['precio']}€" if p.get('disponible', True) else f"🚫 {p['nombre']} - agotado",
+                                callback_data=f"info_{categoria}_{pid}")]
+          for pid, p in datos['productos'].items()]
+    kb.append([InlineKeyboardButton("🔙 VOLVER", callback_data='menu_principal')])
+    return f"👇 **{datos['titulo']}**", InlineKeyboardMarkup(kb)
+
+def _pantalla_producto(categoria, producto_id, producto):
+    txt = f"🍽️ **{producto['nombre']}**\n\n_{producto['desc']}_\n\n💰 **Precio: {producto['precio']}€**\n⚠️ **ALÉRGENOS:** {', '.join(producto['alergenos'])}\n\n"
+    if not producto.get('disponible', True):
+        return (txt + "🚫 **AGOTADO** por hoy.",
+                InlineKeyboardMarkup([[InlineKeyboardButton("🔙 VOLVER", callback_data=f"cat_{categoria}")]]))
+    txt += "¿Cuántas quieres?"
+    kb = [[InlineKeyboardButton(str(i), callback_data=f"add_{categoria}_{producto_id}_{i}") for i in range(1, 4)],
+          [InlineKeyboardButton(str(i), callback_data=f"add_{categoria}_{producto_id}_{i}") for i in range(4, 6)],
+          [InlineKeyboardButton("🔙 VOLVER", callback_data=f"cat_{categoria}")]]
+    return txt, InlineKeyboardMarkup(kb)
+
+def _pantalla_anadido(categoria):
+    return None, InlineKeyboardMarkup([
+        [InlineKeyboardButton("🍽️ SEGUIR PIDIENDO", callback_data=f"cat_{categoria}")],
+        [InlineKeyboardButton("🛒 VER MI PEDIDO", callback_data='ver_carrito')],
+        [InlineKeyboardButton("🚀 TRAMITAR PEDIDO", callback_data='tramitar_pedido')]
+    ])
+
+def _pantalla_faq_menu(faq):
+    keyboard = [[InlineKeyboardButton(datos["pregunta"], callback_data=f"faq_{key}")]
+                for key, datos in faq.items()]
+    keyboard.append([
+        InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal'),
+        InlineKeyboardButton("🏠 INICIO", callback_data='inicio')
+    ])
+    return "❓ **PREGUNTAS FRECUENTES**\n\nSelecciona una pregunta:", InlineKeyboardMarkup(keyboard)
+
+def _pantalla_faq(datos):
+    return (f"{datos['respuesta']}\n\n_¿Te ha resuelto la duda?_",
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ SÍ", callback_data='faq_util_si'),
+                 InlineKeyboardButton("❌ NO", callback_data='faq_util_no')],
+                [InlineKeyboardButton("🔙 VOLVER A FAQ", callback_data='faq_menu')]
+            ]))
+
+def _pantalla_feedback_faq(util):
+    mensaje = "✅ ¡Gracias por tu feedback!" if util == 'si' else "❌ Lamentamos no haberte ayudado."
+    return mensaje, InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 VOLVER A FAQ", callback_data='faq_menu')],
+        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+    ])
+
+def _pantalla_sin_valorar():
+    return ("⭐ **NO HAY PEDIDOS PENDIENTES DE VALORAR**\n\n¡Gracias por tu apoyo!",
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("🍽️ HACER PEDIDO", callback_data='menu_principal')],
+                [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+            ]))
+
+def _pantalla_valoracion_registrada():
+    return None, InlineKeyboardMarkup([
+        [InlineKeyboardButton("🍽️ HACER OTRO PEDIDO", callback_data='menu_principal')],
+        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+    ])
+
+def _pantalla_vaciar_carrito():
+    return ("🗑️ **CESTA VACIADA**\n\nTu carrito ha sido vaciado.",
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal')],
+                [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+            ]))
+
+def _pantalla_admin_panel():
+    return None, InlineKeyboardMarkup([
+        [InlineKeyboardButton("📦 PEDIDOS RECIENTES", callback_data='admin_pedidos')],
+        [InlineKeyboardButton("🏆 MÁS VENDIDOS", callback_data='admin_productos')],
+        [InlineKeyboardButton("📚 ESTADÍSTICAS FAQ", callback_data='admin_faq')],
+        [InlineKeyboardButton(f"🔬 PERFILAR {SEGUNDOS_PERFIL} s / INFORME", callback_data='admin_perfil')],
+        [InlineKeyboardButton("🔄 ACTUALIZAR", callback_data='admin_panel')],
+        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+    ])
+
+def _pantalla_admin_pedidos():
+    return None, InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔙 PANEL ADMIN", callback_data='admin_panel')],
+        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+    ])
+
+def construir_pantallas(menu, faq):
+    """Construye todas las pantallas estáticas, indexadas por (pantalla, clave)"""
+    pantallas = {
+        ('inicio', False): _pantalla_inicio(False),
+        ('inicio', True): _pantalla_inicio(True),
+        ('menu_principal', None): _pantalla_menu_principal(menu),
+        ('faq_menu', None): _pantalla_faq_menu(faq),
+        ('feedback_faq', 'si'): _pantalla_feedback_faq('si'),
+        ('feedback_faq', 'no'): _pantalla_feedback_faq('no'),
+        ('sin_valorar', None): _pantalla_sin_valorar(),
+        ('valoracion_registrada', None): _pantalla_valoracion_registrada(),
+        ('vaciar_carrito', None): _pantalla_vaciar_carrito(),
+        ('admin_panel', None): _pantalla_admin_panel(),
+        ('admin_pedidos', None): _pantalla_admin_pedidos(),
+    }
+    for categoria, datos in menu.items():
+        pantallas[('cat', categoria)] = _pantalla_categoria(categoria, datos)
+        pantallas[('anadido', categoria)] = _pantalla_anadido(categoria)
+        for producto_id, producto in datos['productos'].items():
+            pantallas[('info', categoria, producto_id)] = _pantalla_producto(categoria, producto_id, producto)
+    for key, datos in faq.items():
+        pantallas[('faq', key)] = _pantalla_faq(datos)
+    return pantallas
+
+def pantalla(*clave):
+    """Devuelve (texto, teclado) de una pantalla precalculada del catálogo en uso"""
+    return CATALOGO.pantallas[clave]
+
+@lru_cache(maxsize=512)
+def teclado_valoracion_pedido(pedido_id):
+    """Plantilla de valoración de un pedido, cacheada por pedido_id"""
+    return (f"⭐ **VALORAR PEDIDO #{pedido_id}**\n\n¿Cómo calificarías tu experiencia?",
+            InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton("⭐", callback_data=f"puntuar_{pedido_id}_1"),
+                    InlineKeyboardButton("⭐⭐", callback_data=f"puntuar_{pedido_id}_2"),
+                    InlineKeyboardButton("⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_3")
+                ],
+                [
+                    InlineKeyboardButton("⭐⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_4"),
+                    InlineKeyboardButton("⭐⭐⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_5")
+                ],
+                [InlineKeyboardButton("🔙 VOLVER", callback_data='valorar_menu')]
+            ]))
+
+# ============ CATÁLOGO ============
+# La carta y las FAQ se leen de CATALOGO_PATH (por defecto catalogo.json junto a
+# este fichero; vacío para no usar fichero), un JSON {"version", "menu", "faq"}
+# con la misma forma que MENU y FAQ. Si no se puede leer se usan esos dos dicts.
+# Cada carga produce un Catalogo completo (índice plano de productos,
+# disponibilidad y pantallas ya construidas) que sustituye al anterior con una
+# sola asignación: un handler que lee CATALOGO una vez trabaja con una versión
+# coherente aunque la carta se recargue a mitad. Los carritos no se tocan.
+CATALOGO_PATH = os.environ.get("CATALOGO_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalogo.json"))
+SEGUNDOS_REVISION_CATALOGO = int(os.environ.get("SEGUNDOS_REVISION_CATALOGO", 30))
+ID_CATALOGO = re.compile(r"[a-z0-9]+")        # van en callback_data separados por '_'
+CLAVES_FAQ_RESERVADAS = {"menu", "util"}      # las taparían las rutas faq_menu y faq_util_
+MAX_CALLBACK_DATA = 64                        # bytes que admite Telegram
+RECARGAS_CATALOGO = contador("knocktwice_catalogo_recargas_total", "Recargas de la carta", "resultado")
+
+class ErrorCatalogo(ValueError):
+    """Carta con formato incorrecto; el mensaje indica dónde"""
+
+def _texto(valor, donde, vacio=False):
+    if not isinstance(valor, str) or not (valor or vacio):
+        raise ErrorCatalogo(f"{donde}: se esperaba un texto")
+    return valor
+
+def validar_catalogo(menu, faq):
+    """Comprueba la carta y las FAQ y devuelve copias normalizadas (con 'disponible' en cada producto)"""
+    if not isinstance(menu, dict) or not menu:
+        raise ErrorCatalogo("menu: se esperaba un objeto con las categorías")
+    if not isinstance(faq, dict):
+        raise ErrorCatalogo("faq: se esperaba un objeto con las preguntas")
+    
+    menu_valido, nombres = {}, set()
+    for categoria, datos in menu.items():
+        if not ID_CATALOGO.fullmatch(categoria) or not isinstance(datos, dict):
+            raise ErrorCatalogo(f"menu.{categoria}: id de categoría inválido (sólo a-z y 0-9)")
+        productos = datos.get('productos')
+        if not isinstance(productos, dict):
+            raise ErrorCatalogo(f"menu.{categoria}.productos: se esperaba un objeto")
+        productos_validos = {}
+        for producto_id, producto in productos.items():
+            donde = f"menu.{categoria}.productos.{producto_id}"
+            if not ID_CATALOGO.fullmatch(producto_id) or not isinstance(producto, dict):
+                raise ErrorCatalogo(f"{donde}: id de producto inválido (sólo a-z y 0-9)")
+            if len(f"add_{categoria}_{producto_id}_5".encode()) > MAX_CALLBACK_DATA:
+                raise ErrorCatalogo(f"{donde}: ids demasiado largos para un botón")
+            precio = producto.get('precio')
+            if isinstance(precio, bool) or not isinstance(precio, (int, float)) or precio < 0:
+                raise ErrorCatalogo(f"{donde}.precio: se esperaba un número positivo")
+            alergenos = producto.get('alergenos', [])
+            if not isinstance(alergenos, list) or not all(isinstance(a, str) for a in alergenos):
+                raise ErrorCatalogo(f"{donde}.alergenos: se esperaba una lista de textos")
+            disponible = producto.get('disponible', True)
+            if not isinstance(disponible, bool):
+                raise ErrorCatalogo(f"{donde}.disponible: se esperaba true o false")
+            nombre = _texto(producto.get('nombre'), f"{donde}.nombre")
+            # Los pedidos antiguos y los carritos viejos identifican el producto por su nombre
+            if nombre in nombres:
+                raise ErrorCatalogo(f"{donde}.nombre: '{nombre}' está repetido")
+            nombres.add(nombre)
+            productos_validos[producto_id] = {
+                "nombre": nombre, "precio": precio, "desc": _texto(producto.get('desc', ''), f"{donde}.desc", vacio=True),
+                "alergenos": list(alergenos), "disponible": disponible,
+            }
+        menu_valido[categoria] = {"titulo": _texto(datos.get('titulo'), f"menu.{categoria}.titulo"),
+                                  "productos": productos_validos}
+    
+    faq_valido = {}
+    for clave, datos in faq.items():
+        if not ID_CATALOGO.fullmatch(clave) or clave in CLAVES_FAQ_RESERVADAS or not isinstance(datos, dict):
+            raise ErrorCatalogo(f"faq.{clave}: clave inválida")
+        faq_valido[clave] = {"pregunta": _texto(datos.get('pregunta'), f"faq.{clave}.pregunta"),
+                             "respuesta": _texto(datos.get('respuesta'), f"faq.{clave}.respuesta")}
+    return menu_valido, faq_valido
+
+class Catalogo:
+    """Una versión de la carta y las FAQ con sus índices y pantallas; no se modifica nunca"""
+    __slots__ = ('menu', 'faq', 'version', 'productos', 'por_nombre', 'agotados', 'pantallas')
+
+    def __init__(self, menu, faq, version=None):
+        self.menu, self.faq = validar_catalogo(menu, faq)
+        self.version = version
+        # (categoria, producto_id) -> producto, sin recorrer la carta en cada clic
+        self.productos = {(categoria, producto_id): producto
+                          for categoria, datos in self.menu.items()
+                          for producto_id, producto in datos['productos'].items()}
+        self.por_nombre = {producto['nombre']: clave for clave, producto in self.productos.items()}
+        self.agotados = frozenset(clave for clave, producto in self.productos.items() if not producto['disponible'])
+        self.pantallas = construir_pantallas(self.menu, self.faq)
+
+    def producto(self, categoria, producto_id):
+        """Producto de la carta, o None si no existe"""
+        return self.productos.get((categoria, producto_id))
+
+    def no_disponibles(self, carrito):
+        """Nombres de las líneas del carrito que ya no están en la carta o están agotadas"""
+        return [nombre for categoria, producto_id, nombre, _, _ in carrito.lineas()
+                if (categoria, producto_id) not in self.productos or (categoria, producto_id) in self.agotados]
+
+def leer_catalogo(ruta):
+    """Lee y valida el JSON de la carta; no toca el catálogo en uso"""
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            datos = json.load(f)
+    except ValueError as e:
+        raise ErrorCatalogo(f"JSON inválido: {e}") from None
+    if not isinstance(datos, dict):
+        raise ErrorCatalogo("se esperaba un objeto con 'menu' y 'faq'")
+    return Catalogo(datos.get('menu'), datos.get('faq', FAQ), version=datos.get('version'))
+
+_lock_catalogo = threading.Lock()
+_firma_leida = None  # (mtime_ns, tamaño) del último fichero leído, bien o mal
+
+def recargar_catalogo(forzar=False):
+    """Carga CATALOGO_PATH si ha cambiado (mtime/tamaño y 'version'), o siempre con forzar.
+
+    Devuelve el catálogo nuevo, o None si no había nada que cargar. Los
+    errores (OSError, ErrorCatalogo) se propagan y el catálogo en uso se queda.
+    """
+    global CATALOGO, _firma_leida
+    if not CATALOGO_PATH:
+        return None
+    with _lock_catalogo:
+        estado = os.stat(CATALOGO_PATH)
+        firma = (estado.st_mtime_ns, estado.st_size)
+        if not forzar and firma == _firma_leida:
+            return None
+        _firma_leida = firma
+        try:
+            nuevo = leer_catalogo(CATALOGO_PATH)
+        except (OSError, ErrorCatalogo):
+            RECARGAS_CATALOGO.con('error').incrementar()
+            raise
+        if not forzar and nuevo.version is not None and nuevo.version == CATALOGO.version:
+            return None  # fichero guardado otra vez sin cambiar de versión
+        CATALOGO = nuevo
+        teclado_valoracion_pedido.cache_clear()
+    RECARGAS_CATALOGO.con('ok').incrementar()
+    log_info("🍽️ Carta cargada (versión %s): %s productos, %s agotados, %s FAQ", nuevo.version,
+             len(nuevo.productos), len(nuevo.agotados), len(nuevo.faq), version=nuevo.version)
+    return nuevo
+
+class VigilanteCatalogo:
+    """Hilo que recarga la carta cuando cambia el fichero"""
+
+    def __init__(self, intervalo=SEGUNDOS_REVISION_CATALOGO):
+        self.intervalo = intervalo
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                recargar_catalogo()
+            except (OSError, ErrorCatalogo) as e:
+                log_aviso("⚠️ No se recarga la carta, sigue la anterior: %s", e)
+
+    def iniciar(self):
+        if not CATALOGO_PATH or self.intervalo <= 0:
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="catalogo", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout=5)
+
+# La carta integrada hasta que se lea el fichero; si el fichero falla al
+# arrancar se sigue con ella y se reintenta cuando cambie
+CATALOGO = Catalogo(MENU, FAQ)
+try:
+    recargar_catalogo(forzar=True)
+except (OSError, ErrorCatalogo) as e:
+    log_error("❌ No se puede leer CATALOGO_PATH (%s), se usa la carta integrada: %s", CATALOGO_PATH, e)
+VIGILANTE_CATALOGO = VigilanteCatalogo()
+
+# ============ ENRUTADOR DE CALLBACKS ============
+# Cada botón se resuelve con una búsqueda exacta en un dict o, si no, con el
+# prefijo registrado más largo. Los handlers se registran con @ruta.
+RUTAS_EXACTAS = {}      # callback_data -> handler
+RUTAS_PREFIJO = {}      # prefijo (acabado en '_') -> (handler, tipos de los argumentos)
+CALLBACKS_RECHAZADOS = contador("knocktwice_callbacks_rechazados_total", "callback_data desconocidos o malformados", "motivo")
+
+class CallbackInvalido(ValueError):
+    """callback_data desconocido o con argumentos incorrectos"""
+
+    def __init__(self, motivo):
+        super().__init__(motivo)
+        self.motivo = motivo
+
+def ruta(patron, *tipos):
+    """Registra un handler de botón.
+
+    Un patrón acabado en '_' es un prefijo: el resto del callback_data se
+    parte por '_' en tantos argumentos como `tipos` y cada uno se convierte
+    con su tipo. Cualquier otro patrón es una coincidencia exacta.
+    """
+    def registrar(handler):
+        if patron.endswith('_'):
+            RUTAS_PREFIJO[patron] = (handler, tipos)
+        else:
+            RUTAS_EXACTAS[patron] = handler
+        return handler
+    return registrar
+
+def resolver_callback(data):
+    """Devuelve (patrón, handler, argumentos) para un callback_data o lanza CallbackInvalido"""
+    handler = RUTAS_EXACTAS.get(data)
+    if handler is not None:
+        return data, handler, ()
+    
+    # Prefijo más largo: se prueba desde el último '_' hacia el principio
+    corte = data.rfind('_')
+    while corte > 0:
+        prefijo = data[:corte + 1]
+        registro = RUTAS_PREFIJO.get(prefijo)
+        if registro is not None:
+            handler, tipos = registro
+            partes = data[corte + 1:].split('_', len(tipos) - 1) if tipos else []
+            if len(partes) != len(tipos) or not all(partes):
+                raise CallbackInvalido('malformado')
+            try:
+                return prefijo, handler, tuple(tipo(parte) for tipo, parte in zip(tipos, partes))
+            except (KeyError, ValueError):
+                raise CallbackInvalido('malformado') from None
+        corte = data.rfind('_', 0, corte)
+    
+    raise CallbackInvalido('desconocido')
+
 # ============ HANDLERS PRINCIPALES ============
 def start(update: Update, context: CallbackContext):
     """Comando /start - FUNCIONA CORRECTAMENTE PARA BOTONES Y COMANDOS"""
@@ -248,11 +2494,11 @@ def start(update: Update, context: CallbackContext):
     if update.callback_query:
         user = update.callback_query.from_user
         user_id = user.id
-        print(f"🔄 Botón INICIO de {user.username or user.first_name} (ID: {user_id})")
+        log_debug("🔄 Botón INICIO de %s", user.username or user.first_name, user_id=user_id)
     else:
         user = update.effective_user
         user_id = user.id
-        print(f"🚀 Comando /start de {user.username or user.first_name} (ID: {user_id})")
+        log_info("🚀 Comando /start de %s", user.username or user.first_name, user_id=user_id)
     
     # Verificar cooldown
     puede_pedir, minutos = verificar_cooldown(user_id)
@@ -265,8 +2511,7 @@ def start(update: Update, context: CallbackContext):
         return
     
     # Inicializar carrito
-    if 'carrito' not in context.user_data:
-        context.user_data['carrito'] = []
+    obtener_carrito(context)
     
     valoracion_promedio = obtener_valoracion_promedio()
     estrellas = "⭐" * int(valoracion_promedio) if valoracion_promedio > 0 else "Sin valoraciones"
@@ -281,53 +2526,34 @@ def start(update: Update, context: CallbackContext):
            f"⭐ *Valoración: {valoracion_promedio}/5 {estrellas}*{modo_texto}\n\n"
            f"*¿Qué deseas hacer?*")
     
-    kb = [[InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal')],
-          [InlineKeyboardButton("🛒 MI PEDIDO", callback_data='ver_carrito')],
-          [InlineKeyboardButton("❓ PREGUNTAS FRECUENTES", callback_data='faq_menu')],
-          [InlineKeyboardButton("⭐ VALORAR PEDIDO", callback_data='valorar_menu')]]
-    
-    if es_admin(user_id):
-        kb.append([InlineKeyboardButton("🔧 PANEL ADMIN", callback_data='admin_panel')])
+    _, kb = pantalla('inicio', es_admin(user_id))
     
     if update.callback_query:
         # Si viene de un botón, editar el mensaje existente
         try:
-            update.callback_query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+            update.callback_query.edit_message_text(txt, reply_markup=kb, parse_mode='Markdown')
         except Exception as e:
-            print(f"⚠️ Error editando mensaje: {e}")
+            log_aviso("⚠️ Error editando mensaje: %s", e, user_id=user_id)
             # Fallback: enviar nuevo mensaje
-            context.bot.send_message(
-                chat_id=user_id,
-                text=txt,
-                reply_markup=InlineKeyboardMarkup(kb),
-                parse_mode='Markdown'
-            )
+            enviar_mensaje(user_id, txt, reply_markup=kb, parse_mode='Markdown')
     else:
         # Si viene de comando, enviar nuevo mensaje
-        update.message.reply_text(txt, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
+        update.message.reply_text(txt, reply_markup=kb, parse_mode='Markdown')
 
+@ruta('menu_principal')
 def menu_principal(update: Update, context: CallbackContext):
     """Muestra el menú principal"""
     if update.callback_query:
         query = update.callback_query
-        query.answer()
-        mensaje_func = query.edit_message_text
-    else:
-        mensaje_func = update.message.reply_text
-    
-    keyboard = [
-        [InlineKeyboardButton("🍕 PIZZAS", callback_data='cat_pizzas')],
-        [InlineKeyboardButton("🍔 BURGERS", callback_data='cat_burgers')],
-        [InlineKeyboardButton("🍰 POSTRES", callback_data='cat_postres')],
-        [InlineKeyboardButton("🛒 VER MI PEDIDO", callback_data='ver_carrito')],
-        [InlineKeyboardButton("❓ FAQ", callback_data='faq_menu')],
-        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-    ]
+        query.answer()
+        mensaje_func = query.edit_message_text
+    else:
+        mensaje_func = update.message.reply_text
     
-    mensaje_func("📂 **SELECCIONA UNA CATEGORÍA:**", 
-                reply_markup=InlineKeyboardMarkup(keyboard), 
-                parse_mode='Markdown')
+    texto, keyboard = pantalla('menu_principal', None)
+    mensaje_func(texto, reply_markup=keyboard, parse_mode='Markdown')
 
+@ruta('ver_carrito')
 def ver_carrito(update: Update, context: CallbackContext):
     """Muestra el carrito"""
     if update.callback_query:
@@ -337,38 +2563,25 @@ def ver_carrito(update: Update, context: CallbackContext):
     else:
         mensaje_func = update.message.reply_text
     
-    carrito = context.user_data.get('carrito', [])
+    carrito = obtener_carrito(context)
     
     if not carrito:
         mensaje = "🛒 **TU CESTA ESTÁ VACÍA**"
         keyboard = [[InlineKeyboardButton("🍽️ IR A LA CARTA", callback_data='menu_principal')]]
     else:
-        productos_agrupados = {}
-        total = 0
-        
-        for item in carrito:
-            nombre = item['nombre']
-            precio = item['precio']
-            total += precio
-            
-            if nombre in productos_agrupados:
-                productos_agrupados[nombre]['cantidad'] += 1
-                productos_agrupados[nombre]['subtotal'] += precio
-            else:
-                productos_agrupados[nombre] = {
-                    'cantidad': 1,
-                    'precio': precio,
-                    'subtotal': precio
-                }
-        
         mensaje = "📝 **TU PEDIDO:**\n\n"
-        for nombre, info in productos_agrupados.items():
-            mensaje += f"▪️ {info['cantidad']}x {nombre} ... {info['subtotal']}€\n"
+        keyboard = []
+        for categoria, producto_id, nombre, cantidad, precio in carrito.lineas():
+            mensaje += f"▪️ {cantidad}x {nombre} ... {cantidad * precio}€\n"
+            callback = f"quitar_{categoria}_{producto_id}"
+            # Un botón con callback_data de más de 64 bytes tumbaría el teclado entero
+            if len(callback.encode()) <= MAX_CALLBACK_DATA:
+                keyboard.append([InlineKeyboardButton(f"➖ Quitar 1 {nombre}", callback_data=callback)])
         
-        mensaje += f"\n💰 **TOTAL:** {total}€\n\n"
+        mensaje += f"\n💰 **TOTAL:** {carrito.total}€\n\n"
         mensaje += "👇 Para continuar, necesitamos tu dirección de entrega."
         
-        keyboard = [
+        keyboard += [
             [InlineKeyboardButton("📍 PONER DIRECCIÓN", callback_data='pedir_direccion')],
             [InlineKeyboardButton("🗑️ VACIAR CESTA", callback_data='vaciar_carrito')],
             [InlineKeyboardButton("🍽️ SEGUIR PIDIENDO", callback_data='menu_principal')]
@@ -376,6 +2589,8 @@ def ver_carrito(update: Update, context: CallbackContext):
     
     mensaje_func(mensaje, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
+@ruta('pedir_direccion')
+@ruta('tramitar_pedido')
 def pedir_direccion(update: Update, context: CallbackContext):
     """Solicita la dirección"""
     query = update.callback_query
@@ -415,6 +2630,7 @@ def procesar_direccion(update: Update, context: CallbackContext):
         parse_mode='Markdown'
     )
 
+@ruta('hora_', str)
 def confirmar_hora(update: Update, context: CallbackContext, hora_elegida):
     """Confirma el pedido con la hora seleccionada"""
     query = update.callback_query
@@ -423,77 +2639,80 @@ def confirmar_hora(update: Update, context: CallbackContext, hora_elegida):
     user_id = query.from_user.id
     usuario = query.from_user
     
+    inicio = time.perf_counter()
+    
     # Verificar cooldown
     puede_pedir, minutos = verificar_cooldown(user_id)
     if not puede_pedir:
         query.edit_message_text(f"⏳ Espera {minutos} minuto(s)")
         return
     
-    carrito = context.user_data.get('carrito', [])
+    carrito = obtener_carrito(context)
     direccion = context.user_data.get('direccion', 'No especificada')
     
     if not carrito:
         query.edit_message_text("❌ El carrito está vacío")
         return
     
-    # Calcular total y productos
-    productos_agrupados = {}
-    total = 0
-    
-    for item in carrito:
-        nombre = item['nombre']
-        precio = item['precio']
-        total += precio
-        
-        if nombre in productos_agrupados:
-            productos_agrupados[nombre] += 1
-        else:
-            productos_agrupados[nombre] = 1
-    
-    productos_str = ", ".join([f"{cant}x {nombre}" for nombre, cant in productos_agrupados.items()])
-    texto_pedido = "".join([f"- {cant}x {nombre}\n" for nombre, cant in productos_agrupados.items()])
-    
-    # Guardar en BD
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO pedidos (user_id, username, productos, total, direccion, hora_entrega, estado, fecha)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (usuario.id, usuario.username, productos_str, total, direccion, 
-               hora_elegida, "pendiente", datetime.now().isoformat()))
-    
-    pedido_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    
-    # Actualizar cooldown
-    actualizar_cooldown(usuario.id, usuario.username)
+    # La carta puede haber cambiado desde que se llenó el carrito
+    no_disponibles = CATALOGO.no_disponibles(carrito)
+    if no_disponibles:
+        query.edit_message_text(
+            f"🚫 Ya no nos queda: {', '.join(no_disponibles)}.\n\nQuítalo de tu pedido para continuar.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 VER MI PEDIDO", callback_data='ver_carrito')]]))
+        return
     
-    # Enviar al grupo con ambos botones
+    # Calcular total y productos
+    total = carrito.total
+    lineas = [(nombre, cantidad) for _, _, nombre, cantidad, _ in carrito.lineas()]
+    productos_str = ", ".join([f"{cant}x {nombre}" for nombre, cant in lineas])
+    texto_pedido = "".join([f"- {cant}x {nombre}\n" for nombre, cant in lineas])
+    validado = time.perf_counter()
+    
+    # Pedido, cooldown y comanda para el grupo en una única transacción;
+    # la cola de salida envía la comanda en segundo plano tras el commit
     try:
-        keyboard = [
-            [InlineKeyboardButton("🛵 PEDIDO EN CAMINO", callback_data=f"camino_{pedido_id}")],
-            [InlineKeyboardButton("✅ ENTREGADO", callback_data=f"entregado_{pedido_id}")]
-        ]
-        
-        mensaje_grupo = (f"🚪 **NUEVO PEDIDO #{pedido_id}** 🚪\n\n"
-                         f"👤 Cliente: @{usuario.username or usuario.first_name}\n"
-                         f"⏰ Hora: {hora_elegida}\n"
-                         f"📍 Dirección: {direccion}\n"
-                         f"🍽️ Comanda:\n{texto_pedido}"
-                         f"💰 Total: {total}€\n"
-                         f"➖➖➖➖➖➖➖➖➖➖")
-        
-        context.bot.send_message(
-            chat_id=ID_GRUPO_PEDIDOS,
-            text=mensaje_grupo,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        print(f"✅ Pedido #{pedido_id} enviado al grupo con ambos botones")
+        with get_db() as conn:
+            fecha = datetime.now().isoformat()
+            c = conn.execute('''INSERT INTO pedidos (user_id, username, productos, total, direccion, hora_entrega, estado, fecha)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (usuario.id, usuario.username, productos_str, total, direccion, 
+                              hora_elegida, "pendiente", fecha))
+            pedido_id = c.lastrowid
+            conn.executemany('''INSERT INTO pedido_items (pedido_id, categoria, producto_id, cantidad, precio_unitario)
+                                VALUES (?, ?, ?, ?, ?)''',
+                             [(pedido_id, categoria or '', producto_id, cantidad, precio)
+                              for categoria, producto_id, _, cantidad, precio in carrito.lineas()])
+            sumar_ventas(conn, dia_de(fecha), pedidos=1, ventas=total)
+            
+            actualizar_cooldown(usuario.id, usuario.username)
+            
+            keyboard = [
+                [InlineKeyboardButton("🛵 PEDIDO EN CAMINO", callback_data=f"camino_{pedido_id}")],
+                [InlineKeyboardButton("✅ ENTREGADO", callback_data=f"entregado_{pedido_id}")]
+            ]
+            
+            mensaje_grupo = (f"🚪 **NUEVO PEDIDO #{pedido_id}** 🚪\n\n"
+                             f"👤 Cliente: @{usuario.username or usuario.first_name}\n"
+                             f"⏰ Hora: {hora_elegida}\n"
+                             f"📍 Dirección: {direccion}\n"
+                             f"🍽️ Comanda:\n{texto_pedido}"
+                             f"💰 Total: {total}€\n"
+                             f"➖➖➖➖➖➖➖➖➖➖")
+            
+            enviar_mensaje(ID_GRUPO_PEDIDOS, mensaje_grupo,
+                           reply_markup=InlineKeyboardMarkup(keyboard), prioridad=PRIORIDAD_COCINA)
     except Exception as e:
-        print(f"❌ Error enviando al grupo: {e}")
+        log_error("❌ Error guardando pedido: %s", e, user_id=usuario.id, exc_info=True)
+        query.edit_message_text("❌ No hemos podido registrar tu pedido. Inténtalo de nuevo en unos segundos.")
+        return
+    guardado = time.perf_counter()
+    PEDIDOS_CREADOS.incrementar()
+    log_info("✅ Pedido #%s guardado y encolado para el grupo", pedido_id,
+             pedido_id=pedido_id, user_id=usuario.id, total=total, duracion_ms=round((guardado - inicio) * 1000, 1))
     
-    # Limpiar carrito y mostrar confirmación
-    context.user_data['carrito'] = []
+    # Limpiar carrito y mostrar confirmación sin esperar al grupo
+    context.user_data['carrito'] = Carrito()
     context.user_data['direccion'] = None
     
     query.edit_message_text(
@@ -504,26 +2723,27 @@ def confirmar_hora(update: Update, context: CallbackContext, hora_elegida):
         f"⭐ *Recuerda:* Te pediremos valoración cuando te llegue",
         parse_mode='Markdown'
     )
+    confirmado = time.perf_counter()
+    
+    ETAPAS_PEDIDO['validacion'].registrar(validado - inicio)
+    ETAPAS_PEDIDO['transaccion'].registrar(guardado - validado)
+    ETAPAS_PEDIDO['confirmacion'].registrar(confirmado - guardado)
+    ETAPAS_PEDIDO['total'].registrar(confirmado - inicio)
 
+@ruta('vaciar_carrito')
 def vaciar_carrito(update: Update, context: CallbackContext):
     """Vacía el carrito"""
     query = update.callback_query
     query.answer()
     
-    context.user_data['carrito'] = []
+    context.user_data['carrito'] = Carrito()
     context.user_data['esperando_direccion'] = False
     
-    query.edit_message_text(
-        "🗑️ **CESTA VACIADA**\n\n"
-        "Tu carrito ha sido vaciado.",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal')],
-            [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-        ]),
-        parse_mode='Markdown'
-    )
+    texto, keyboard = pantalla('vaciar_carrito', None)
+    query.edit_message_text(texto, reply_markup=keyboard, parse_mode='Markdown')
 
 # ============ FAQ HANDLERS ============
+@ruta('faq_menu')
 def faq_menu(update: Update, context: CallbackContext):
     """Menú de FAQ"""
     if update.callback_query:
@@ -533,64 +2753,36 @@ def faq_menu(update: Update, context: CallbackContext):
     else:
         mensaje_func = update.message.reply_text
     
-    keyboard = []
-    for key, faq in FAQ.items():
-        keyboard.append([InlineKeyboardButton(faq["pregunta"], callback_data=f"faq_{key}")])
-    
-    keyboard.append([
-        InlineKeyboardButton("🍽️ VER CARTA", callback_data='menu_principal'),
-        InlineKeyboardButton("🏠 INICIO", callback_data='inicio')
-    ])
-    
-    mensaje_func(
-        "❓ **PREGUNTAS FRECUENTES**\n\nSelecciona una pregunta:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
-    )
+    texto, keyboard = pantalla('faq_menu', None)
+    mensaje_func(texto, reply_markup=keyboard, parse_mode='Markdown')
 
+@ruta('faq_', str)
 def mostrar_faq(update: Update, context: CallbackContext, faq_key):
     """Muestra una FAQ específica"""
     query = update.callback_query
     query.answer()
     
-    if faq_key not in FAQ:
+    catalogo = CATALOGO
+    if faq_key not in catalogo.faq:
         query.edit_message_text("❌ Pregunta no encontrada")
         return
     
-    registrar_consulta_faq(FAQ[faq_key]["pregunta"])
-    faq = FAQ[faq_key]
+    registrar_consulta_faq(catalogo.faq[faq_key]["pregunta"])
     
-    query.edit_message_text(
-        f"{faq['respuesta']}\n\n"
-        f"_¿Te ha resuelto la duda?_",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ SÍ", callback_data='faq_util_si'),
-             InlineKeyboardButton("❌ NO", callback_data='faq_util_no')],
-            [InlineKeyboardButton("🔙 VOLVER A FAQ", callback_data='faq_menu')]
-        ]),
-        parse_mode='Markdown'
-    )
+    texto, keyboard = catalogo.pantallas['faq', faq_key]
+    query.edit_message_text(texto, reply_markup=keyboard, parse_mode='Markdown')
 
+@ruta('faq_util_', str)
 def feedback_faq(update: Update, context: CallbackContext, util):
     """Procesa feedback de FAQ"""
     query = update.callback_query
     query.answer()
     
-    if util == 'si':
-        mensaje = "✅ ¡Gracias por tu feedback!"
-    else:
-        mensaje = "❌ Lamentamos no haberte ayudado."
-    
-    query.edit_message_text(
-        mensaje,
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 VOLVER A FAQ", callback_data='faq_menu')],
-            [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-        ]),
-        parse_mode='Markdown'
-    )
+    mensaje, keyboard = pantalla('feedback_faq', 'si' if util == 'si' else 'no')
+    query.edit_message_text(mensaje, reply_markup=keyboard, parse_mode='Markdown')
 
 # ============ VALORACIONES ============
+@ruta('valorar_menu')
 def valorar_menu(update: Update, context: CallbackContext):
     """Menú de valoraciones"""
     query = update.callback_query
@@ -599,18 +2791,11 @@ def valorar_menu(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     pedidos_sin_valorar = obtener_pedidos_sin_valorar(user_id)
     
-    print(f"📊 Valorar menu - User: {user_id}, Pedidos sin valorar: {len(pedidos_sin_valorar)}")
+    log_debug("📊 Valorar menú: %s pedidos sin valorar", len(pedidos_sin_valorar), user_id=user_id)
     
     if not pedidos_sin_valorar:
-        query.edit_message_text(
-            "⭐ **NO HAY PEDIDOS PENDIENTES DE VALORAR**\n\n"
-            "¡Gracias por tu apoyo!",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🍽️ HACER PEDIDO", callback_data='menu_principal')],
-                [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-            ]),
-            parse_mode='Markdown'
-        )
+        texto, keyboard = pantalla('sin_valorar', None)
+        query.edit_message_text(texto, reply_markup=keyboard, parse_mode='Markdown')
         return
     
     keyboard = []
@@ -633,30 +2818,22 @@ def valorar_menu(update: Update, context: CallbackContext):
         parse_mode='Markdown'
     )
 
+@ruta('valorar_pedido_', int)
 def mostrar_valoracion_pedido(update: Update, context: CallbackContext, pedido_id):
     """Muestra opciones de valoración"""
     query = update.callback_query
     query.answer()
     
-    mensaje = f"⭐ **VALORAR PEDIDO #{pedido_id}**\n\n¿Cómo calificarías tu experiencia?"
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("⭐", callback_data=f"puntuar_{pedido_id}_1"),
-            InlineKeyboardButton("⭐⭐", callback_data=f"puntuar_{pedido_id}_2"),
-            InlineKeyboardButton("⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_3")
-        ],
-        [
-            InlineKeyboardButton("⭐⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_4"),
-            InlineKeyboardButton("⭐⭐⭐⭐⭐", callback_data=f"puntuar_{pedido_id}_5")
-        ],
-        [InlineKeyboardButton("🔙 VOLVER", callback_data='valorar_menu')]
-    ]
-    
-    query.edit_message_text(mensaje, reply_markup=InlineKeyboardMarkup(keyboard))
+    mensaje, keyboard = teclado_valoracion_pedido(pedido_id)
+    query.edit_message_text(mensaje, reply_markup=keyboard)
 
+@ruta('puntuar_', int, int)
 def procesar_valoracion(update: Update, context: CallbackContext, pedido_id, estrellas):
     """Procesa la valoración"""
+    # Un valor fuera de rango descuadraría las sumas de ventas_diarias y totales
+    if not 1 <= estrellas <= 5:
+        raise CallbackInvalido('estrellas')
+    
     query = update.callback_query
     query.answer()
     
@@ -670,15 +2847,14 @@ def procesar_valoracion(update: Update, context: CallbackContext, pedido_id, est
         f"⭐ Has dado {estrellas} estrellas\n"
         f"📊 Valoración promedio: {valoracion_promedio}/5\n\n"
         f"¡Gracias por tu opinión!",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🍽️ HACER OTRO PEDIDO", callback_data='menu_principal')],
-            [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-        ]),
+        reply_markup=pantalla('valoracion_registrada', None)[1],
         parse_mode='Markdown'
     )
-    print(f"✅ Valoración guardada: Pedido #{pedido_id}, {estrellas} estrellas")
+    log_info("✅ Valoración guardada: pedido #%s, %s estrellas", pedido_id, estrellas,
+             pedido_id=pedido_id, estrellas=estrellas)
 
 # ============ BOTONES ADMIN ============
+@ruta('camino_', int)
 def pedido_en_camino_boton(update: Update, context: CallbackContext, pedido_id):
     """Botón para notificar que el pedido está en camino"""
     query = update.callback_query
@@ -691,25 +2867,21 @@ def pedido_en_camino_boton(update: Update, context: CallbackContext, pedido_id):
     query.answer()
     
     # Buscar el pedido
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM pedidos WHERE id = ?", (pedido_id,))
-    res = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        res = conn.execute("SELECT user_id FROM pedidos WHERE id = ?", (pedido_id,)).fetchone()
     
     if res:
         cliente_id = res[0]
         try:
-            # Notificar al cliente
-            context.bot.send_message(
-                chat_id=cliente_id, 
-                text=f"🛵 **¡TU PEDIDO #{pedido_id} ESTÁ EN CAMINO!**\n\n"
-                     f"Prepárate, nuestro repartidor llegará pronto.\n"
-                     f"¡Que aproveche! 🤫"
-            )
-            
-            # Actualizar estado
-            actualizar_estado_pedido(pedido_id, "en_camino")
+            # Notificar al cliente y actualizar estado en la misma transacción
+            with get_db():
+                enviar_mensaje(
+                    cliente_id,
+                    f"🛵 **¡TU PEDIDO #{pedido_id} ESTÁ EN CAMINO!**\n\n"
+                    f"Prepárate, nuestro repartidor llegará pronto.\n"
+                    f"¡Que aproveche! 🤫"
+                )
+                actualizar_estado_pedido(pedido_id, "en_camino")
             
             # Actualizar mensaje en grupo
             query.edit_message_text(
@@ -719,14 +2891,15 @@ def pedido_en_camino_boton(update: Update, context: CallbackContext, pedido_id):
                     InlineKeyboardButton("✅ ENTREGADO", callback_data=f"entregado_{pedido_id}")
                 ]])
             )
-            print(f"✅ Pedido #{pedido_id} marcado como 'en camino'")
+            log_info("✅ Pedido #%s marcado como 'en camino'", pedido_id, pedido_id=pedido_id, admin_id=user_id)
             
         except Exception as e:
-            print(f"❌ Error notificando cliente: {e}")
+            log_error("❌ Error notificando cliente: %s", e, pedido_id=pedido_id, exc_info=True)
             query.answer(f"❌ Error: {str(e)[:50]}", show_alert=True)
     else:
         query.answer("❌ Pedido no encontrado", show_alert=True)
 
+@ruta('entregado_', int)
 def pedido_entregado_boton(update: Update, context: CallbackContext, pedido_id):
     """Botón para notificar que el pedido ha sido entregado"""
     query = update.callback_query
@@ -739,11 +2912,8 @@ def pedido_entregado_boton(update: Update, context: CallbackContext, pedido_id):
     query.answer()
     
     # Buscar el pedido
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT user_id, productos, total FROM pedidos WHERE id = ?", (pedido_id,))
-    res = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        res = conn.execute("SELECT user_id, productos, total FROM pedidos WHERE id = ?", (pedido_id,)).fetchone()
     
     if res:
         cliente_id = res[0]
@@ -751,22 +2921,22 @@ def pedido_entregado_boton(update: Update, context: CallbackContext, pedido_id):
         total = res[2]
         
         try:
-            # Notificar al cliente que su pedido ha sido entregado
-            context.bot.send_message(
-                chat_id=cliente_id, 
-                text=f"✅ **¡TU PEDIDO #{pedido_id} HA SIDO ENTREGADO!**\n\n"
-                     f"🍽️ *Resumen:*\n{productos}\n"
-                     f"💰 *Total:* {total}€\n\n"
-                     f"⭐ *¿Cómo valorarías tu experiencia?*\n"
-                     f"Usa el botón de abajo para valorar ahora mismo:\n\n",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⭐ VALORAR ESTE PEDIDO", callback_data=f"valorar_pedido_{pedido_id}")
-                ]]),
-                parse_mode='Markdown'
-            )
-            
-            # Actualizar estado
-            actualizar_estado_pedido(pedido_id, "entregado")
+            # Notificar al cliente que su pedido ha sido entregado y actualizar estado
+            with get_db():
+                enviar_mensaje(
+                    cliente_id,
+                    f"✅ **¡TU PEDIDO #{pedido_id} HA SIDO ENTREGADO!**\n\n"
+                    f"🍽️ *Resumen:*\n{productos}\n"
+                    f"💰 *Total:* {total}€\n\n"
+                    f"⭐ *¿Cómo valorarías tu experiencia?*\n"
+                    f"Usa el botón de abajo para valorar ahora mismo:\n\n",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("⭐ VALORAR ESTE PEDIDO", callback_data=f"valorar_pedido_{pedido_id}")
+                    ]]),
+                    parse_mode='Markdown'
+                )
+                actualizar_estado_pedido(pedido_id, "entregado")
+            PEDIDOS_ENTREGADOS.incrementar()
             
             # Actualizar mensaje en grupo
             query.edit_message_text(
@@ -775,41 +2945,37 @@ def pedido_entregado_boton(update: Update, context: CallbackContext, pedido_id):
                     InlineKeyboardButton("✅ ENTREGADO", callback_data="ya_entregado")
                 ]])
             )
-            print(f"✅ Pedido #{pedido_id} marcado como 'entregado' y cliente notificado")
+            log_info("✅ Pedido #%s marcado como 'entregado' y cliente notificado", pedido_id,
+                     pedido_id=pedido_id, admin_id=user_id)
             
         except Exception as e:
-            print(f"❌ Error notificando entrega: {e}")
+            log_error("❌ Error notificando entrega: %s", e, pedido_id=pedido_id, exc_info=True)
             query.answer(f"❌ Error: {str(e)[:50]}", show_alert=True)
     else:
         query.answer("❌ Pedido no encontrado", show_alert=True)
 
 # ============ PANEL ADMIN ============
+@ruta('admin_panel')
 def admin_panel(update: Update, context: CallbackContext):
     """Panel de administración"""
     if update.callback_query:
         query = update.callback_query
+        if not es_admin(query.from_user.id):
+            query.answer("❌ Solo para administradores", show_alert=True)
+            return
         query.answer()
         mensaje_func = query.edit_message_text
     else:
+        if not es_admin(update.effective_user.id):
+            update.message.reply_text("❌ Comando no disponible.")
+            return
         mensaje_func = update.message.reply_text
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Pedidos de hoy
-    hoy = datetime.now().strftime("%Y-%m-%d")
-    c.execute("SELECT COUNT(*), SUM(total) FROM pedidos WHERE DATE(fecha) = ?", (hoy,))
-    pedidos_hoy = c.fetchone()
-    
-    # Total histórico
-    c.execute("SELECT COUNT(*), SUM(total) FROM pedidos")
-    total_historico = c.fetchone()
-    
-    # Valoración promedio
-    c.execute("SELECT AVG(valoracion) FROM pedidos WHERE valoracion > 0")
-    valoracion_promedio = c.fetchone()[0] or 0
-    
-    conn.close()
+    # Dos filas de los agregados (ventas_diarias y totales), no el histórico
+    pedidos_hoy = ventas_del_dia(datetime.now().date())
+    total_historico = obtener_totales()
+    valoracion_promedio = obtener_valoracion_promedio()
+    cola = COLA_SALIDA.estadisticas()
     
     mensaje = (
         "🔧 **PANEL DE ADMINISTRACIÓN**\n\n"
@@ -821,195 +2987,267 @@ def admin_panel(update: Update, context: CallbackContext):
         f"• Pedidos: {total_historico[0] or 0}\n"
         f"• Ventas: {total_historico[1] or 0:.2f}€\n\n"
         
-        f"⭐ *VALORACIÓN PROMEDIO:* {round(valoracion_promedio, 1) or 0.0}/5\n"
+        f"⭐ *VALORACIÓN PROMEDIO:* {valoracion_promedio}/5\n"
+        f"📤 *Cola de salida:* {cola['profundidad']} pendientes • p95 {cola['latencia_p95']:.1f}s\n"
+        f"⏱️ *Confirmar pedido p95:* {ETAPAS_PEDIDO['total'].percentil(95) * 1000:.0f} ms "
+        f"(BD {ETAPAS_PEDIDO['transaccion'].percentil(95) * 1000:.0f} ms) • "
+        f"a cocina {COLA_SALIDA.latencias_prioridad[PRIORIDAD_COCINA].percentil(95):.1f}s\n"
+        f"🧵 *Handlers en cola:* {EJECUTOR.pendientes if EJECUTOR else 0} ({HILOS_HANDLERS} hilos)\n"
         f"🔧 *Modo pruebas:* {'✅ ACTIVADO' if MODO_PRUEBAS else '❌ DESACTIVADO'}\n\n"
         
         f"⏰ *Hora:* {datetime.now().strftime('%d/%m/%Y %H:%M')}"
     )
     
+    _, keyboard = pantalla('admin_panel', None)
+    mensaje_func(mensaje, reply_markup=keyboard, parse_mode='Markdown')
+
+# Navegador de pedidos: filtros y cursor viajan en el callback_data
+# (admin_pedidos_<estado>_<día>_<cliente>_<dirección>_<id cursor>, < 64 bytes)
+PEDIDOS_POR_PAGINA = 8
+FILTROS_ESTADO = {'t': None, 'p': 'pendiente', 'c': 'en_camino', 'e': 'entregado'}
+ICONOS_ESTADO = {'pendiente': '🔄', 'en_camino': '🛵', 'entregado': '✅'}
+
+def _callback_pedidos(estado='t', dia='0', cliente=0, direccion='i', cursor=0):
+    """direccion: 'i' primera página, 's' más antiguos que cursor, 'a' más recientes que cursor"""
+    return f"admin_pedidos_{estado}_{dia}_{cliente}_{direccion}_{cursor}"
+
+def pagina_pedidos(estado='t', dia='0', cliente=0, direccion='i', cursor=0):
+    """Texto y teclado de una página del navegador de pedidos"""
+    if estado not in FILTROS_ESTADO or direccion not in 'isa':
+        raise CallbackInvalido('malformado')
+    try:
+        fecha_dia = datetime.strptime(dia, '%Y%m%d').date() if dia != '0' else None
+    except ValueError:
+        raise CallbackInvalido('malformado') from None
+    
+    pedidos, hay_mas = buscar_pedidos(FILTROS_ESTADO[estado], fecha_dia, cliente,
+                                      antes_de=cursor if direccion == 's' else None,
+                                      despues_de=cursor if direccion == 'a' else None,
+                                      limite=PEDIDOS_POR_PAGINA)
+    hay_recientes = hay_mas if direccion == 'a' else direccion == 's'
+    hay_antiguos = hay_mas if direccion != 'a' else True
+    
+    filtros = [f"{ICONOS_ESTADO[FILTROS_ESTADO[estado]]} {FILTROS_ESTADO[estado]}" if estado != 't' else None,
+               f"📅 {fecha_dia.strftime('%d/%m/%Y')}" if fecha_dia else None,
+               f"👤 {cliente}" if cliente else None]
+    mensaje = "📦 **PEDIDOS**" + "".join(f" • {filtro}" for filtro in filtros if filtro) + "\n\n"
+    if not pedidos:
+        mensaje += "📭 No hay pedidos con estos filtros."
+    for pedido_id, user_id, username, productos, total, direccion_entrega, hora, estado_pedido, fecha in pedidos:
+        productos = productos if len(productos) <= 200 else productos[:200] + "…"
+        mensaje += (
+            f"*#{pedido_id}* {ICONOS_ESTADO.get(estado_pedido, '🔄')} {datetime.fromisoformat(fecha).strftime('%d/%m %H:%M')}\n"
+            f"   👤 {escape_markdown(username or 'Anónimo')} ({user_id}) • ⏰ {escape_markdown(hora or '-')}\n"
+            f"   📍 {escape_markdown(direccion_entrega or '-')}\n"
+            f"   🍽️ {escape_markdown(productos)}\n"
+            f"   💰 {total}€\n\n"
+        )
+    
+    hoy = datetime.now().date()
+    ayer = hoy - timedelta(days=1)
+    def marca(activo, texto):
+        return f"• {texto} •" if activo else texto
     keyboard = [
-        [InlineKeyboardButton("📦 PEDIDOS RECIENTES", callback_data='admin_pedidos')],
-        [InlineKeyboardButton("🔄 ACTUALIZAR", callback_data='admin_panel')],
-        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
+        [InlineKeyboardButton(marca(estado == codigo, ICONOS_ESTADO.get(valor, "TODOS")),
+                              callback_data=_callback_pedidos(codigo, dia, cliente))
+         for codigo, valor in FILTROS_ESTADO.items()],
+        [InlineKeyboardButton(marca(dia == valor, texto), callback_data=_callback_pedidos(estado, valor, cliente))
+         for texto, valor in (("📅 HOY", hoy.strftime('%Y%m%d')), ("📅 AYER", ayer.strftime('%Y%m%d')),
+                              ("📅 TODOS", '0'))],
     ]
-    
-    mensaje_func(mensaje, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    paginas = []
+    if pedidos and hay_recientes:
+        paginas.append(InlineKeyboardButton("⬅️ MÁS RECIENTES",
+                                            callback_data=_callback_pedidos(estado, dia, cliente, 'a', pedidos[0][0])))
+    if pedidos and hay_antiguos:
+        paginas.append(InlineKeyboardButton("MÁS ANTIGUOS ➡️",
+                                            callback_data=_callback_pedidos(estado, dia, cliente, 's', pedidos[-1][0])))
+    if paginas:
+        keyboard.append(paginas)
+    if cliente:
+        keyboard.append([InlineKeyboardButton("👥 TODOS LOS CLIENTES", callback_data=_callback_pedidos(estado, dia))])
+    keyboard.append([InlineKeyboardButton("🔙 PANEL ADMIN", callback_data='admin_panel')])
+    return mensaje, InlineKeyboardMarkup(keyboard)
 
+@ruta('admin_pedidos')
 def mostrar_pedidos_recientes(update: Update, context: CallbackContext):
-    """Muestra pedidos recientes"""
+    """Primera página del navegador de pedidos, sin filtros"""
+    navegar_pedidos(update, context)
+
+@ruta('admin_pedidos_', str, str, int, str, int)
+def navegar_pedidos(update: Update, context: CallbackContext, estado='t', dia='0', cliente=0, direccion='i', cursor=0):
+    """Página del navegador de pedidos con sus filtros y su cursor"""
     query = update.callback_query
+    if not es_admin(query.from_user.id):
+        query.answer("❌ Solo para administradores", show_alert=True)
+        return
     query.answer()
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''SELECT id, username, productos, total, estado, fecha 
-                 FROM pedidos ORDER BY fecha DESC LIMIT 10''')
-    pedidos = c.fetchall()
-    conn.close()
+    mensaje, keyboard = pagina_pedidos(estado, dia, cliente, direccion, cursor)
+    query.edit_message_text(mensaje, reply_markup=keyboard, parse_mode='Markdown')
+
+def nombre_producto(categoria, producto_id):
+    """Nombre en la carta, o el id si el producto ya no existe"""
+    producto = CATALOGO.producto(categoria, producto_id)
+    return producto['nombre'] if producto else producto_id
+
+@ruta('admin_productos')
+def mostrar_productos_vendidos(update: Update, context: CallbackContext):
+    """Unidades por preparar y productos más vendidos (hoy, 7 días, histórico)"""
+    query = update.callback_query
+    if not es_admin(query.from_user.id):
+        query.answer("❌ Solo para administradores", show_alert=True)
+        return
+    query.answer()
     
-    if not pedidos:
-        mensaje = "📭 No hay pedidos recientes."
+    mensaje = "🍳 **POR PREPARAR**\n"
+    por_preparar = unidades_por_preparar()
+    mensaje += "".join(f"• {escape_markdown(nombre_producto(categoria, producto_id))}: *{unidades}*\n"
+                       for categoria, producto_id, unidades in por_preparar) or "• Nada pendiente\n"
+    
+    hoy = datetime.now().date()
+    for titulo, desde in (("HOY", hoy), ("ÚLTIMOS 7 DÍAS", hoy - timedelta(days=6)), ("HISTÓRICO", None)):
+        mensaje += f"\n🏆 **{titulo}**\n"
+        mensaje += "".join(f"{i}. {escape_markdown(nombre_producto(categoria, producto_id))}: "
+                           f"*{unidades}* uds • {ventas:.2f}€\n"
+                           for i, (categoria, producto_id, unidades, ventas)
+                           in enumerate(productos_mas_vendidos(desde), 1)) or "• Sin ventas\n"
+    
+    _, keyboard = pantalla('admin_pedidos', None)
+    query.edit_message_text(mensaje, reply_markup=keyboard, parse_mode='Markdown')
+
+@ruta('admin_faq')
+def mostrar_estadisticas_faq(update: Update, context: CallbackContext):
+    """Consultas por pregunta frecuente, incluidas las pendientes de guardar"""
+    query = update.callback_query
+    if not es_admin(query.from_user.id):
+        query.answer("❌ Solo para administradores", show_alert=True)
+        return
+    query.answer()
+    
+    totales = CONTADOR_FAQ.totales()
+    if not totales:
+        mensaje = "📭 Todavía no hay consultas de FAQ."
     else:
-        mensaje = "📦 **PEDIDOS RECIENTES**\n\n"
-        
-        for i, pedido in enumerate(pedidos, 1):
-            estado_icono = "✅" if pedido[4] == 'entregado' else "🛵" if pedido[4] == 'en_camino' else "🔄"
-            fecha = datetime.fromisoformat(pedido[5]).strftime("%H:%M")
-            
-            mensaje += (
-                f"{i}. *#{pedido[0]}* {estado_icono}\n"
-                f"   👤 {pedido[1] or 'Anónimo'}\n"
-                f"   🍽️ {pedido[2][:30]}...\n"
-                f"   💰 {pedido[3]}€ • {fecha}\n\n"
-            )
+        mensaje = "📚 **ESTADÍSTICAS FAQ**\n\n"
+        for pregunta, veces in totales.most_common():
+            mensaje += f"• {pregunta}: *{veces}*\n"
     
-    keyboard = [
-        [InlineKeyboardButton("🔙 PANEL ADMIN", callback_data='admin_panel')],
-        [InlineKeyboardButton("🏠 INICIO", callback_data='inicio')]
-    ]
+    _, keyboard = pantalla('admin_pedidos', None)
+    query.edit_message_text(mensaje, reply_markup=keyboard, parse_mode='Markdown')
+
+def alternar_perfilado(chat_id, segundos=SEGUNDOS_PERFIL):
+    """Abre una ventana de perfilado o, si ya hay una, la cierra y devuelve el informe"""
+    informe = PERFILADOR.detener()
+    if informe is not None:
+        return informe
+    PERFILADOR.iniciar(segundos, aviso_chat=chat_id)
+    log_info("🔬 Perfilado iniciado durante %s s", segundos, chat_id=chat_id)
+    return (f"🔬 Perfilando los handlers durante {segundos} s.\n"
+            f"Recibirás el informe al terminar; pulsa otra vez para cortarlo antes.")
+
+@ruta('admin_perfil')
+def boton_perfil(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if not es_admin(query.from_user.id):
+        query.answer("❌ Solo para administradores", show_alert=True)
+        return
     
-    query.edit_message_text(mensaje, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    _, keyboard = pantalla('admin_pedidos', None)
+    query.edit_message_text(alternar_perfilado(query.message.chat_id), reply_markup=keyboard)
 
 # ============ HANDLER DE BOTONES COMPLETO ============
+@ruta('inicio')
+def boton_inicio(update: Update, context: CallbackContext):
+    """Botón INICIO"""
+    query = update.callback_query
+    log_muestreado("inicio", "🔄 Botón INICIO pulsado", user_id=query.from_user.id)
+    try:
+        # Llamar a start directamente con el query
+        start(update, context)
+        # NO intentar borrar el mensaje anterior
+    except Exception as e:
+        log_error("❌ Error en inicio: %s", e, exc_info=True)
+        query.answer("⏳ Cargando...")
+        # Enviar mensaje de error simple
+        query.edit_message_text("🏠 Volviendo al inicio...", 
+                              reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 CARGAR", callback_data='inicio')]]))
+
+@ruta('cat_', str)
+def mostrar_categoria(update: Update, context: CallbackContext, categoria):
+    """Productos de una categoría"""
+    # Una sola búsqueda en el catálogo en uso: valida y da la pantalla de la misma versión
+    pantalla_categoria = CATALOGO.pantallas.get(('cat', categoria))
+    if pantalla_categoria is None:
+        raise CallbackInvalido('categoria')
+    
+    txt, kb = pantalla_categoria
+    update.callback_query.edit_message_text(txt, reply_markup=kb, parse_mode='Markdown')
+
+@ruta('info_', str, str)
+def mostrar_producto(update: Update, context: CallbackContext, categoria, producto_id):
+    """Ficha de un producto"""
+    ficha = CATALOGO.pantallas.get(('info', categoria, producto_id))
+    if ficha is None:
+        raise CallbackInvalido('producto')
+    
+    txt, kb = ficha
+    update.callback_query.edit_message_text(txt, reply_markup=kb, parse_mode='Markdown')
+
+@ruta('add_', str, str, int)
+def agregar_al_carrito(update: Update, context: CallbackContext, categoria, producto_id, cantidad):
+    """Añade unidades de un producto al carrito"""
+    catalogo = CATALOGO
+    producto = catalogo.producto(categoria, producto_id)
+    if producto is None or cantidad < 1:
+        raise CallbackInvalido('producto')
+    if not producto['disponible']:
+        # Botón de una ficha anterior a marcarlo agotado: se enseña la ficha actual
+        txt, kb = catalogo.pantallas['info', categoria, producto_id]
+        update.callback_query.edit_message_text(txt, reply_markup=kb, parse_mode='Markdown')
+        return
+    
+    obtener_carrito(context).agregar(categoria, producto_id, producto['nombre'], producto['precio'], cantidad)
+    
+    update.callback_query.edit_message_text(
+        f"✅ **{cantidad}x {producto['nombre']}** añadido(s) al carrito.\n\n"
+        f"¿Qué quieres hacer ahora?",
+        reply_markup=catalogo.pantallas['anadido', categoria][1],
+        parse_mode='Markdown'
+    )
+
+@ruta('quitar_', str, str)
+def quitar_del_carrito(update: Update, context: CallbackContext, categoria, producto_id):
+    """Quita una unidad de un producto y vuelve a mostrar el carrito"""
+    obtener_carrito(context).quitar_uno(categoria, producto_id)
+    ver_carrito(update, context)
+
+@ruta('ya_camino')
+@ruta('ya_entregado')
+def boton_ya_marcado(update: Update, context: CallbackContext):
+    update.callback_query.answer("✓")
+
 def button_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     data = query.data
     query.answer()
-    
-    print(f"🔘 Botón: {data}")
-    
-    # Navegación principal - BOTÓN INICIO CORREGIDO
-    if data == 'inicio':
-        print("🔄 Botón INICIO pulsado")
-        try:
-            # Llamar a start directamente con el query
-            start(update, context)
-            # NO intentar borrar el mensaje anterior
-        except Exception as e:
-            print(f"❌ Error en inicio: {e}")
-            query.answer("⏳ Cargando...")
-            # Enviar mensaje de error simple
-            query.edit_message_text("🏠 Volviendo al inicio...", 
-                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 CARGAR", callback_data='inicio')]]))
-    
-    elif data == 'menu_principal':
-        menu_principal(update, context)
-    
-    elif data == 'ver_carrito':
-        ver_carrito(update, context)
-    
-    elif data == 'tramitar_pedido':
-        pedir_direccion(update, context)
-    
-    elif data == 'pedir_direccion':
-        pedir_direccion(update, context)
-    
-    elif data == 'vaciar_carrito':
-        vaciar_carrito(update, context)
-    
-    # Categorías
-    elif data.startswith('cat_'):
-        categoria = data.split('_')[1]
-        kb = [[InlineKeyboardButton(f"{p['nombre']} - {p['precio']}€", callback_data=f"info_{categoria}_{pid}")] 
-              for pid, p in MENU[categoria]['productos'].items()]
-        kb.append([InlineKeyboardButton("🔙 VOLVER", callback_data='menu_principal')])
-        query.edit_message_text(f"👇 **{MENU[categoria]['titulo']}**", 
-                              reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
-    
-    # Info producto
-    elif data.startswith('info_'):
-        partes = data.split('_')
-        categoria = partes[1]
-        producto_id = partes[2]
-        producto = MENU[categoria]['productos'][producto_id]
-        
-        txt = f"🍽️ **{producto['nombre']}**\n\n_{producto['desc']}_\n\n💰 **Precio: {producto['precio']}€**\n⚠️ **ALÉRGENOS:** {', '.join(producto['alergenos'])}\n\n¿Cuántas quieres?"
-        kb = [[InlineKeyboardButton(str(i), callback_data=f"add_{categoria}_{producto_id}_{i}") for i in range(1, 4)],
-              [InlineKeyboardButton(str(i), callback_data=f"add_{categoria}_{producto_id}_{i}") for i in range(4, 6)],
-              [InlineKeyboardButton("🔙 VOLVER", callback_data=f"cat_{categoria}")]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(kb), parse_mode='Markdown')
-    
-    # Añadir al carrito
-    elif data.startswith('add_'):
-        partes = data.split('_')
-        categoria = partes[1]
-        producto_id = partes[2]
-        cantidad = int(partes[3])
-        producto = MENU[categoria]['productos'][producto_id]
-        
-        if 'carrito' not in context.user_data:
-            context.user_data['carrito'] = []
-        
-        for _ in range(cantidad):
-            context.user_data['carrito'].append({
-                'nombre': producto['nombre'],
-                'precio': producto['precio'],
-                'categoria': categoria
-            })
-        
-        query.edit_message_text(
-            f"✅ **{cantidad}x {producto['nombre']}** añadido(s) al carrito.\n\n"
-            f"¿Qué quieres hacer ahora?",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🍽️ SEGUIR PIDIENDO", callback_data=f"cat_{categoria}")],
-                [InlineKeyboardButton("🛒 VER MI PEDIDO", callback_data='ver_carrito')],
-                [InlineKeyboardButton("🚀 TRAMITAR PEDIDO", callback_data='tramitar_pedido')]
-            ]),
-            parse_mode='Markdown'
-        )
-    
-    # Hora
-    elif data.startswith('hora_'):
-        hora = data.split('_')[1]
-        confirmar_hora(update, context, hora)
-    
-    # FAQ
-    elif data == 'faq_menu':
-        faq_menu(update, context)
-    
-    elif data.startswith('faq_'):
-        if data.startswith('faq_util_'):
-            util = data.split('_')[2]
-            feedback_faq(update, context, util)
+    patron = 'rechazado'
+    inicio = time.perf_counter()
+    try:
+        patron, handler, argumentos = resolver_callback(data)
+        if PERFILADOR.activo:
+            PERFILADOR.ejecutar(patron, handler, update, context, *argumentos)
         else:
-            faq_key = data.split('_')[1]
-            mostrar_faq(update, context, faq_key)
-    
-    # Valoraciones
-    elif data == 'valorar_menu':
-        valorar_menu(update, context)
-    
-    elif data.startswith('valorar_pedido_'):
-        pedido_id = int(data.split('_')[2])
-        mostrar_valoracion_pedido(update, context, pedido_id)
-    
-    elif data.startswith('puntuar_'):
-        partes = data.split('_')
-        pedido_id = int(partes[1])
-        estrellas = int(partes[2])
-        procesar_valoracion(update, context, pedido_id, estrellas)
-    
-    # Botones admin
-    elif data.startswith('camino_'):
-        pedido_id = int(data.split('_')[1])
-        pedido_en_camino_boton(update, context, pedido_id)
-    
-    elif data.startswith('entregado_'):
-        pedido_id = int(data.split('_')[1])
-        pedido_entregado_boton(update, context, pedido_id)
-    
-    elif data in ['ya_camino', 'ya_entregado']:
-        query.answer("✓")
-    
-    # Admin panel
-    elif data == 'admin_panel':
-        admin_panel(update, context)
-    
-    elif data == 'admin_pedidos':
-        mostrar_pedidos_recientes(update, context)
-    
-    else:
+            handler(update, context, *argumentos)
+    except CallbackInvalido as e:
+        CALLBACKS_RECHAZADOS.con(e.motivo).incrementar()
+        log_aviso("⚠️ Callback rechazado (%s): %s", e.motivo, data, user_id=query.from_user.id)
         query.answer("Opción no disponible")
+    finally:
+        duracion = time.perf_counter() - inicio
+        LATENCIA_CALLBACKS.con(patron).registrar(duracion)
+        log_muestreado("boton", "🔘 Botón: %s", data, ruta=patron, user_id=query.from_user.id,
+                       duracion_ms=round(duracion * 1000, 1))
 
 # ============ HANDLER MENSAJES ============
 def handle_message(update: Update, context: CallbackContext):
@@ -1053,69 +3291,747 @@ def comando_admin(update: Update, context: CallbackContext):
 def comando_ayuda(update: Update, context: CallbackContext):
     handle_message(update, context)
 
+def comando_recalcular(update: Update, context: CallbackContext):
+    """/recalcular [comprobar] - Comprueba y reconstruye las ventas por día y los totales (solo admin)"""
+    if not es_admin(update.effective_user.id):
+        update.message.reply_text("❌ Comando no disponible.")
+        return
+    
+    if context.args and context.args[0] == 'comprobar':
+        diferencias = comprobar_ventas()
+        estado = "✅ Consistente" if not diferencias else "⚠️ Hay diferencias: /recalcular para corregirlas"
+    else:
+        diferencias = reconstruir_ventas()
+        estado = "✅ Consistente" if not diferencias else "⚠️ Corregido"
+    
+    nombres = {'pedidos': 'pedidos', 'ventas': 'ventas', 'suma_valoraciones': 'estrellas', 'valoraciones': 'valoraciones'}
+    lineas = "".join(f"• {clave} {nombres[campo]}: {guardado:g} → {real:g}\n" for clave, campo, guardado, real in diferencias[:10])
+    if len(diferencias) > 10:
+        lineas += f"• ... y {len(diferencias) - 10} más\n"
+    if lineas:
+        lineas += "\n"
+    pedidos, ventas, suma, cuenta = obtener_totales()
+    update.message.reply_text(
+        f"📊 **AGREGADOS DE VENTAS**\n\n"
+        f"{lineas}"
+        f"• Histórico: {pedidos} pedidos • {ventas:.2f}€\n"
+        f"• Valoraciones: {suma} ⭐ en {cuenta} pedidos\n\n"
+        f"{estado}",
+        parse_mode='Markdown'
+    )
+
+def comando_pedidos(update: Update, context: CallbackContext):
+    """/pedidos [estado] [AAAA-MM-DD|hoy|ayer] [@usuario|user_id] - Navegador de pedidos filtrado (solo admin)"""
+    if not es_admin(update.effective_user.id):
+        update.message.reply_text("❌ Comando no disponible.")
+        return
+    
+    codigos = {valor: codigo for codigo, valor in FILTROS_ESTADO.items() if valor}
+    estado, dia, cliente = 't', '0', 0
+    for argumento in context.args or []:
+        argumento = argumento.lower()
+        if argumento in codigos:
+            estado = codigos[argumento]
+        elif argumento in ('hoy', 'ayer'):
+            dia = (datetime.now().date() - timedelta(days=argumento == 'ayer')).strftime('%Y%m%d')
+        elif argumento.isdigit():
+            cliente = int(argumento)
+        elif argumento.startswith('@'):
+            with get_db() as conn:
+                fila = conn.execute("SELECT user_id FROM usuarios WHERE username = ? COLLATE NOCASE",
+                                    (argumento[1:],)).fetchone()
+            if not fila:
+                update.message.reply_text(f"❌ No conozco a {argumento}")
+                return
+            cliente = fila[0]
+        else:
+            try:
+                dia = datetime.strptime(argumento, '%Y-%m-%d').strftime('%Y%m%d')
+            except ValueError:
+                update.message.reply_text("Uso: /pedidos [pendiente|en_camino|entregado] [AAAA-MM-DD|hoy|ayer] "
+                                          "[@usuario|user_id]")
+                return
+    
+    mensaje, keyboard = pagina_pedidos(estado, dia, cliente)
+    update.message.reply_text(mensaje, reply_markup=keyboard, parse_mode='Markdown')
+
+def comando_perfil(update: Update, context: CallbackContext):
+    """/perfil [segundos] - Perfila los handlers durante una ventana o muestra el informe (solo admin)"""
+    if not es_admin(update.effective_user.id):
+        update.message.reply_text("❌ Comando no disponible.")
+        return
+    
+    segundos = SEGUNDOS_PERFIL
+    if context.args and context.args[0].isdigit():
+        segundos = min(max(int(context.args[0]), 1), 600)
+    update.message.reply_text(alternar_perfilado(update.effective_chat.id, segundos))
+
+def comando_recargar(update: Update, context: CallbackContext):
+    """/recargar - Vuelve a leer la carta de CATALOGO_PATH sin reiniciar (solo admin)"""
+    if not es_admin(update.effective_user.id):
+        update.message.reply_text("❌ Comando no disponible.")
+        return
+    
+    if not CATALOGO_PATH:
+        update.message.reply_text("ℹ️ No hay CATALOGO_PATH: se usa la carta integrada.")
+        return
+    try:
+        catalogo = recargar_catalogo(forzar=True)
+    except (OSError, ErrorCatalogo) as e:
+        # Sin Markdown: el error puede traer nombres con _ o *
+        update.message.reply_text(f"❌ No se ha recargado la carta, sigue la anterior.\n\n{e}")
+        return
+    agotados = ", ".join(sorted(catalogo.productos[clave]['nombre'] for clave in catalogo.agotados)) or "ninguno"
+    update.message.reply_text(
+        f"✅ Carta recargada (versión {catalogo.version or 'sin versión'})\n\n"
+        f"• Productos: {len(catalogo.productos)} en {len(catalogo.menu)} categorías\n"
+        f"• Agotados: {agotados}\n"
+        f"• FAQ: {len(catalogo.faq)} preguntas"
+    )
+
+# ============ CONCURRENCIA ============
+# Número de hilos para los handlers (BOT_HILOS=0 los ejecuta en el propio
+# hilo del dispatcher, uno detrás de otro)
+HILOS_HANDLERS = int(os.environ.get("BOT_HILOS", 8))
+
+class EjecutorPorUsuario:
+    """Pool de hilos que ejecuta los updates de un mismo usuario en serie.
+
+    context.user_data (carrito, dirección...) se modifica sin locks, así que
+    dos updates del mismo usuario nunca se solapan; los de usuarios distintos
+    sí se ejecutan en paralelo. Los updates que llegan mientras el usuario
+    tiene uno en marcha esperan en su propia cola sin ocupar un hilo.
+    """
+
+    def __init__(self, hilos):
+        self.hilos = hilos
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="handler")
+        self._colas = {}  # clave -> updates pendientes (sin contar el que se ejecuta)
+        self._lock = threading.Lock()
+        self._local = threading.local()  # clave del usuario que atiende cada hilo
+        self.pendientes = 0  # updates en cola o en ejecución
+
+    def enviar(self, clave, funcion, *args):
+        with self._lock:
+            self.pendientes += 1
+            cola = self._colas.get(clave)
+            if cola is not None:
+                cola.append((funcion, args))
+                return
+            self._colas[clave] = deque()
+        self._pool.submit(self._ejecutar, clave, funcion, args)
+
+    def ocupado_por_otro(self, clave):
+        """True si el usuario tiene updates pendientes fuera del hilo actual"""
+        return clave in self._colas and getattr(self._local, 'clave', None) != clave
+
+    def _ejecutar(self, clave, funcion, args):
+        self._local.clave = clave
+        try:
+            funcion(*args)
+        except Exception as e:
+            log_error("❌ Error en handler: %s", e, user_id=clave, exc_info=True)
+        finally:
+            self._local.clave = None
+            with self._lock:
+                self.pendientes -= 1
+                cola = self._colas[clave]
+                if cola:
+                    siguiente = cola.popleft()
+                else:
+                    del self._colas[clave]
+                    siguiente = None
+            if siguiente:
+                # Se reenvía al pool para no acaparar el hilo con un usuario muy activo
+                self._pool.submit(self._ejecutar, clave, *siguiente)
+
+    def detener(self):
+        """Espera a que terminen los updates pendientes"""
+        while self.pendientes:
+            time.sleep(0.05)
+        self._pool.shutdown(wait=True)
+
+EJECUTOR = EjecutorPorUsuario(HILOS_HANDLERS) if HILOS_HANDLERS > 0 else None
+medidor("knocktwice_handlers_pendientes", "Updates en cola o en ejecución en el pool de handlers",
+        lambda: EJECUTOR.pendientes if EJECUTOR else 0)
+
+def clave_usuario(update):
+    """Clave de serialización de un update: el usuario o, en su defecto, el chat"""
+    if update.effective_user:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat else None
+
+def en_paralelo(handler):
+    """Envuelve un handler para ejecutarlo en EJECUTOR, en serie por usuario"""
+    if EJECUTOR is None:
+        return handler
+    
+    def ejecutar(update, context):
+        try:
+            handler(update, context)
+        finally:
+            # El dispatcher no la guarda mientras el handler sigue en marcha
+            if context.dispatcher.persistence:
+                context.dispatcher.update_persistence(update=update)
+    
+    @wraps(handler)
+    def envoltorio(update, context):
+        EJECUTOR.enviar(clave_usuario(update), ejecutar, update, context)
+    return envoltorio
+
+# ============ EXPORTACIÓN ============
+# GET /export/<tabla>.<csv|jsonl>?desde=AAAA-MM-DD&hasta=AAAA-MM-DD con
+# "Authorization: Bearer <EXPORT_TOKEN>". Las filas salen de una conexión de
+# sólo lectura en lotes de fetchmany y se codifican y envían por trozos, así
+# que la memoria no depende del tamaño del histórico y los pedidos nuevos
+# nunca esperan (con WAL un lector no bloquea al escritor).
+TOKEN_EXPORTACION = os.environ.get("EXPORT_TOKEN", "")
+FILAS_POR_LOTE_EXPORTACION = 500
+# tabla -> (consulta con {esquema} y {donde} para el filtro de fechas, columna de
+# fecha, índices de la clave de orden). La consulta se lanza en la BD principal y
+# en la de archivo y las dos salidas, ordenadas por esa clave, se mezclan.
+CONSULTAS_EXPORTACION = {
+    "pedidos": ('''SELECT id, user_id, username, productos, total, direccion, hora_entrega, estado, valoracion, fecha
+                   FROM {esquema}.pedidos {donde} ORDER BY fecha, id''', "fecha", (9, 0)),
+    "pedido_items": ('''SELECT i.pedido_id, p.fecha, i.categoria, i.producto_id, i.cantidad, i.precio_unitario
+                        FROM {esquema}.pedidos p JOIN {esquema}.pedido_items i ON i.pedido_id = p.id
+                        {donde} ORDER BY p.fecha, p.id, i.categoria, i.producto_id''', "p.fecha", (1, 0, 2, 3)),
+    "valoraciones": ('''SELECT id, pedido_id, user_id, estrellas, comentario, fecha
+                        FROM {esquema}.valoraciones {donde} ORDER BY id''', "fecha", (0,)),
+}
+FORMATOS_EXPORTACION = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
+
+class ErrorExportacion(ValueError):
+    """Petición de exportación con tabla, formato o fechas incorrectos"""
+
+def conexion_lectura():
+    """Conexión aparte en modo sólo lectura: nunca toma el lock de escritura"""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=5, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    if os.path.exists(DB_ARCHIVO_PATH):
+        conn.execute("ATTACH DATABASE ? AS archivo", (f"file:{DB_ARCHIVO_PATH}?mode=ro",))
+    return conn
+
+def _limites_fechas(desde, hasta):
+    """[desde, hasta + 1 día) como textos ISO comparables con `fecha`"""
+    try:
+        inicio = datetime.strptime(desde, '%Y-%m-%d').date().isoformat() if desde else None
+        fin = (datetime.strptime(hasta, '%Y-%m-%d').date() + timedelta(days=1)).isoformat() if hasta else None
+    except ValueError:
+        raise ErrorExportacion("fechas en formato AAAA-MM-DD") from None
+    return inicio, fin
+
+def consulta_exportacion(conn, tabla, desde=None, hasta=None):
+    """Lanza la consulta de una tabla filtrada por fecha; devuelve (columnas, generador de lotes)"""
+    if tabla not in CONSULTAS_EXPORTACION:
+        raise ErrorExportacion(f"tabla desconocida: {tabla}")
+    consulta, columna_fecha, indices_clave = CONSULTAS_EXPORTACION[tabla]
+    inicio, fin = _limites_fechas(desde, hasta)
+    
+    condiciones, parametros = [], []
+    if inicio:
+        condiciones.append(f"{columna_fecha} >= ?")
+        parametros.append(inicio)
+    if fin:
+        condiciones.append(f"{columna_fecha} < ?")
+        parametros.append(fin)
+    donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    esquemas = [fila[1] for fila in conn.execute("PRAGMA database_list") if fila[1] in ("main", "archivo")]
+    cursores = [conn.execute(consulta.format(esquema=esquema, donde=donde), parametros) for esquema in esquemas]
+    
+    def filas(cursor):
+        while True:
+            lote = cursor.fetchmany(FILAS_POR_LOTE_EXPORTACION)
+            if not lote:
+                return
+            yield from lote
+    
+    def lotes():
+        clave = lambda fila: tuple(fila[i] for i in indices_clave)
+        lote, anterior = [], None
+        for fila in heapq.merge(*map(filas, cursores), key=clave):
+            # Un pedido a medio archivar sale de las dos BD, una fila detrás de otra
+            if clave(fila) == anterior:
+                continue
+            anterior = clave(fila)
+            lote.append(fila)
+            if len(lote) == FILAS_POR_LOTE_EXPORTACION:
+                yield lote
+                lote = []
+        if lote:
+            yield lote
+    return [descripcion[0] for descripcion in cursores[0].description], lotes()
+
+def _celda_csv(valor):
+    # Un texto que empieza por =, +, - o @ se ejecutaría como fórmula en una hoja de cálculo
+    if isinstance(valor, str) and valor[:1] in ('=', '+', '-', '@'):
+        return "'" + valor
+    return valor
+
+def codificar_exportacion(columnas, lotes, formato):
+    """Convierte los lotes en trozos de bytes: CSV con cabecera o JSONL"""
+    if formato == "csv":
+        salida = io.StringIO()
+        escritor = csv.writer(salida)
+        escritor.writerow(columnas)
+        for lote in lotes:
+            escritor.writerows([_celda_csv(valor) for valor in fila] for fila in lote)
+            yield salida.getvalue().encode("utf-8")
+            salida.seek(0)
+            salida.truncate()
+        resto = salida.getvalue()  # sólo la cabecera si no había filas
+        if resto:
+            yield resto.encode("utf-8")
+        return
+    
+    for lote in lotes:
+        yield "".join(json.dumps(dict(zip(columnas, fila)), ensure_ascii=False) + "\n"
+                      for fila in lote).encode("utf-8")
+
+def comprimir_gzip(trozos):
+    """gzip incremental: cada trozo se comprime según llega"""
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for trozo in trozos:
+        comprimido = compresor.compress(trozo)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
+
 # ============ SERVIDOR WEB ============
+MAX_TAMANO_UPDATE = 1024 * 1024
+DIR_WEB = os.path.dirname(os.path.abspath(__file__))
+DIR_ESTATICOS = os.path.join(DIR_WEB, "static")
+# Páginas servidas desde disco; lo demás sólo desde /static/
+PAGINAS_WEB = {"/": "index.html", "/index.html": "index.html"}
+CACHE_CONTROL_WEB = "public, max-age=300"
+SEGUNDOS_ENTRE_STAT = 2
+
+class RecursoEstatico:
+    """Fichero servido por la web, leído y comprimido una sola vez"""
+    __slots__ = ('cuerpo', 'cuerpo_gzip', 'tipo', 'etag', 'ultima_modificacion', 'mtime', 'comprobado')
+
+    def __init__(self, cuerpo, tipo, mtime):
+        self.cuerpo = cuerpo
+        gzip_cuerpo = gzip.compress(cuerpo, compresslevel=9)
+        self.cuerpo_gzip = gzip_cuerpo if len(gzip_cuerpo) < len(cuerpo) else None
+        self.tipo = tipo
+        self.etag = '"%s"' % hashlib.sha1(cuerpo).hexdigest()[:16]
+        self.ultima_modificacion = formatdate(mtime, usegmt=True)
+        self.mtime = mtime
+        self.comprobado = time.monotonic()
+
+class CacheEstaticos:
+    """Ficheros estáticos en memoria; se releen si cambia su mtime"""
+
+    def __init__(self):
+        self._recursos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, ruta):
+        """RecursoEstatico de una ruta absoluta, o None si no existe"""
+        recurso = self._recursos.get(ruta)
+        ahora = time.monotonic()
+        if recurso is not None and ahora - recurso.comprobado < SEGUNDOS_ENTRE_STAT:
+            return recurso
+        
+        try:
+            mtime = os.stat(ruta).st_mtime
+        except OSError:
+            self._recursos.pop(ruta, None)
+            return None
+        if recurso is not None and recurso.mtime == mtime:
+            recurso.comprobado = ahora
+            return recurso
+        
+        with open(ruta, "rb") as f:
+            cuerpo = f.read()
+        tipo = mimetypes.guess_type(ruta)[0] or "application/octet-stream"
+        if tipo.startswith("text/") or tipo in ("application/javascript", "application/json"):
+            tipo += "; charset=utf-8"
+        recurso = RecursoEstatico(cuerpo, tipo, mtime)
+        with self._lock:
+            self._recursos[ruta] = recurso
+        return recurso
+
+CACHE_ESTATICOS = CacheEstaticos()
+# Landing mínima por si falta index.html
+RECURSO_HTML_WEB = RecursoEstatico(HTML_WEB.encode("utf-8"), "text/html; charset=utf-8", time.time())
+
+def ruta_estatica(path):
+    """Fichero en disco para una ruta web, sin salir de los directorios permitidos"""
+    if path in PAGINAS_WEB:
+        return os.path.join(DIR_WEB, PAGINAS_WEB[path])
+    if path.startswith("/static/"):
+        ruta = os.path.realpath(os.path.join(DIR_ESTATICOS, path[len("/static/"):]))
+        if ruta.startswith(DIR_ESTATICOS + os.sep):
+            return ruta
+    return None
+
 class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
     def do_GET(self):
+        self._con_cuerpo = True
+        self._responder_get()
+    
+    def do_HEAD(self):
+        self._con_cuerpo = False
+        self._responder_get()
+    
+    def _responder_get(self):
+        url = urlsplit(self.path)
+        path = url.path
+        if path == "/healthz":
+            self._salud()
+            return
+        if path == "/metrics":
+            self._metricas()
+            return
+        if path.startswith("/export/"):
+            self._exportar(path[len("/export/"):], parse_qs(url.query))
+            return
+        
+        ruta = ruta_estatica(path)
+        recurso = CACHE_ESTATICOS.obtener(ruta) if ruta else None
+        if recurso is None and path in PAGINAS_WEB:
+            recurso = RECURSO_HTML_WEB
+        if recurso is None:
+            self.send_error(404)
+            return
+        self._servir(recurso)
+    
+    def _escribir(self, cuerpo):
+        if self._con_cuerpo:
+            self.wfile.write(cuerpo)
+    
+    def _servir(self, recurso):
+        """Responde con el recurso, un 304 si el cliente ya lo tiene, o gzip si lo acepta"""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            no_modificado = recurso.etag in [etag.strip() for etag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        else:
+            no_modificado = self.headers.get("If-Modified-Since") == recurso.ultima_modificacion
+        
+        cuerpo = recurso.cuerpo
+        comprimido = recurso.cuerpo_gzip is not None and "gzip" in self.headers.get("Accept-Encoding", "")
+        if comprimido:
+            cuerpo = recurso.cuerpo_gzip
+        
+        self.send_response(304 if no_modificado else 200)
+        self.send_header("ETag", recurso.etag)
+        self.send_header("Last-Modified", recurso.ultima_modificacion)
+        self.send_header("Cache-Control", CACHE_CONTROL_WEB)
+        self.send_header("Vary", "Accept-Encoding")
+        if no_modificado:
+            self.end_headers()
+            return
+        
+        self.send_header("Content-Type", recurso.tipo)
+        if comprimido:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self._escribir(cuerpo)
+    
+    def _metricas(self):
+        """/metrics en formato de texto de Prometheus"""
+        cuerpo = exponer_metricas()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self._escribir(cuerpo)
+    
+    def _exportar(self, nombre, parametros):
+        """/export/<tabla>.<csv|jsonl> en streaming (ver EXPORTACIÓN); no existe sin EXPORT_TOKEN"""
+        if not TOKEN_EXPORTACION:
+            self.send_error(404)
+            return
+        autorizacion = self.headers.get("Authorization", "")
+        token = autorizacion[len("Bearer "):] if autorizacion.startswith("Bearer ") else ""
+        if not hmac.compare_digest(token.encode("utf-8"), TOKEN_EXPORTACION.encode("utf-8")):
+            self.send_error(403)
+            return
+        
+        tabla, _, formato = nombre.partition(".")
+        if formato not in FORMATOS_EXPORTACION:
+            self.send_error(404)
+            return
+        
+        conn = None
+        try:
+            try:
+                conn = conexion_lectura()
+                columnas, lotes = consulta_exportacion(conn, tabla, parametros.get("desde", [None])[0],
+                                                       parametros.get("hasta", [None])[0])
+            except ErrorExportacion as e:
+                self.send_error(404 if tabla not in CONSULTAS_EXPORTACION else 400, str(e))
+                return
+            except sqlite3.Error as e:
+                log_error("❌ No se pudo abrir la exportación %s.%s: %s", tabla, formato, e)
+                self.send_error(503)
+                return
+            
+            filas = 0
+            def contar(lotes):
+                nonlocal filas
+                for lote in lotes:
+                    filas += len(lote)
+                    yield lote
+            trozos = codificar_exportacion(columnas, contar(lotes), formato)
+            comprimido = "gzip" in self.headers.get("Accept-Encoding", "")
+            if comprimido:
+                trozos = comprimir_gzip(trozos)
+            # HTTP/1.0 no entiende chunked: se envía tal cual y se cierra la conexión
+            por_trozos = self.request_version != "HTTP/1.0"
+            
+            self.send_response(200)
+            self.send_header("Content-Type", FORMATOS_EXPORTACION[formato])
+            self.send_header("Content-Disposition", f'attachment; filename="{tabla}.{formato}"')
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Vary", "Accept-Encoding")
+            if comprimido:
+                self.send_header("Content-Encoding", "gzip")
+            if por_trozos:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            if not self._con_cuerpo:
+                return
+            
+            inicio = time.perf_counter()
+            enviados = 0
+            for trozo in trozos:
+                if trozo:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(trozo), trozo) if por_trozos else trozo)
+                    enviados += len(trozo)
+            if por_trozos:
+                self.wfile.write(b"0\r\n\r\n")
+            log_info("📤 Exportación %s.%s: %s filas, %s bytes en %.1fs", tabla, formato, filas, enviados,
+                     time.perf_counter() - inicio, cliente=self.client_address[0], filas=filas, bytes=enviados)
+        except (BrokenPipeError, ConnectionResetError):
+            log_aviso("⚠️ Exportación %s.%s cortada por el cliente", tabla, formato, cliente=self.client_address[0])
+            self.close_connection = True
+        except sqlite3.Error as e:
+            # Las cabeceras ya han salido: se corta la respuesta para que el cliente no la dé por buena
+            log_error("❌ Error en la exportación %s.%s: %s", tabla, formato, e, exc_info=True)
+            self.close_connection = True
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def _salud(self):
+        """/healthz: 200 si la BD responde y el dispatcher está en marcha, 503 si no"""
+        estado = {"bd": comprobar_bd(), "dispatcher": "ok"}
+        
+        despachador = getattr(self.server, 'despachador', None)
+        if despachador is None or not getattr(despachador, 'running', True):
+            estado["dispatcher"] = "parado"
+        estado["cola_salida"] = COLA_SALIDA.estadisticas()["profundidad"]
+        
+        sano = estado["bd"] == "ok" and estado["dispatcher"] == "ok"
+        cuerpo = json.dumps(estado).encode("utf-8")
+        self.send_response(200 if sano else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self._escribir(cuerpo)
+    
+    def do_POST(self):
+        """Webhook de Telegram: valida el secreto y mete el update en la cola del dispatcher"""
+        despachador = getattr(self.server, 'despachador', None)
+        if self.path != RUTA_WEBHOOK or not WEBHOOK_SECRET:
+            self.send_error(404)
+            return
+        
+        secreto = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secreto, WEBHOOK_SECRET):
+            self.send_error(403)
+            return
+        
+        if despachador is None:
+            # Todavía arrancando: Telegram reintentará la entrega
+            self.send_error(503)
+            return
+        
+        try:
+            longitud = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(400)
+            return
+        if longitud <= 0 or longitud > MAX_TAMANO_UPDATE:
+            self.send_error(413 if longitud > 0 else 400)
+            return
+        
+        # JSON inválido, que no es un objeto o sin update_id: 400 en vez de una excepción en el hilo
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(longitud)), despachador.bot)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            update = None
+        if update is None:
+            self.send_error(400)
+            return
+        
+        despachador.update_queue.put(update)
         self.send_response(200)
-        self.send_header("Content-type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(HTML_WEB.encode("utf-8"))
+    
+    def log_request(self, code='-', size='-'):
+        # Sin log por petición: los monitores de uptime llaman cada pocos segundos
+        pass
     
     def log_message(self, format, *args):
-        print(f"🌐 Web: {args[0]} {args[1]}")
+        log_aviso("🌐 Web: " + format, *args, cliente=self.client_address[0])
+
+_conexion_salud = None
+_lock_salud = threading.Lock()
+
+def comprobar_bd():
+    """'ok' o el error de la BD, con una única conexión para todas las sondas de /healthz.
+
+    Cada petición web llega en un hilo nuevo: con get_db() cada sonda abriría
+    una conexión del pool (pragmas, ATTACH, caché de sentencias) que nunca se cierra.
+    """
+    global _conexion_salud
+    with _lock_salud:
+        try:
+            if _conexion_salud is None:
+                _conexion_salud = sqlite3.connect(DB_PATH, timeout=2, check_same_thread=False)
+            _conexion_salud.execute("PRAGMA user_version").fetchone()  # lee la cabecera del fichero
+            return "ok"
+        except sqlite3.Error as e:
+            if _conexion_salud is not None:
+                _conexion_salud.close()
+                _conexion_salud = None
+            return f"error: {e}"
+
+class ServidorWeb(ThreadingHTTPServer):
+    """Un hilo por conexión: un cliente lento no bloquea al resto"""
+    daemon_threads = True
+    request_queue_size = 128
+
+def crear_servidor_web(puerto):
+    """Servidor HTTP de la landing y del webhook; `despachador` se asigna al crear el bot"""
+    servidor = ServidorWeb(('0.0.0.0', puerto), HealthHandler)
+    servidor.despachador = None
+    threading.Thread(target=servidor.serve_forever, name="servidor-web", daemon=True).start()
+    return servidor
+
+def iniciar_webhook(updater):
+    """Registra el webhook y arranca dispatcher y job queue sin el servidor propio de PTB.
+
+    Los updates llegan por HealthHandler.do_POST. Devuelve False si Telegram
+    rechaza el webhook, para volver a polling.
+    """
+    try:
+        updater.bot.set_webhook(url=URL_PROYECTO + RUTA_WEBHOOK, secret_token=WEBHOOK_SECRET,
+                                allowed_updates=['message', 'callback_query'])
+    except Exception as e:
+        log_aviso("⚠️ No se pudo registrar el webhook (%s), usando polling", e)
+        return False
+    
+    listo = threading.Event()
+    updater.running = True
+    updater.job_queue.start()
+    updater._init_thread(updater.dispatcher.start, "dispatcher", ready=listo)
+    listo.wait()
+    return True
 
 def keep_alive():
     time.sleep(10)
     while True:
         try:
             requests.get(URL_PROYECTO, timeout=10)
-            print("✅ Ping enviado")
+            log_debug("✅ Ping enviado")
         except:
-            print("⚠️ Error ping")
+            log_aviso("⚠️ Error ping")
         time.sleep(300)
 
+# Comandos del bot: /nombre -> handler
+COMANDOS = {
+    "start": start,
+    "menu": comando_menu,
+    "pedido": comando_pedido,
+    "faq": comando_faq,
+    "valorar": comando_valorar,
+    "admin": comando_admin,
+    "ayuda": comando_ayuda,
+    "recalcular": comando_recalcular,
+    "perfil": comando_perfil,
+    "pedidos": comando_pedidos,
+    "recargar": comando_recargar,
+}
+
 def main():
-    print("🚀 Iniciando bot...")
+    log_info("🚀 Iniciando bot...")
     init_db()
     
     if not TOKEN:
-        print("❌ ERROR: No hay TELEGRAM_TOKEN")
+        log_error("❌ ERROR: No hay TELEGRAM_TOKEN")
         return
     
-    # Servidor web
-    threading.Thread(target=lambda: HTTPServer(('0.0.0.0', int(os.environ.get("PORT", 10000))), HealthHandler).serve_forever(), daemon=True).start()
-    print("✅ Servidor web iniciado")
+    # Servidor web (landing y webhook)
+    servidor = crear_servidor_web(int(os.environ.get("PORT", 10000)))
+    log_info("✅ Servidor web iniciado")
     
-    # Keep-alive
-    threading.Thread(target=keep_alive, daemon=True).start()
+    webhook = MODO_BOT == "webhook"
+    if webhook and not WEBHOOK_SECRET:
+        log_aviso("⚠️ MODO_BOT=webhook sin WEBHOOK_SECRET, usando polling")
+        webhook = False
     
-    # Bot
-    updater = Updater(TOKEN, use_context=True)
+    # Volcado periódico de estadísticas FAQ y de sesiones
+    CONTADOR_FAQ.iniciar()
+    PERSISTENCIA.iniciar()
+    ARCHIVADOR.iniciar()
+    VIGILANTE_CATALOGO.iniciar()
+    
+    # Bot (user_data se guarda en la tabla sesiones; cada llamada a la API se mide)
+    bot = ExtBot(TOKEN, base_url=f"{URL_API_TELEGRAM}/bot", request=PeticionMedida(con_pool_size=HILOS_HANDLERS + 8))
+    updater = Updater(bot=bot, use_context=True, persistence=PERSISTENCIA)
     dp = updater.dispatcher
     
-    # Handlers
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("menu", comando_menu))
-    dp.add_handler(CommandHandler("pedido", comando_pedido))
-    dp.add_handler(CommandHandler("faq", comando_faq))
-    dp.add_handler(CommandHandler("valorar", comando_valorar))
-    dp.add_handler(CommandHandler("admin", comando_admin))
-    dp.add_handler(CommandHandler("ayuda", comando_ayuda))
-    
-    dp.add_handler(CallbackQueryHandler(button_handler))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-    
-    print("="*50)
-    print("🎉 BOT KNOCK TWICE ACTIVO!")
-    print(f"🔧 Modo pruebas: {'✅ ACTIVADO' if MODO_PRUEBAS else '❌ DESACTIVADO'}")
-    print(f"📊 Todas las pizzas restauradas: {len(MENU['pizzas']['productos'])}")
-    print(f"📚 FAQ completo: {len(FAQ)} preguntas")
-    print(f"🛵✅ Botones: PEDIDO EN CAMINO y ENTREGADO activos")
-    print(f"🏠 Botón INICIO funcionando correctamente")
-    print("="*50)
-    
-    updater.start_polling()
+    # Envíos al grupo y a clientes, con límites y reintentos
+    COLA_SALIDA.iniciar(updater.bot)
+    
+    # Handlers (en el pool de hilos, en serie por usuario, con su duración en /metrics)
+    for nombre, handler in COMANDOS.items():
+        dp.add_handler(CommandHandler(nombre, en_paralelo(medir(LATENCIA_COMANDOS, nombre, handler))))
+    
+    dp.add_handler(CallbackQueryHandler(en_paralelo(button_handler)))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command,
+                                  en_paralelo(medir(LATENCIA_COMANDOS, "mensaje", handle_message))))
+    
+    log_info("🎉 BOT KNOCK TWICE ACTIVO!")
+    log_info("🔧 Modo pruebas: %s", '✅ ACTIVADO' if MODO_PRUEBAS else '❌ DESACTIVADO')
+    log_info("📊 Carta: %s productos (%s agotados), versión %s", len(CATALOGO.productos), len(CATALOGO.agotados),
+             CATALOGO.version or 'integrada')
+    log_info("📚 FAQ completo: %s preguntas", len(CATALOGO.faq))
+    log_info("🛵✅ Botones: PEDIDO EN CAMINO y ENTREGADO activos")
+    log_info("🏠 Botón INICIO funcionando correctamente")
+    log_info("🧵 Hilos para handlers: %s", HILOS_HANDLERS or 'ninguno (secuencial)')
+    
+    servidor.despachador = dp
+    if webhook and iniciar_webhook(updater):
+        log_info("📬 Recibiendo updates por webhook en %s", RUTA_WEBHOOK)
+    else:
+        # Keep-alive (con webhook las entregas de Telegram ya mantienen el servicio despierto)
+        threading.Thread(target=keep_alive, daemon=True).start()
+        updater.start_polling()
     updater.idle()
+    if EJECUTOR:
+        EJECUTOR.detener()
+    dp.update_persistence()
+    PERSISTENCIA.detener()
+    COLA_SALIDA.detener()
+    CONTADOR_FAQ.detener()
+    ARCHIVADOR.detener()
+    VIGILANTE_CATALOGO.detener()
+    POOL_DB.cerrar()
 
 if __name__ == "__main__":
     main()